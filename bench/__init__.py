@@ -0,0 +1,8 @@
+# bench — бенчмарки и golden-проверка горячего пути (парсинг сообщений и сопоставление моделей).
+#
+#   python -m bench                  # замеры: строк/сек и время по функциям
+#   python -m bench --check          # сверка с bench/golden.jsonl и с эталонным baseline_resolve (код 1 при расхождении)
+#   python -m bench --update-golden  # перезаписать golden после осознанного изменения поведения
+#   python -m bench.plans            # EXPLAIN QUERY PLAN всех запросов Repo: без полных сканов и temp B-tree
+#   python -m pytest -q              # tests/: те же проверки golden, планов (и parity) как тесты
+#   PG_TEST_URL=... python -m bench.parity  # db_pg.PgRepo против db.Repo на одном сценарии
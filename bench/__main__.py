@@ -0,0 +1,207 @@
+# bench/__main__.py — замеры и golden-проверка парсинга/сопоставления (см. bench/__init__.py)
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")  # bot.py создаёт Bot при импорте
+
+import bot  # noqa: E402
+import db  # noqa: E402
+from bench.corpus import corpus, synthetic_catalog  # noqa: E402
+
+GOLDEN = Path(__file__).with_name("golden.jsonl")
+NETWORK = "Bench"
+PRODUCTS = 3000  # каталог по умолчанию; golden.jsonl записан на нём
+
+
+async def build_repo(catalog) -> db.Repo:
+    repo = db.Repo()
+    await repo.ensure_network(NETWORK)
+    async with repo.tx():
+        for i, (name, aliases) in enumerate(catalog):
+            pid = await repo.ensure_product(name)
+            for alias in aliases:
+                await repo.ensure_product(name, alias)
+            if i % 10 == 0:  # в стоке сети — каждый десятый товар
+                await repo.add_stock(NETWORK, pid, 128, 5, day=bot.today_local())
+    return repo
+
+
+def data_models(scan: bot.TextScan) -> List[str]:
+    """model_raw, которые обработчик этого сообщения отдал бы в сопоставление."""
+    if scan.kind == "sale":
+        return [it["model_raw"] for it in scan.sale_items()]
+    if scan.kind == "stock_inc":
+        return [l.model for l in scan.lines if l.text and l.kind == "stock_inc"]
+    if scan.kind == "stock_snapshot":
+        return [l.model for l in scan.lines[1:] if l.text]
+    return []
+
+
+async def golden_records(repo: db.Repo, messages: List[str]) -> List[Dict[str, Any]]:
+    out = []
+    for text in messages:
+        scan = bot.TextScan(text)
+        resolved = await bot.resolve_products_batch(repo, NETWORK, data_models(scan))
+        out.append({
+            "text": text,
+            "kind": bot.classify_message(text),
+            "items": bot.parse_sales_message(text),
+            "resolved": [name if pid else None for pid, name in resolved],
+        })
+    return out
+
+
+async def baseline_resolve(repo: db.Repo, network: str, raw_model: str):
+    """Сопоставление до кэшей и cdist: extractOne по строке, сток (82), затем каталог (90).
+    Эталон семантики — пороги и скоринг bot.resolve_products_batch должны давать то же самое."""
+    from rapidfuzz import process, fuzz
+    q = bot._norm(raw_model)
+    for rows, cutoff in ((await repo.get_network_stock_candidates(network), 82),
+                         (await repo.get_product_candidates_with_aliases(), 90)):
+        if rows:
+            names = [name for _, name in rows]
+            match = process.extractOne(q, names, scorer=fuzz.WRatio)
+            if match and match[1] >= cutoff:
+                return rows[match[2]][0], names[match[2]]
+    return None, raw_model
+
+
+async def baseline_mismatches(repo: db.Repo, messages: List[str]) -> List[Any]:
+    bad = []
+    for text in messages:
+        models = data_models(bot.TextScan(text))
+        got = await bot.resolve_products_batch(repo, NETWORK, models)
+        for raw, res in zip(models, got):
+            want = await baseline_resolve(repo, NETWORK, raw)
+            if res != want:
+                bad.append((raw, want, res))
+    return bad
+
+
+async def check_baseline(repo: db.Repo, messages: List[str]) -> int:
+    """0 — resolve_products_batch совпадает с baseline_resolve на всём корпусе."""
+    drift = await baseline_mismatches(repo, messages)
+    for raw, want, res in drift[:10]:
+        print(f"BASELINE {raw!r}: baseline {want!r}, batch {res!r}")
+    if drift:
+        print(f"baseline: {len(drift)} models resolve differently from baseline_resolve")
+        return 1
+    return 0
+
+
+async def check_golden(repo: db.Repo, messages: List[str]) -> int:
+    """0 — разбор и сопоставление корпуса совпадают с golden.jsonl."""
+    records = await golden_records(repo, messages)
+    expected = [json.loads(l) for l in GOLDEN.read_text(encoding="utf-8").splitlines() if l]
+    if len(expected) != len(records):
+        print(f"golden: {len(expected)} records, corpus has {len(records)}")
+        return 1
+    bad = [(e, r) for e, r in zip(expected, records) if e != r]
+    for e, r in bad[:10]:
+        print(f"MISMATCH {e['text']!r}\n  expected: {e}\n  actual:   {r}")
+    print(f"golden: {len(records) - len(bad)}/{len(records)} ok")
+    return 1 if bad else 0
+
+
+def _best_of(fn: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+async def _abest_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+async def run_bench(repo: db.Repo, messages: List[str], repeat: int):
+    lines = [l for text in messages for l in text.splitlines() if l.strip()]
+    sales = [t for t in messages if bot.classify_message(t) == "sale"]
+    scans = [bot.TextScan(t) for t in messages]
+    models = [m for sc in scans for m in data_models(sc)]
+
+    def scan_all():
+        for t in messages:
+            sc = bot.TextScan(t)
+            if sc.kind != "ignore":
+                data_models(sc)
+
+    async def resolve_lines():
+        for m in models:
+            await bot.resolve_product_from_stock_first(repo, NETWORK, m)
+
+    async def resolve_messages():
+        for sc in scans:
+            ms = data_models(sc)
+            if ms:
+                await bot.resolve_products_batch(repo, NETWORK, ms)
+
+    await bot.resolve_products_batch(repo, NETWORK, models[:1])  # прогрев кэша кандидатов
+    rows = [
+        ("classify_message", len(messages), len(lines), _best_of(lambda: [bot.classify_message(t) for t in messages], repeat)),
+        ("parse_sales_message", len(sales), sum(len(t.splitlines()) for t in sales),
+         _best_of(lambda: [bot.parse_sales_message(t) for t in sales], repeat)),
+        ("_clean_model_fragment", len(lines), len(lines), _best_of(lambda: [bot._clean_model_fragment(l) for l in lines], repeat)),
+        ("TextScan (kind+models)", len(messages), len(lines), _best_of(scan_all, repeat)),
+        ("resolve_product_from_stock_first", len(models), len(models), await _abest_of(resolve_lines, max(1, repeat // 3))),
+        ("resolve_products_batch", sum(1 for sc in scans if data_models(sc)), len(models),
+         await _abest_of(resolve_messages, max(1, repeat // 3))),
+    ]
+    print(f"corpus: {len(messages)} messages, {len(lines)} lines, {len(models)} models to resolve")
+    print(f"{'function':36} {'calls':>7} {'lines':>7} {'ms':>9} {'us/call':>9} {'lines/s':>10}")
+    for name, calls, n_lines, sec in rows:
+        print(f"{name:36} {calls:7d} {n_lines:7d} {sec * 1000:9.1f} {sec / max(calls, 1) * 1e6:9.1f} {n_lines / sec:10.0f}")
+
+
+async def amain(args) -> int:
+    catalog = synthetic_catalog(args.products)
+    messages = corpus(catalog)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        repo = await build_repo(catalog)
+        print(f"catalog: {len(catalog)} products, {sum(len(a) for _, a in catalog)} aliases, "
+              f"loaded in {time.perf_counter() - t0:.2f}s")
+        try:
+            if args.update_golden or args.check:
+                if await check_baseline(repo, messages):
+                    return 1
+                if args.check:
+                    return await check_golden(repo, messages)
+                records = await golden_records(repo, messages)
+                with GOLDEN.open("w", encoding="utf-8") as f:
+                    for r in records:
+                        f.write(json.dumps(r, ensure_ascii=False) + "\n")
+                print(f"golden: wrote {len(records)} records to {GOLDEN}")
+                return 0
+            await run_bench(repo, messages, args.repeat)
+            return 0
+        finally:
+            repo.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="python -m bench")
+    ap.add_argument("--check", action="store_true", help="сверить вывод с golden.jsonl")
+    ap.add_argument("--update-golden", action="store_true", help="перезаписать golden.jsonl")
+    ap.add_argument("--products", type=int, default=PRODUCTS, help="размер синтетического каталога")
+    ap.add_argument("--repeat", type=int, default=5, help="повторов на замер (берётся лучший)")
+    sys.exit(asyncio.run(amain(ap.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench/corpus.py — корпус сообщений из рабочих чатов и синтетический каталог
+import random
+from typing import List, Tuple
+
+SEED = 20240601
+
+# Реальные по форме сообщения: продажи, приходы, стоки и болтовня, которую бот должен пропускать.
+MESSAGES: List[str] = [
+    # продажи
+    "продал Reno 11F 5G 8/256 — 1",
+    "Продажа: A38 4/128 x2",
+    "A3x 4/64 2 шт",
+    "Reno 12 F 8/256 149 990 тг - 1",
+    "продал A60 8/256 89 990тг x1",
+    "Galaxy A15 128 — 3",
+    "Redmi Note 13 Pro 8/256 — 2\nA38 4/128 — 1\nA18 4/128 х3",
+    "Продал:\nReno 11F 8/256 - 1\nA58 6/128 - 2\nA79 5G 8/256 - 1",
+    "A38 128 шт 3; A18 64 шт 1; Reno 11 256 шт 1",
+    "прод. Find X7 Ultra 12/512 — 1",
+    "sale A58 6/128 2",
+    "Reno11 F 5G 256гб - 1",
+    "A98 5G 8/256 1шт.",
+    "iPhone 15 Pro Max 1TB — 1",
+    "Reno 12 Pro 12/512 219 990 тенге — 1",
+    "A3 Pro 8/256 ×2",
+    "А38 4/128 — 2",
+    "Reno 10 Pro+ 12/256 - 1",
+    "A17k 3/64 - 4",
+    "продажа A2 Pro 8/256 199990₸ 1",
+    "Reno 8T 8/128 — 1\nA57s 4/128 — 2\nA77 4/128 — 1\nA96 6/128 — 1",
+    "Сегодня продал Reno 11F 256 — 2",
+    "Find N3 Flip 12/256 — 1 (в кредит)",
+    "A38 4/128 2",
+    "A5 Pro 5G 8/256 99 999 KZT — 1",
+    "Reno 12F 5G 8 / 256 - 1",
+    "А79 5G 8/256 сатылды 1",
+    "A60 8/256 — 2 дана",
+    # приходы
+    "приход Reno 12 F 8/256 — 5",
+    "Получили A38 4/128 — 10\nПолучили A18 4/128 — 6",
+    "привезли A3x 4/64 x12",
+    "поступил Find X7 12/256 - 2",
+    "Приход:\nприход A60 8/256 - 4\nприход A79 5G 8/256 - 3",
+    # стоки
+    "сток:\nReno 11F 5G 8/256 — 3\nA38 4/128 — 7\nGalaxy A15 — 5\nA18 4/128 — 0",
+    "Сток:\nA3x 4/64 - 12\nA60 8/256 - 4\nReno 12 F 8/256 - 2\nReno 12 Pro 12/512 - 1\nFind X7 12/256 - 0\nA79 5G 8/256 - 6",
+    "остаток:\nA38 128 — 9\nA58 128 — 2\nA98 256 — 1",
+    "новый сток:\nReno 12F 256 — 4\nA3 Pro 256 — 5\nA5 Pro 256 — 3\nA17k 64 — 8\nA2 Pro 256 — 2",
+    # болтовня и служебное
+    "Доброе утро, коллеги!",
+    "Всем привет, сегодня акция на A38",
+    "Доля OPPO в магазине 35%",
+    "доля рынка: Reno 11F 8/256 - 3",
+    "ок",
+    "👍",
+    "Сколько стоит A60 8/256?",
+    "Кто сегодня на смене?",
+    "План на месяц 120",
+    "Қайырлы таң! Бүгін 3 клиент болды",
+    "Сәлем, A38 бар ма?",
+    "Завтра привезут Reno 12",
+]
+
+_SERIES = ("Reno", "A", "Find X", "Find N", "K", "F", "Galaxy A", "Galaxy S", "Redmi Note", "Redmi",
+           "Poco X", "Poco M", "iPhone", "Realme C", "Realme GT", "Narzo", "Honor X", "Honor Magic",
+           "Tecno Spark", "Tecno Camon", "Infinix Hot", "Infinix Note", "Vivo Y", "Vivo V")
+_SUFFIXES = ("", " Pro", " Pro+", " 5G", "F", " F", "s", "k", "x", " Lite", " Ultra", " Plus", " Neo")
+_MEMS = ("4/64", "4/128", "6/128", "8/128", "8/256", "12/256", "12/512", "128", "256", "256гб", "1TB", "")
+_QTYS = ("— 1", "- 2", "x2", "х3", "×2", "1 шт", "2шт.", "3", ": 4", "— 10")
+_PRICES = ("", "", "", "129 990 тг", "89990тг", "45 000 тенге", "120000₸", "99 999 KZT")
+_PREFIXES = ("", "", "продал ", "Продажа: ", "прод. ", "sale ")
+
+
+def synthetic_catalog(n_products: int = 3000, seed: int = SEED) -> List[Tuple[str, List[str]]]:
+    """[(каноническое имя, [алиасы])] — порядка n_products товаров и столько же алиасов."""
+    rnd = random.Random(seed)
+    out: List[Tuple[str, List[str]]] = []
+    seen = set()
+    while len(out) < n_products:
+        name = f"{rnd.choice(_SERIES)} {rnd.randint(1, 99)}{rnd.choice(_SUFFIXES)}".strip()
+        if name in seen:
+            continue
+        seen.add(name)
+        compact = name.replace(" ", "").lower()
+        aliases = [compact] if compact != name.lower() else []
+        if rnd.random() < 0.3:
+            aliases.append(name.lower().replace("reno", "рено").replace("galaxy", "гэлакси"))
+        out.append((name, [a for a in aliases if a != name]))
+    return out
+
+
+def synthetic_messages(catalog: List[Tuple[str, List[str]]], n: int = 200, seed: int = SEED) -> List[str]:
+    """Сообщения из случайных строк продаж/прихода/стока по товарам каталога."""
+    rnd = random.Random(seed + 1)
+    names = [name for name, _ in catalog]
+
+    def line() -> str:
+        parts = [rnd.choice(_PREFIXES) + rnd.choice(names), rnd.choice(_MEMS), rnd.choice(_PRICES), rnd.choice(_QTYS)]
+        return " ".join(p for p in parts if p)
+
+    out: List[str] = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.6:
+            out.append("\n".join(line() for _ in range(rnd.randint(1, 5))))
+        elif r < 0.7:
+            out.append("\n".join("приход " + line() for _ in range(rnd.randint(1, 3))))
+        elif r < 0.8:
+            out.append("сток:\n" + "\n".join(line() for _ in range(rnd.randint(30, 80))))
+        else:
+            out.append(rnd.choice(("Доброе утро!", "ок", "Кто на смене?", "Доля 30%", "Сколько A38 осталось?")))
+    return out
+
+
+def corpus(catalog: List[Tuple[str, List[str]]]) -> List[str]:
+    return MESSAGES + synthetic_messages(catalog)
@@ -0,0 +1,148 @@
+# bench/parity.py — сверка db_pg.PgRepo с db.Repo на одном сценарии
+#
+#   PG_TEST_URL=postgresql://postgres@localhost/postgres python -m bench.parity
+#   python -m pytest -q tests/test_parity.py   # то же как тест; пропуск — только если Postgres недоступен
+#
+# Оба бэкенда начинают с пустой базы (SQLite — временный файл, Postgres — временная схема),
+# получают одинаковое наполнение и все вызовы из bench.plans (CALLS + EXTRA_CALLS), плюс
+# полные выгрузки. Результаты сравниваются после нормализации порядка: на равных ключах
+# сортировки бэкенды не обязаны совпадать. Код выхода 1 при расхождении.
+import asyncio
+import contextlib
+import os
+import sys
+import tempfile
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, List
+
+import db
+from bench.plans import CALLS, EXTRA_CALLS, NET, TODAY, _populate
+
+DEFAULT_URL = "postgresql://postgres@localhost/postgres"  # если PG_TEST_URL не задан
+
+# результат, где важен порядок элементов
+ORDERED = {"insert_sales_batch"}
+# [(product_id, имя)]: сравниваем группы имён по товару, а не сами id — SQLite AUTOINCREMENT
+# тратит id и на INSERT ... ON CONFLICT DO NOTHING, Postgres (поиск до вставки) — нет
+BY_PRODUCT = {"get_product_candidates_with_aliases", "get_network_stock_candidates"}
+# счётчики версий: сколько раз они растут за транзакцию, у бэкендов разное — сверяем, что выросли
+COUNTERS = {"cache_versions"}
+
+
+def _norm(v: Any, ordered: bool = False) -> Any:
+    if isinstance(v, db.StockDiff):
+        return (sorted(v.added), sorted(v.changed), sorted(v.removed), v.unchanged)
+    if isinstance(v, dict):
+        return {k: _norm(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        items = [_norm(x) for x in v]
+        return items if ordered or isinstance(v, tuple) else sorted(items, key=repr)
+    return v
+
+
+async def _nested_tx(repo, state):
+    # внешний tx() с вложенными: ошибка во вложенном откатывает только его записи
+    async with repo.tx():
+        async with repo.tx():
+            await repo.set_poll_offset(2001)
+        with contextlib.suppress(RuntimeError):
+            async with repo.tx():
+                await repo.acquire_lease("nested", "replica-a", 60)
+                raise RuntimeError
+        taken = await repo.acquire_lease("nested", "replica-b", 60)
+    return taken, await repo.get_poll_offset()
+
+
+# ветки, которые сценарий bench.plans не задевает
+PARITY_CALLS = [
+    ("insert_sales_batch", lambda r, s: r.insert_sales_batch(datetime(2024, 5, 15, 13), TODAY, "1001", NET,
+                                                             [(s["pid"], 256, 1), (s["pid"], 256, 2), (s["pid"], 64, 1)], 3)),
+    ("prompt_needed_today", lambda r, s: r.prompt_needed_today(NET, kind="x")),
+    ("prompt_needed_today", lambda r, s: r.prompt_needed_today(NET, kind="x")),
+    ("acquire_lease", lambda r, s: r.acquire_lease("scheduler", "replica-a", 60)),
+    ("acquire_lease", lambda r, s: r.acquire_lease("scheduler", "replica-b", 60)),
+    ("acquire_lease", lambda r, s: r.acquire_lease("scheduler", "replica-a", 60)),
+    ("acquire_lease", lambda r, s: r.acquire_lease("other", "replica-b", -1)),
+    ("acquire_lease", lambda r, s: r.acquire_lease("other", "replica-a", 60)),
+    ("import_catalog", lambda r, s: r.import_catalog([("Dup", ["d1", "d2"]), ("Dup", ["d2"]), ("Dup2", ["d1"])])),
+    ("add_stock", lambda r, s: r.add_stock(NET, s["pid"], 512, 7, kind="shipment", day=TODAY)),
+    ("checkpoint_stock", lambda r, s: r.checkpoint_stock(date.today())),
+    ("replace_stock_snapshot", lambda r, s: r.replace_stock_snapshot(NET, [(s["pid"], 512, 2), (s["pid"], 512, 1)], day=TODAY)),
+    ("get_stock_table", lambda r, s: r.get_stock_table(NET, as_of=date.today())),
+    ("get_stock_table", lambda r, s: r.get_stock_table(NET, as_of=TODAY - timedelta(days=1))),
+    ("get_stale_people_by_network", lambda r, s: r.get_stale_people_by_network(days=10, per_network={"net3": 1})),
+    ("get_sales_by_network_month", lambda r, s: r.get_sales_by_network_month(TODAY.year, TODAY.month, None)),
+    ("tx", _nested_tx),
+]
+
+
+def _by_product(rows) -> List[Any]:
+    groups = {}
+    for pid, name in rows:
+        groups.setdefault(pid, []).append(name)
+    return sorted(sorted(names) for names in groups.values())
+
+
+async def _exports(repo) -> List[Any]:
+    out = []
+    for kind in ("sales", "shipments"):
+        for net in (None, NET):
+            rows = [r async for batch in repo.iter_export(kind, TODAY - timedelta(days=60), TODAY, net, batch=7)
+                    for r in batch]
+            out.append((kind, net, rows[0], sorted(rows[1:], key=repr)))
+    return out
+
+
+async def _scenario(repo) -> List[Any]:
+    state = await _populate(repo)
+    results = []
+    for method, call in CALLS + EXTRA_CALLS + PARITY_CALLS:
+        res = await call(repo, state)
+        if method in COUNTERS:
+            res = tuple(v > 0 for v in res)
+        results.append((method, _by_product(res) if method in BY_PRODUCT else _norm(res, method in ORDERED)))
+    results.append(("iter_export", await _exports(repo)))
+    return results
+
+
+async def check(url: str) -> int:
+    import asyncpg
+    from db_pg import PgRepo, asyncpg_dsn
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "parity.db")
+        lite = db.Repo()
+        try:
+            expected = await _scenario(lite)
+        finally:
+            lite.close()
+
+    schema = f"parity_{uuid.uuid4().hex[:8]}"
+    admin = await asyncpg.connect(asyncpg_dsn(url))
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    try:
+        pg = await PgRepo.connect(url, min_size=1, max_size=4, server_settings={"search_path": schema})
+        try:
+            got = await _scenario(pg)
+        finally:
+            await pg.close()
+    finally:
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+    failures = 0
+    for (method, want), (_, have) in zip(expected, got):
+        if want != have:
+            failures += 1
+            print(f"FAIL {method}:\n  sqlite:   {want!r}\n  postgres: {have!r}")
+    print(f"parity: {len(expected)} calls compared, {failures} mismatches")
+    return 1 if failures else 0
+
+
+def main():
+    sys.exit(asyncio.run(check(os.getenv("PG_TEST_URL", DEFAULT_URL))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# bench/plans.py — регрессия планов запросов Repo (EXPLAIN QUERY PLAN)
+#
+#   python -m bench.plans      # код выхода 1, если горячий запрос ушёл в полный скан или temp B-tree
+#   python -m bench.plans -v   # заодно напечатать все запросы и их планы
+#
+# Вызывает каждый публичный метод Repo на заполненной временной базе, перехватывает
+# фактически выполненный SQL (trace callback отдаёт его с подставленными значениями)
+# и прогоняет через EXPLAIN QUERY PLAN. Новый метод Repo без записи в CALLS — тоже ошибка.
+import argparse
+import asyncio
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import db
+
+NET = "Plan"
+TODAY = date(2024, 5, 15)
+
+# Что методу разрешено читать целиком (имя таблицы или алиас, как в плане):
+# загрузка каталога в кэш кандидатов, обслуживание и перебор справочника сетей в отчётах.
+ALLOWED_SCANS: Dict[str, Set[str]] = {
+    "get_product_candidates_with_aliases": {"products", "aliases"},
+    "rebuild_sales_daily": {"sales"},
+    "checkpoint_stock": {"networks"},
+    "get_sales_by_network_day": {"n"},
+    "get_sales_by_network_week": {"n"},
+    "get_sales_by_network_month": {"n"},
+    # t — json_each с порогами по сетям: несколько записей из конфига
+    "get_stale_people_by_network": {"t"},
+    # прогрев кэшей после старта — намеренно всё подряд (до IDENTITY_CACHE_SIZE)
+    "warm_caches": {"p", "networks"},
+}
+
+SCAN_RE = re.compile(r"^SCAN (\w+)")
+SKIP_RE = re.compile(r"^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA)\b", re.IGNORECASE)
+
+# (метод, вызов) — порядок важен: сначала наполняем, потом читаем и чистим
+CALLS: List[Tuple[str, Callable[[db.Repo, Dict[str, Any]], Any]]] = [
+    ("ensure_network", lambda r, s: r.ensure_network(NET, "Павлодар", "ул. Ленина 1")),
+    ("get_person_by_tg", lambda r, s: r.get_person_by_tg(1001)),
+    ("bind_by_tgid", lambda r, s: r.bind_by_tgid(1001, NET)),
+    ("bind_by_username", lambda r, s: r.bind_by_username("@seller", NET)),
+    ("import_bindings", lambda r, s: r.import_bindings([("1002", NET), ("@seller2", NET)])),
+    ("warm_caches", lambda r, s: r.warm_caches()),
+    ("ensure_product", lambda r, s: r.ensure_product("Reno 11F 5G", "reno11f")),
+    ("import_catalog", lambda r, s: r.import_catalog([("Reno 12 F", ["reno12f"]), ("A38", [])])),
+    ("add_stock", lambda r, s: r.add_stock(NET, s["pid"], 256, 3, day=TODAY)),
+    ("insert_sale", lambda r, s: r.insert_sale(datetime(2024, 5, 15, 12), TODAY, "1001", NET, s["pid"], 256, 1, 1)),
+    ("insert_sales_batch", lambda r, s: r.insert_sales_batch(datetime(2024, 5, 15, 12), TODAY, "1001", NET,
+                                                             [(s["pid"], 256, 1), (s["pid"], 128, 1)], 2)),
+    ("insert_shipment", lambda r, s: r.insert_shipment(datetime(2024, 5, 15, 12), TODAY, NET, s["pid"], 256, 5)),
+    ("touch_last_sale", lambda r, s: r.touch_last_sale("1001")),
+    ("get_network_by_username", lambda r, s: r.get_network_by_username("seller")),
+    ("get_primary_network_for_person", lambda r, s: r.get_primary_network_for_person("1001")),
+    ("get_network", lambda r, s: r.get_network(NET)),
+    ("get_product_candidates_with_aliases", lambda r, s: r.get_product_candidates_with_aliases()),
+    ("get_network_stock_candidates", lambda r, s: r.get_network_stock_candidates(NET)),
+    ("get_stock_table", lambda r, s: r.get_stock_table(NET)),
+    ("checkpoint_stock", lambda r, s: r.checkpoint_stock(TODAY - timedelta(days=1))),
+    ("get_sales_by_network_day", lambda r, s: r.get_sales_by_network_day(TODAY, None)),
+    ("get_sales_by_network_week", lambda r, s: r.get_sales_by_network_week(TODAY, None)),
+    ("get_sales_by_network_month", lambda r, s: r.get_sales_by_network_month(TODAY.year, TODAY.month, None)),
+    ("set_plan", lambda r, s: r.set_plan(NET, TODAY.year, TODAY.month, 100)),
+    ("get_stale_people_by_network", lambda r, s: r.get_stale_people_by_network(days=4, per_network={NET: 2})),
+    ("prompt_needed_today", lambda r, s: r.prompt_needed_today(NET)),
+    ("acquire_lease", lambda r, s: r.acquire_lease("scheduler", "replica-a", 60)),
+    ("release_lease", lambda r, s: r.release_lease("scheduler", "replica-a")),
+    ("set_poll_offset", lambda r, s: r.set_poll_offset(1001)),
+    ("get_poll_offset", lambda r, s: r.get_poll_offset()),
+    ("mark_and_check_update", lambda r, s: r.mark_and_check_update(777)),
+    ("flush_dedup", lambda r, s: r.flush_dedup()),
+    ("prune_processed_updates", lambda r, s: r.prune_processed_updates()),
+    ("replace_stock_snapshot", lambda r, s: r.replace_stock_snapshot(NET, [(s["pid"], 256, 4)], day=TODAY)),
+    ("set_network_initialized", lambda r, s: r.set_network_initialized(NET, True)),
+    ("clear_prompt_flags", lambda r, s: r.clear_prompt_flags(NET)),
+    ("rebuild_sales_daily", lambda r, s: r.rebuild_sales_daily()),
+    ("cache_versions", lambda r, s: r.cache_versions()),
+]
+
+# отчёты по одной сети — отдельная ветка запроса, проверяем и её
+EXTRA_CALLS: List[Tuple[str, Callable[[db.Repo, Dict[str, Any]], Any]]] = [
+    ("get_sales_by_network_day", lambda r, s: r.get_sales_by_network_day(TODAY, NET)),
+    ("get_stock_table", lambda r, s: r.get_stock_table(NET, as_of=TODAY)),
+    ("iter_export", lambda r, s: _drain(r.iter_export("sales", TODAY - timedelta(days=30), TODAY))),
+    ("iter_export", lambda r, s: _drain(r.iter_export("sales", TODAY - timedelta(days=30), TODAY, NET))),
+    ("iter_export", lambda r, s: _drain(r.iter_export("shipments", TODAY - timedelta(days=30), TODAY))),
+    ("iter_export", lambda r, s: _drain(r.iter_export("shipments", TODAY - timedelta(days=30), TODAY, NET))),
+    ("get_sales_by_network_week", lambda r, s: r.get_sales_by_network_week(TODAY, NET)),
+    ("get_sales_by_network_month", lambda r, s: r.get_sales_by_network_month(TODAY.year, TODAY.month, NET)),
+]
+
+
+async def _drain(it) -> int:
+    return sum([len(rows) async for rows in it])
+
+
+async def _populate(repo: db.Repo) -> Dict[str, Any]:
+    """Немного данных, чтобы таблицы и индексы не были пустыми."""
+    async with repo.tx():
+        for i in range(20):
+            await repo.ensure_network(f"net{i}")
+        pids = [await repo.ensure_product(f"Model {i}", f"model{i}") for i in range(200)]
+        for i, pid in enumerate(pids[:60]):
+            await repo.add_stock(f"net{i % 20}", pid, 128, 2, day=TODAY)
+        for i in range(300):
+            person = str(5000 + i % 40)
+            await repo.get_person_by_tg(int(person))
+            await repo.bind_by_tgid(int(person), f"net{i % 20}")
+            day = TODAY - timedelta(days=i % 40)
+            await repo.insert_sale(datetime.combine(day, datetime.min.time()), day, person,
+                                   f"net{i % 20}", pids[i % 60], 128, 1, 10_000 + i)
+    return {"pid": await repo.ensure_product("Reno 11F 5G")}
+
+
+def _violations(method: str, plan: List[str]) -> List[str]:
+    bad = []
+    allowed = ALLOWED_SCANS.get(method, set())
+    for detail in plan:
+        if "USE TEMP B-TREE" in detail:
+            bad.append(detail)
+        m = SCAN_RE.match(detail)
+        if m and m.group(1) != "CONSTANT" and m.group(1) not in allowed:
+            bad.append(detail)
+    return bad
+
+
+async def check(verbose: bool = False) -> int:
+    public = {name for name, fn in inspect.getmembers(db.Repo, inspect.iscoroutinefunction) if not name.startswith("_")}
+    missing = public - {name for name, _ in CALLS}
+    if missing:
+        print("нет в bench/plans.py CALLS:", ", ".join(sorted(missing)))
+        return 1
+
+    captured: List[str] = []
+    orig_conn = db._conn
+
+    def traced_conn(*a, **kw):
+        conn = orig_conn(*a, **kw)
+        conn.set_trace_callback(captured.append)
+        return conn
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "plans.db")
+        repo = db.Repo()
+        state = await _populate(repo)
+        repo.close()
+
+        db._conn = traced_conn
+        repo = db.Repo()
+        captured.clear()  # схема и миграции — не горячий путь
+        explain = sqlite3.connect(db.DB_PATH)
+        failures = 0
+        try:
+            for method, call in CALLS + EXTRA_CALLS:
+                captured.clear()
+                await call(repo, state)
+                for sql in [q for q in captured if not SKIP_RE.match(q)]:
+                    plan = [row[3] for row in explain.execute("EXPLAIN QUERY PLAN " + sql)]
+                    bad = _violations(method, plan)
+                    failures += bool(bad)
+                    if verbose or bad:
+                        print(f"{'FAIL' if bad else 'ok  '} {method}: {' '.join(sql.split())[:150]}")
+                        for detail in plan:
+                            print(f"       {'!! ' if detail in bad else ''}{detail}")
+        finally:
+            explain.close()
+            repo.close()
+            db._conn = orig_conn
+    print(f"plans: {len(CALLS) + len(EXTRA_CALLS)} calls checked, {failures} violations")
+    return 1 if failures else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="python -m bench.plans")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    sys.exit(asyncio.run(check(ap.parse_args().verbose)))
+
+
+if __name__ == "__main__":
+    main()
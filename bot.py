@@ -1,15 +1,33 @@
 # -*- coding: utf-8 -*-
 """
-Production bot.py (aiogram v3.7+, webhook, keep-alive, APScheduler)
+Production bot.py (aiogram v3.7+, webhook/long polling, keep-alive, APScheduler)
 """
 
 import os
+
+import coldstart
+if __name__ == "__main__" and os.getenv("FAST_START", "1") == "1":
+    # порт открыт и отвечает на health, пока грузятся aiogram и остальное (см. coldstart.py)
+    coldstart.hold_port(int(os.getenv("PORT", "10000")))
+
 import re
+import io
+import time
+import csv
+import hmac
+import html
+import zlib
+import codecs
+import contextlib
+import socket
 import asyncio
 import logging
 import calendar
+from collections import OrderedDict
 from datetime import datetime, date, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from urllib.parse import quote
 
 from pytz import timezone
 from aiohttp import web
@@ -17,19 +35,19 @@ from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.types import Message
+from aiogram.types import Message, Update
 from aiogram.filters import Command
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram import BaseMiddleware
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-try:
-    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-    HAS_SQLA = True
-except Exception:
-    HAS_SQLA = False
-
 import db  # см. db.Repo из твоего db.py
+from outbox import Outbox, PRIO_REPLY, PRIO_NOTICE, PRIO_DIGEST
+from updates import UpdatePipeline, UpdatePoller
+import metrics
+from metrics import HANDLER_SECONDS, FUZZY_SECONDS, FUZZY_MATCHES, JOB_SECONDS, JOB_FAILURES, timed
+import tracing
+from tracing import SamplingProfiler, span
+
+coldstart.mark("imports")
 
 # =============================================================================
 # Конфиг
@@ -40,17 +58,57 @@ RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", "").rstrip("/")
 PORT = int(os.getenv("PORT", "10000"))
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "wh_default_0")
 CRON_KEY = os.getenv("CRON_KEY", "cron_default_0")
+EXPORT_KEY = os.getenv("EXPORT_KEY", "")  # ключ для /export/*; без него (или с ключом по умолчанию) выгрузки нет
+METRICS_KEY = os.getenv("METRICS_KEY", "")  # если задан — /metrics только с ?key=
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))  # >0 — трассировать этапы, апдейты дольше — в лог slow
+PROFILE_WINDOW_SEC = float(os.getenv("PROFILE_WINDOW_SEC", "0"))  # >0 — сэмплирующий профайлер, сводка раз в окно
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
 
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))
 ADMIN_TG_ID = int(os.getenv("ADMIN_TG_ID", "0"))
 TZ = timezone(os.getenv("TZ", "Asia/Almaty"))
 
-DATABASE_URL = os.getenv("DATABASE_URL", "")  # если укажешь Postgres — jobstore будет персистентным
+DATABASE_URL = os.getenv("DATABASE_URL", "")  # Postgres для STORAGE=postgres, если PG_DSN не задан
+STORAGE = os.getenv("STORAGE", "sqlite")  # sqlite | postgres — где лежат данные бота (db.Repo / db_pg.PgRepo)
+PG_DSN = os.getenv("PG_DSN", "") or DATABASE_URL
+# несколько реплик: задачи по расписанию, keepalive и установку вебхука делает держатель аренды в БД
+INSTANCE_ID = os.getenv("INSTANCE_ID") or os.getenv("RENDER_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL_SEC = float(os.getenv("LEASE_TTL_SEC", "60"))
 
 KEEPALIVE_ENABLED = os.getenv("KEEPALIVE_ENABLED", "1") == "1"
 KEEPALIVE_PATH = os.getenv("KEEPALIVE_PATH", "/")
 KEEPALIVE_INTERVAL_MIN = int(os.getenv("KEEPALIVE_INTERVAL_MIN", "4"))
 
+DEDUP_FLUSH_SEC = int(os.getenv("DEDUP_FLUSH_SEC", "30"))  # как часто окно антидубля пишется в БД
+
+# напоминание «нет продаж»: порог в днях и свои пороги сетей ("Сеть A:7,Сеть B:3")
+STALE_DAYS = int(os.getenv("STALE_DAYS", "4"))
+STALE_DAYS_BY_NETWORK = {
+    net.strip(): int(days)
+    for net, _, days in (item.rpartition(":") for item in os.getenv("STALE_DAYS_BY_NETWORK", "").split(","))
+    if net.strip() and days.strip().isdigit()
+}
+
+# исходящие: общий лимит бота и лимит на группу (Telegram: ~30/с и ~20/мин)
+SEND_RATE_PER_SEC = float(os.getenv("SEND_RATE_PER_SEC", "30"))
+SEND_GROUP_PER_MIN = float(os.getenv("SEND_GROUP_PER_MIN", "20"))
+
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "500"))  # строк файла на одну транзакцию
+
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))  # готовых текстов /sales и /stocks
+
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "100"))  # апдейтов в очереди одной сети
+UPDATE_LANES = int(os.getenv("UPDATE_LANES", "64"))  # очередей (воркеров) вебхука, ключи делят их хешем
+# webhook — Telegram шлёт апдейты на RENDER_EXTERNAL_URL; polling — сами забираем getUpdates пачками
+UPDATES_MODE = os.getenv("UPDATES_MODE", "webhook" if RENDER_EXTERNAL_URL else "polling")
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))        # апдейтов в пачке (максимум Telegram — 100)
+POLL_TIMEOUT_SEC = int(os.getenv("POLL_TIMEOUT_SEC", "25"))
+# накопившиеся за простой апдейты по умолчанию разбираем, а не выбрасываем
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+ALLOWED_UPDATES = ["message", "edited_message"]
+
+FUZZY_WORKERS = int(os.getenv("FUZZY_WORKERS", "-1"))  # потоки rapidfuzz.cdist, -1 — все ядра
+
 SILENT_UNBOUND = os.getenv("SILENT_UNBOUND", "1") == "1"
 STRICT_STOCK_PROMPT = True
 RECOVERY_MODE = os.getenv("RECOVERY_MODE", "0") == "1"
@@ -61,6 +119,7 @@ RECOVERY_MODE = os.getenv("RECOVERY_MODE", "0") == "1"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("bot")
+slow_log = logging.getLogger("slow")
 
 # =============================================================================
 # Помощники и парсинг
@@ -72,78 +131,209 @@ SALE_MARKERS = ("продал", "продажа", "прод.", "sale", "шт", "
 STOCK_INC_MARKERS = ("приход", "поступил", "получили", "привезли")
 STOCK_SNAPSHOT_PREFIXES = ("сток:", "остаток:", "новый сток:")
 
-SPACE_RE = re.compile(r"\s+")
 PRICE_RE = re.compile(r"(\d[\d\s]{3,})\s*(?:тг|тенге|₸|kzt)", re.IGNORECASE)
 RAM_ROM_RE = re.compile(r"\b(\d{1,2})\s*/\s*(\d{2,4})\b")
 GB_SUFFIX_RE = re.compile(r"\b(gb|гб)\b", re.IGNORECASE)
 
+# всё ниже применяется к уже нормализованной строке (_norm)
+QTY_TAIL_RE = re.compile(r'(?:[-—:]\s*(\d+)\s*$)|(?:x\s*(\d+)\s*$)|(?:\b(\d+)\s*шт\.?\s*$)|(?:\s(\d+)\s*$)')
+MEM_TOKEN_RE = re.compile(r'\b(64|128|256|512|1024)\b')
+MEM_SIZES = {"64", "128", "256", "512", "1024"}
+TB_TOKENS = ("1тб", "1tb", "1 tb", "1 тб")
+CURRENCY_TOKENS = ("тг", "тенге", "₸", "kzt")
+TAIL_DASH_QTY_RE = re.compile(r'[-—:]\s*\d+\s*$')
+TAIL_X_QTY_RE = re.compile(r'\bx\s*\d+\s*$')
+TAIL_SHT_QTY_RE = re.compile(r'\b\d+\s*шт\.?\s*$')
+NON_MODEL_CHARS_RE = re.compile(r"[^\w\s\-+]")
+G_SUFFIX_RE = re.compile(r'\b(\d+)\s+g\b')
+F_SUFFIX_RE = re.compile(r'\b(\d+)\s+f\b')
+
 def now_local() -> datetime:
     return datetime.now(TZ)
 
 def today_local() -> date:
     return now_local().date()
 
+def parse_day(s: str) -> Optional[date]:
+    # ДД.ММ.ГГГГ, ДД.ММ (текущий год) или ГГГГ-ММ-ДД
+    if s.count(".") == 1:
+        s = f"{s}.{today_local().year}"
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            pass
+    return None
+
 def _norm(s: str) -> str:
     s = s.lower().replace("ё", "е")
     s = s.replace("×", "x").replace("х", "x")
-    s = SPACE_RE.sub(" ", s).strip()
-    return s
+    # split() режет по тем же символам, что и \s+, и заодно делает strip
+    return " ".join(s.split())
 
-def contains_ignored_word(s: str) -> bool:
-    L = _norm(s or "")
-    return any(w in L for w in IGNORE_WHOLE_MSG_IF_CONTAINS)
-
-def _strip_prices(s: str) -> str:
-    return PRICE_RE.sub("", s)
+def _ends_with_digit(s: str) -> bool:
+    return s.rstrip()[-1:].isdigit()
 
-def _extract_qty(s: str) -> Optional[int]:
-    s = _norm(s)
+def _scan_qty(s: str) -> Optional[int]:
+    # все варианты QTY_TAIL_RE заканчиваются числом или «шт»; gb/tb в хвосте вырезаются до поиска
+    if not (_ends_with_digit(s) or s.endswith(("шт", "шт.", "gb", "гб", "tb", "тб"))):
+        return None
     s_wo_gb = GB_SUFFIX_RE.sub("", s)
-    for tb in ("1тб", "1tb", "1 tb", "1 тб"):
+    for tb in TB_TOKENS:
         s_wo_gb = s_wo_gb.replace(tb, "")
-    m = re.search(r'(?:[-—:]\s*(\d+)\s*$)|(?:x\s*(\d+)\s*$)|(?:\b(\d+)\s*шт\.?\s*$)|(?:\s(\d+)\s*$)', s_wo_gb)
+    m = QTY_TAIL_RE.search(s_wo_gb)
     if m:
         for g in m.groups():
             if g:
-                try:
-                    return int(g)
-                except ValueError:
-                    pass
+                return int(g)
     return None
 
-def _extract_mem(s: str) -> Optional[int]:
-    L = _norm(s)
-    if any(tok in L.replace(" ", "") for tok in ("1tb", "1тб")):
+def _scan_mem(s: str) -> Optional[int]:
+    if any(tok in s.replace(" ", "") for tok in ("1tb", "1тб")):
         return 1024
-    m = RAM_ROM_RE.search(L)
-    if m:
-        mem = m.group(2)
-        if mem in {"64", "128", "256", "512", "1024"}:
-            return int(mem)
-    m2 = re.search(r'\b(64|128|256|512|1024)\b', L)
+    if "/" in s:
+        m = RAM_ROM_RE.search(s)
+        if m and m.group(2) in MEM_SIZES:
+            return int(m.group(2))
+    m2 = MEM_TOKEN_RE.search(s)
     if m2:
         return int(m2.group(1))
     return None
 
-def _clean_model_fragment(s: str) -> str:
-    s = _strip_prices(s)
-    s = _norm(s)
-    s = RAM_ROM_RE.sub(" ", s)
-    s = GB_SUFFIX_RE.sub(" ", s)
-    for tb in ("1тб", "1tb", "1 tb", "1 тб"):
-        s = s.replace(tb, " ")
-    s = re.sub(r'\b(64|128|256|512|1024)\b', " ", s)
-    s = re.sub(r'[-—:]\s*\d+\s*$', " ", s)
-    s = re.sub(r'\bx\s*\d+\s*$', " ", s)
-    s = re.sub(r'\b\d+\s*шт\.?\s*$', " ", s)
+def _scan_model(raw: str, s: str) -> str:
+    # цену режем по сырому тексту (как и раньше): нормализация пробелов меняет границы PRICE_RE
+    if any(tok in s for tok in CURRENCY_TOKENS):
+        s = _norm(PRICE_RE.sub("", raw))
+    if "/" in s:
+        s = RAM_ROM_RE.sub(" ", s)
+    if "gb" in s or "гб" in s:
+        s = GB_SUFFIX_RE.sub(" ", s)
+    if "tb" in s or "тб" in s:
+        for tb in TB_TOKENS:
+            s = s.replace(tb, " ")
+    s = MEM_TOKEN_RE.sub(" ", s)
+    # хвостовые количества снимаются по очереди, как в исходной цепочке re.sub
+    if _ends_with_digit(s):
+        s = TAIL_DASH_QTY_RE.sub(" ", s)
+    if _ends_with_digit(s):
+        s = TAIL_X_QTY_RE.sub(" ", s)
+    if s.rstrip().endswith(("шт", "шт.")):
+        s = TAIL_SHT_QTY_RE.sub(" ", s)
     for mk in SALE_MARKERS:
         s = s.replace(mk, " ")
-    s = re.sub(r"[^\w\s\-+]", " ", s)
-    s = SPACE_RE.sub(" ", s).strip()
-    s = re.sub(r'\b(\d+)\s+g\b', r'\1g', s)
-    s = re.sub(r'\b(\d+)\s+f\b', r'\1f', s)
+    s = " ".join(NON_MODEL_CHARS_RE.sub(" ", s).split())
+    if " g" in s:
+        s = G_SUFFIX_RE.sub(r'\1g', s)
+    if " f" in s:
+        s = F_SUFFIX_RE.sub(r'\1f', s)
     return s
 
+_UNSET = object()
+
+class TextScan:
+    """Разбор строки или целого сообщения за один проход нормализации.
+
+    Текст нормализуется один раз в конструкторе; qty, память, модель и класс
+    считаются лениво поверх нормализованной строки и кэшируются, так что
+    classify_message и обработчики используют один и тот же результат.
+    """
+
+    __slots__ = ("raw", "lower", "text", "_qty", "_mem", "_model", "_kind", "_lines")
+
+    def __init__(self, raw: Optional[str]):
+        self.raw = raw or ""
+        self.lower = self.raw.strip().lower()
+        self.text = _norm(self.lower)
+        self._qty = self._mem = self._model = self._kind = self._lines = _UNSET
+
+    @property
+    def qty(self) -> Optional[int]:
+        if self._qty is _UNSET:
+            self._qty = _scan_qty(self.text)
+        return self._qty
+
+    @property
+    def mem(self) -> Optional[int]:
+        if self._mem is _UNSET:
+            self._mem = _scan_mem(self.text)
+        return self._mem
+
+    @property
+    def model(self) -> str:
+        if self._model is _UNSET:
+            self._model = _scan_model(self.raw, self.text)
+        return self._model
+
+    @property
+    def ignored(self) -> bool:
+        return any(w in self.text for w in IGNORE_WHOLE_MSG_IF_CONTAINS)
+
+    @property
+    def looks_like_sale(self) -> bool:
+        return self.qty is not None and (any(mk in self.text for mk in SALE_MARKERS) or self.mem is not None)
+
+    @property
+    def kind(self) -> str:
+        if self._kind is _UNSET:
+            self._kind = self._classify()
+        return self._kind
+
+    def _classify(self) -> str:
+        if self.ignored:
+            return "ignore"
+        if self.lower.startswith(STOCK_SNAPSHOT_PREFIXES):
+            return "stock_snapshot"
+        if any(k in self.lower for k in STOCK_INC_MARKERS) and self.qty is not None:
+            return "stock_inc"
+        if self.looks_like_sale:
+            return "sale"
+        return "ignore"
+
+    @property
+    def lines(self) -> List["TextScan"]:
+        """Все строки сообщения (включая пустые — индексы совпадают с splitlines())."""
+        if self._lines is _UNSET:
+            self._lines = [TextScan(l) for l in self.raw.splitlines()]
+        return self._lines
+
+    def sale_item(self) -> Optional[Dict[str, Any]]:
+        if not self.text or self.ignored or not self.looks_like_sale:
+            return None
+        model_raw = self.model
+        if not model_raw or len(model_raw) < 2:
+            return None
+        return {"model_raw": model_raw, "mem_gb": self.mem, "qty": self.qty or 1}
+
+    def sale_items(self) -> List[Dict[str, Any]]:
+        if not self.raw or self.ignored:
+            return []
+        out: List[Dict[str, Any]] = []
+        for raw in self.raw.splitlines():
+            raw = raw.strip()
+            if not raw:
+                continue
+            if ';' in raw and len(raw) > 10:
+                parts = [p.strip() for p in raw.split(';') if p.strip()]
+            else:
+                parts = [raw]
+            for part in parts:
+                item = TextScan(part).sale_item()
+                if item:
+                    out.append(item)
+        return out
+
+def contains_ignored_word(s: str) -> bool:
+    return TextScan(s).ignored
+
+def _extract_qty(s: str) -> Optional[int]:
+    return _scan_qty(_norm(s))
+
+def _extract_mem(s: str) -> Optional[int]:
+    return _scan_mem(_norm(s))
+
+def _clean_model_fragment(s: str) -> str:
+    return _scan_model(s, _norm(s))
+
 def _has_qty(s: str) -> bool:
     return _extract_qty(s) is not None
 
@@ -151,59 +341,64 @@ def _has_mem_token(s: str) -> bool:
     return _extract_mem(s) is not None
 
 def _looks_like_sale_line(s: str) -> bool:
-    L = _norm(s)
-    return _has_qty(L) and (any(mk in L for mk in SALE_MARKERS) or _has_mem_token(L))
+    return TextScan(s).looks_like_sale
 
 def parse_sale_line(line: str) -> Optional[Dict[str, Any]]:
-    if not line or not line.strip():
-        return None
-    if contains_ignored_word(line):
-        return None
-    if not _looks_like_sale_line(line):
-        return None
-    qty = _extract_qty(line) or 1
-    mem = _extract_mem(line)
-    model_raw = _clean_model_fragment(line)
-    if not model_raw or len(model_raw) < 2:
-        return None
-    return {"model_raw": model_raw, "mem_gb": mem, "qty": qty}
+    return TextScan(line).sale_item()
 
 def parse_sales_message(text: str) -> List[Dict[str, Any]]:
-    if not text or contains_ignored_word(text):
-        return []
-    out: List[Dict[str, Any]] = []
-    raw_lines: List[str] = []
-    for raw in text.splitlines():
-        raw = raw.strip()
-        if not raw:
-            continue
-        if ';' in raw and len(raw) > 10:
-            raw_lines.extend([p.strip() for p in raw.split(';') if p.strip()])
-        else:
-            raw_lines.append(raw)
-    for line in raw_lines:
-        item = parse_sale_line(line)
-        if item:
-            out.append(item)
-    return out
+    return TextScan(text).sale_items()
 
 def classify_message(text: str) -> str:
-    t = (text or "").strip()
-    L = t.lower()
-    if contains_ignored_word(L):
-        return "ignore"
-    if any(L.startswith(p) for p in STOCK_SNAPSHOT_PREFIXES):
-        return "stock_snapshot"
-    if any(k in L for k in STOCK_INC_MARKERS) and _has_qty(L):
-        return "stock_inc"
-    if _looks_like_sale_line(L):
-        return "sale"
-    return "ignore"
+    return TextScan(text).kind
+
+class Prefilter:
+    """Дешёвый отсев до антидубля и БД: пропускает всё, из чего TextScan может извлечь данные.
+
+    Одна регулярка по маркерам из конфига. Данные бывают только у снимка стока
+    (префикс) или у строк с числом (qty), причём числу нужен маркер или память.
+    Отсев строго консервативный: то, что дошло бы до обработчиков, не режется.
+    """
+
+    def __init__(self):
+        def alt(words):
+            return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+        self._re = re.compile(
+            rf"(?P<ignore>{alt(IGNORE_WHOLE_MSG_IF_CONTAINS)})"
+            rf"|(?P<snapshot>^\s*(?:{alt(STOCK_SNAPSHOT_PREFIXES)}))"
+            rf"|(?P<marker>{alt(SALE_MARKERS + STOCK_INC_MARKERS)})"
+            r"|(?P<mem>\d\d|t\s*b|т\s*б)"
+            r"|(?P<digit>\d)"
+        )
+        self.stats = {"admitted": 0, "dropped": 0}
+
+    def could_be_data(self, text: Optional[str]) -> bool:
+        found = set()
+        for m in self._re.finditer((text or "").lower()):
+            kind = m.lastgroup
+            if kind == "ignore":
+                return False
+            found.add(kind)
+        if "snapshot" in found:
+            return True
+        return ("digit" in found or "mem" in found and any(ch.isdigit() for ch in text)) \
+            and ("marker" in found or "mem" in found)
+
+    def admit(self, text: Optional[str]) -> bool:
+        ok = self.could_be_data(text)
+        self.stats["admitted" if ok else "dropped"] += 1
+        return ok
+
+prefilter = Prefilter()
 
 def sanitize_secret(s: str) -> str:
     s = re.sub(r'[^A-Za-z0-9_-]', '', s or '')
     return (s or 'wh_default_0').strip()[:256]
 
+def key_matches(given: str, expected: str) -> bool:
+    # байты, а не str: compare_digest падает с TypeError на не-ASCII строках
+    return hmac.compare_digest(given.encode(), expected.encode())
+
 # =============================================================================
 # Repo middleware
 # =============================================================================
@@ -216,6 +411,35 @@ class RepoMiddleware(BaseMiddleware):
         data["repo"] = self.repo
         return await handler(event, data)
 
+class MetricsMiddleware(BaseMiddleware):
+    # время обработчика (on_text, команды) — в гистограмму по имени функции
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        with HANDLER_SECONDS.time(handler=h.callback.__name__ if h else "unknown"):
+            return await handler(event, data)
+
+class TracingMiddleware(BaseMiddleware):
+    # этапы апдейта (span) копятся в трассе; дольше порога — в лог slow с разбивкой
+    def __init__(self, slow_ms: float):
+        super().__init__()
+        self.slow_sec = slow_ms / 1000.0
+        self.stats = {"traced": 0, "slow": 0}
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        tr, token = tracing.start(h.callback.__name__ if h else "unknown")
+        try:
+            return await handler(event, data)
+        finally:
+            tracing.finish(token)
+            total = time.perf_counter() - tr.t0
+            self.stats["traced"] += 1
+            if total >= self.slow_sec:
+                self.stats["slow"] += 1
+                upd = data.get("event_update")
+                slow_log.warning("slow update %s (%s, chat %s): %.0fms\n%s", upd.update_id if upd else "?",
+                                 tr.name, event.chat.id, total * 1000, tr.breakdown(total))
+
 # =============================================================================
 # Бот/диспетчер/роутер
 # =============================================================================
@@ -228,20 +452,36 @@ dp.include_router(router)
 def is_admin(user_id: int) -> bool:
     return ADMIN_TG_ID and user_id == ADMIN_TG_ID
 
-async def safe_send(chat_id: int, text: str):
-    delay = 0.5
-    for _ in range(5):
-        try:
-            await bot.send_message(chat_id, text)
-            return
-        except Exception as e:
-            s = str(e).lower()
-            if "too many requests" in s or "429" in s:
-                await asyncio.sleep(delay)
-                delay = min(delay * 2, 5.0)
-            else:
-                log.warning("send failed: %s", e)
-                await asyncio.sleep(delay)
+outbox = Outbox(bot, global_rate=SEND_RATE_PER_SEC, group_per_min=SEND_GROUP_PER_MIN)
+
+async def safe_send(chat_id: int, text: str, prio: int = PRIO_NOTICE):
+    # только ставит в очередь: лимиты, 429 и повторы — забота outbox
+    outbox.send(chat_id, text, prio)
+
+async def reply(m: Message, text: str):
+    # вместо m.answer: тот же чат и тема, через очередь с приоритетом ответа
+    thread_id = m.message_thread_id if m.is_topic_message else None
+    outbox.send(m.chat.id, text, PRIO_REPLY, message_thread_id=thread_id)
+
+async def update_route_key(repo: db.Repo, update: Update) -> str:
+    # порядок важен внутри сети (остатки), поэтому очередь — по сети автора
+    msg = update.message or update.edited_message
+    if msg is None or msg.from_user is None:
+        return "default"
+    if not prefilter.could_be_data(msg.text):
+        # команды, привязки и болтовня: сеть для них не нужна, в БД не ходим
+        return f"user:{msg.from_user.id}"
+    network_id = await repo.get_primary_network_for_person(str(msg.from_user.id))
+    return f"net:{network_id}" if network_id else f"user:{msg.from_user.id}"
+
+async def update_seen(repo: db.Repo, update: Update) -> bool:
+    # антидубль до очереди — и для вебхука, и для long polling: повторная доставка не
+    # выполнит второй раз ни продажу, ни команду (/import и т.п.). Болтовню не помечаем:
+    # обработчики её отбросят, а метка стоила бы записи в окно антидубля
+    msg = update.message or update.edited_message
+    if msg is not None and msg.text and not msg.text.startswith("/") and not prefilter.could_be_data(msg.text):
+        return False
+    return await repo.mark_and_check_update(update.update_id)
 
 # =============================================================================
 # Команды (привязки, планы, проверки)
@@ -262,12 +502,12 @@ async def bind_network_self(m: Message, repo: db.Repo):
     if city is None and any(x in (name or "").lower() for x in ("аксу", "экибастуз", "ekibastuz", "aksu")):
         city = "Аксу" if "аксу" in name.lower() else "Экибастуз"
     if RECOVERY_MODE and city and "павлодар" in city.lower() and not address:
-        await m.answer("Для Павлодара укажите адрес: сеть: <название>, Павлодар, <адрес>")
+        await reply(m, "Для Павлодара укажите адрес: сеть: <название>, Павлодар, <адрес>")
         return
     await repo.ensure_network(name=name, city=city, address=address)
     await repo.bind_by_tgid(m.from_user.id, name)
     if not SILENT_UNBOUND:
-        await m.answer(f"Привязал к сети: {name}")
+        await reply(m, f"Привязал к сети: {name}")
 
 @router.message(Command("set_network"))
 async def cmd_set_network(m: Message, repo: db.Repo):
@@ -276,7 +516,7 @@ async def cmd_set_network(m: Message, repo: db.Repo):
     try:
         _, ident, net = m.text.strip().split(maxsplit=2)
     except Exception:
-        await m.answer("Формат: /set_network <@username|tgid> <сеть>")
+        await reply(m, "Формат: /set_network <@username|tgid> <сеть>")
         return
     await repo.ensure_network(name=net)
     if ident.startswith("@"):
@@ -285,9 +525,9 @@ async def cmd_set_network(m: Message, repo: db.Repo):
         try:
             await repo.bind_by_tgid(int(ident), net)
         except Exception:
-            await m.answer("tgid должен быть числом")
+            await reply(m, "tgid должен быть числом")
             return
-    await m.answer(f"🔗 {net} → привязка сохранена")
+    await reply(m, f"🔗 {net} → привязка сохранена")
 
 @router.message(Command("set_netinfo"))
 async def cmd_set_netinfo(m: Message, repo: db.Repo):
@@ -297,7 +537,7 @@ async def cmd_set_netinfo(m: Message, repo: db.Repo):
     try:
         _, rest = text.split(" ", 1)
     except Exception:
-        await m.answer("Формат: /set_netinfo <сеть> city=<город> [address=<адрес>]")
+        await reply(m, "Формат: /set_netinfo <сеть> city=<город> [address=<адрес>]")
         return
     parts = rest.split()
     name = parts[0]
@@ -309,10 +549,10 @@ async def cmd_set_netinfo(m: Message, repo: db.Repo):
     city = kv.get("city")
     address = kv.get("address")
     if RECOVERY_MODE and city and "павлодар" in city.lower() and not address:
-        await m.answer("Для Павлодара нужен address=<адрес>")
+        await reply(m, "Для Павлодара нужен address=<адрес>")
         return
     await repo.ensure_network(name=name, city=city, address=address)
-    await m.answer("OK")
+    await reply(m, "OK")
 
 @router.message(Command("plan"))
 async def cmd_plan(m: Message, repo: db.Repo):
@@ -320,13 +560,13 @@ async def cmd_plan(m: Message, repo: db.Repo):
         return
     parts = m.text.strip().split()
     if len(parts) < 3:
-        await m.answer("Формат: /plan <сеть> <число> [город=...] [адрес=...]")
+        await reply(m, "Формат: /plan <сеть> <число> [город=...] [адрес=...]")
         return
     _, net, qty, *rest = parts
     try:
         qty = int(qty)
     except Exception:
-        await m.answer("Число плана должно быть int")
+        await reply(m, "Число плана должно быть int")
         return
     kv = {}
     for p in rest:
@@ -336,12 +576,12 @@ async def cmd_plan(m: Message, repo: db.Repo):
     city = kv.get("город") or kv.get("city")
     address = kv.get("адрес") or kv.get("address")
     if RECOVERY_MODE and city and "павлодар" in city.lower() and not address:
-        await m.answer("Для Павлодара нужен адрес")
+        await reply(m, "Для Павлодара нужен адрес")
         return
     await repo.ensure_network(name=net, city=city, address=address)
     y, mth = today_local().year, today_local().month
     await repo.set_plan(net, y, mth, qty)
-    await m.answer(f"План для {net} на {mth:02d}.{y}: {qty}")
+    await reply(m, f"План для {net} на {mth:02d}.{y}: {qty}")
 
 @router.message(Command("whoami"))
 async def whoami(m: Message, repo: db.Repo):
@@ -352,7 +592,7 @@ async def whoami(m: Message, repo: db.Repo):
             net = await repo.get_network_by_username(uname)
             if net:
                 await repo.bind_by_tgid(m.from_user.id, net)  # миграция на id
-    await m.answer(
+    await reply(m, 
         "Ваши данные:\n"
         f"• id: <code>{m.from_user.id}</code>\n"
         f"• username: @{uname or '-'}\n"
@@ -365,21 +605,55 @@ async def who(m: Message, repo: db.Repo):
         return
     parts = m.text.strip().split(maxsplit=1)
     if len(parts) < 2:
-        await m.answer("Формат: /who <@username|tgid>")
+        await reply(m, "Формат: /who <@username|tgid>")
         return
     ident = parts[1].strip()
     if ident.startswith("@"):
         uname = ident[1:]
         net = await repo.get_network_by_username(uname) if hasattr(repo, "get_network_by_username") else None
-        await m.answer(f"@{uname} → сеть: {net or '—'}")
+        await reply(m, f"@{uname} → сеть: {net or '—'}")
     else:
         try:
             tgid = int(ident)
         except:
-            await m.answer("tgid должен быть числом")
+            await reply(m, "tgid должен быть числом")
             return
         net = await repo.get_primary_network_for_person(str(tgid))
-        await m.answer(f"id {tgid} → сеть: {net or '—'}")
+        await reply(m, f"id {tgid} → сеть: {net or '—'}")
+
+class ReportCache:
+    """Готовые тексты отчётов по ключу (вид, сеть, период).
+
+    Запись годна, пока data_version из repo.cache_versions() не изменилась: повторный
+    /sales или /stocks без новых продаж и движений стока (с любой реплики) не делает ни
+    SQL отчёта, ни форматирования.
+    """
+
+    def __init__(self, maxsize: int = REPORT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._repo = None
+        self._data: "OrderedDict[Tuple, Tuple[int, str]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    async def get(self, repo: db.Repo, key: Tuple, render) -> str:
+        if self._repo is not repo:
+            self._repo = repo
+            self._data.clear()
+        version = (await repo.cache_versions())[1]  # до запроса: запись во время рендера сделает его устаревшим
+        hit = self._data.get(key)
+        if hit is not None and hit[0] == version:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return hit[1]
+        self.misses += 1
+        text = await render()
+        self._data[key] = (version, text)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return text
+
+report_cache = ReportCache()
 
 @router.message(Command("sales"))
 async def cmd_sales(m: Message, repo: db.Repo):
@@ -395,6 +669,12 @@ async def cmd_sales(m: Message, repo: db.Repo):
                 net = parts[2]
         else:
             net = parts[1]
+    # период задаётся сегодняшней датой (для месяца от неё зависит и проекция)
+    text = await report_cache.get(repo, ("sales", scope, net, today_local()),
+                                  lambda: sales_report_text(repo, scope, net))
+    await reply(m, text)
+
+async def sales_report_text(repo: db.Repo, scope: str, net: Optional[str]) -> str:
     if scope == "day":
         data = await repo.get_sales_by_network_day(today_local(), net)
         title = f"Сегодня {today_local().strftime('%d.%m.%Y')}"
@@ -405,8 +685,7 @@ async def cmd_sales(m: Message, repo: db.Repo):
         data = await repo.get_sales_by_network_month(today_local().year, today_local().month, net)
         title = f"Месяц {today_local().month:02d}.{today_local().year}"
     if not data:
-        await m.answer(f"{title}: продаж нет")
-        return
+        return f"{title}: продаж нет"
     lines = [f"📊 {title}:"]
     for name, qty in data:
         lines.append(f"• {name}: {qty}")
@@ -419,7 +698,7 @@ async def cmd_sales(m: Message, repo: db.Repo):
             pace = qty / max(dom, 1)
             proj = round(pace * days_in_month)
             lines.append(f"• {name}: MTD {qty} → ~{proj} к {days_in_month}.{today_local().month}")
-    await m.answer("\n".join(lines))
+    return "\n".join(lines)
 
 @router.message(Command("stocks"))
 async def cmd_stocks(m: Message, repo: db.Repo):
@@ -427,15 +706,31 @@ async def cmd_stocks(m: Message, repo: db.Repo):
         return
     parts = m.text.strip().split()
     net = parts[1] if len(parts) >= 2 else None
-    rows = await repo.get_stock_table(net)
+    as_of = None
+    if len(parts) >= 3:
+        as_of = parse_day(parts[2])
+        if as_of is None:
+            await reply(m, "Формат: /stocks &lt;сеть&gt; [ДД.ММ.ГГГГ]")
+            return
+    text = await report_cache.get(repo, ("stocks", net, as_of), lambda: stock_report_text(repo, net, as_of))
+    await reply(m, text)
+
+async def stock_report_text(repo: db.Repo, net: Optional[str], as_of: Optional[date]) -> str:
+    rows = await repo.get_stock_table(net, as_of=as_of)
     if not rows:
-        await m.answer("Нужно обновить сток.")
-        return
-    lines = ["📦 Текущий сток:"]
+        return "Нужно обновить сток." if as_of is None else f"На {as_of:%d.%m.%Y} стока нет."
+    lines = ["📦 Текущий сток:" if as_of is None else f"📦 Сток на конец {as_of:%d.%m.%Y}:"]
     for name, mem, qty in rows:
         tail = f" {mem}ГБ" if mem else ""
         lines.append(f"• {name}{tail} — {qty}")
-    await m.answer("\n".join(lines))
+    return "\n".join(lines)
+
+@router.message(Command("rebuild_rollup"))
+async def cmd_rebuild_rollup(m: Message, repo: db.Repo):
+    if not is_admin(m.from_user.id):
+        return
+    n = await repo.rebuild_sales_daily()
+    await reply(m, f"Свод продаж пересобран из sales: {n} строк")
 
 @router.message(Command("ask_stocks"))
 async def cmd_ask_stocks(m: Message):
@@ -444,20 +739,170 @@ async def cmd_ask_stocks(m: Message):
     if GROUP_CHAT_ID:
         await safe_send(GROUP_CHAT_ID,
             "Коллеги, пришлите, пожалуйста, актуальный сток в формате:\n"
-            "сток:\nМодель Память — Количество\nПример:\nReno 11F 5G 128 — 3\nA38 128 — 7\nGalaxy A15 — 5"
+            "сток:\nМодель Память — Количество\nПример:\nReno 11F 5G 128 — 3\nA38 128 — 7\nGalaxy A15 — 5",
+            PRIO_DIGEST,
         )
 
+# =============================================================================
+# Импорт файлов (CSV/TSV): каталог, привязки, сток
+# =============================================================================
+
+IMPORT_USAGE = (
+    "Пришлите CSV/TSV с подписью:\n"
+    "/import catalog — название[, алиас, алиас…]\n"
+    "/import bindings — <tgid|@username>, сеть\n"
+    "/import stock <сеть> — модель[, память], количество"
+)
+IMPORT_HEADERS = {"name", "название", "model", "модель", "ident", "tgid", "username", "network", "сеть"}
+USERNAME_RE = re.compile(r"^@?[A-Za-z0-9_]{3,32}$")
+
+async def _file_lines(file_path: str) -> AsyncIterator[str]:
+    # файл читаем потоком по кускам, не держа его целиком в памяти
+    url = bot.session.api.file_url(bot.token, file_path)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in bot.session.stream_content(url, timeout=120):
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+async def _file_rows(file_path: str) -> AsyncIterator[Tuple[int, List[str]]]:
+    """(номер строки, ячейки); разделитель — по первой строке: таб, «;» или «,»."""
+    delimiter = None
+    lineno = 0
+    async for line in _file_lines(file_path):
+        lineno += 1
+        line = line.rstrip("\r")
+        if not line.strip():
+            continue
+        if delimiter is None:
+            delimiter = "\t" if "\t" in line else (";" if line.count(";") > line.count(",") else ",")
+            if line.split(delimiter)[0].strip().strip('"').lower() in IMPORT_HEADERS:
+                continue  # заголовок
+        yield lineno, [cell.strip() for cell in next(csv.reader([line], delimiter=delimiter))]
+
+async def _import_catalog(repo: db.Repo, rows: List[Tuple[int, List[str]]], errors: List[Tuple[int, str]]) -> int:
+    batch = []
+    for lineno, cells in rows:
+        name = cells[0] if cells else ""
+        if not name:
+            errors.append((lineno, "пустое название"))
+            continue
+        aliases = [a.strip() for cell in cells[1:] for a in cell.split("|") if a.strip() and a.strip() != name]
+        batch.append((name, aliases))
+    return await repo.import_catalog(batch) if batch else 0
+
+async def _import_bindings(repo: db.Repo, rows: List[Tuple[int, List[str]]], errors: List[Tuple[int, str]]) -> int:
+    batch = []
+    for lineno, cells in rows:
+        if len(cells) < 2 or not cells[1]:
+            errors.append((lineno, "нужно два столбца: tgid|@username, сеть"))
+        elif not (cells[0].isdigit() or USERNAME_RE.match(cells[0])):
+            errors.append((lineno, f"не tgid и не username: {cells[0]!r}"))
+        else:
+            batch.append((cells[0], cells[1]))
+    return await repo.import_bindings(batch) if batch else 0
+
+async def _import_stock(repo: db.Repo, network: str, rows: List[Tuple[int, List[str]]],
+                        errors: List[Tuple[int, str]], acc: List[Tuple[int, int, int]]) -> int:
+    parsed = []
+    for lineno, cells in rows:
+        if len(cells) < 2 or not cells[0]:
+            errors.append((lineno, "нужно: модель[, память], количество"))
+            continue
+        mem = TextScan(cells[1]).mem if len(cells) > 2 and cells[1] else None
+        if len(cells) > 2 and cells[1] and mem is None:
+            errors.append((lineno, f"не понял память: {cells[1]!r}"))
+            continue
+        if not cells[-1].isdigit():
+            errors.append((lineno, f"количество не число: {cells[-1]!r}"))
+            continue
+        parsed.append((lineno, TextScan(cells[0]).model or cells[0], mem, int(cells[-1])))
+    # весь пакет сопоставляется одной матрицей, как строки сообщения
+    resolved = await resolve_products_batch(repo, network, [model for _, model, _, _ in parsed])
+    for (lineno, model, mem, qty), (pid, _) in zip(parsed, resolved):
+        if pid:
+            acc.append((pid, mem or 0, qty))
+        else:
+            errors.append((lineno, f"модель не найдена: {model!r}"))
+    return len(acc)
+
+def stock_diff_summary(diff: db.StockDiff) -> str:
+    if not diff:
+        return "без изменений"
+    return f"новых {len(diff.added)}, изменено {len(diff.changed)}, убрано {len(diff.removed)}"
+
+@router.message(Command("import"), F.document)
+async def cmd_import(m: Message, repo: db.Repo):
+    if not is_admin(m.from_user.id):
+        return
+    args = (m.caption or "").split(maxsplit=2)[1:]
+    kind = args[0].lower() if args else ""
+    network = args[1].strip() if len(args) > 1 else None
+    if kind not in ("catalog", "bindings", "stock") or (kind == "stock" and not network):
+        await reply(m, html.escape(IMPORT_USAGE, quote=False))
+        return
+    if kind == "stock":
+        await repo.ensure_network(network)
+    file = await bot.get_file(m.document.file_id)
+    errors: List[Tuple[int, str]] = []
+    stock_rows: List[Tuple[int, int, int]] = []
+    loaded = 0
+    t0 = asyncio.get_running_loop().time()
+
+    async def flush(batch):
+        nonlocal loaded
+        if kind == "catalog":
+            loaded += await _import_catalog(repo, batch, errors)
+        elif kind == "bindings":
+            loaded += await _import_bindings(repo, batch, errors)
+        else:
+            loaded = await _import_stock(repo, network, batch, errors, stock_rows)
+
+    # пакетами по IMPORT_BATCH строк: каждая пачка — своя короткая транзакция,
+    # между ними писатель успевает обслужить остальные апдейты
+    batch: List[Tuple[int, List[str]]] = []
+    async for row in _file_rows(file.file_path):
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    lines = [f"Импорт {kind}: загружено {loaded}, ошибок {len(errors)} "
+             f"({asyncio.get_running_loop().time() - t0:.1f} с)"]
+    if kind == "stock":
+        async with repo.tx():
+            diff = await repo.replace_stock_snapshot(network, stock_rows, day=today_local())
+            await repo.set_network_initialized(network, True)
+            await repo.clear_prompt_flags(network)
+        lines.append(f"Сток {network}: {stock_diff_summary(diff)}")
+    errors.sort()
+    for lineno, msg in errors[:20]:
+        lines.append(f"• строка {lineno}: {msg}")
+    if len(errors) > 20:
+        lines.append(f"… и ещё {len(errors) - 20}")
+    await reply(m, html.escape("\n".join(lines), quote=False))
+
 # =============================================================================
 # Обработка обычных сообщений
 # =============================================================================
 
 @router.message(F.text)
-async def on_text(m: Message, repo: db.Repo):
-    # антидубль
-    if await repo.mark_and_check_update(m.update_id):
-        return
+async def on_text(m: Message, repo: db.Repo, event_update: Update):
+    # болтовня отсеивается до любых запросов к БД; антидубль — раньше, в update_seen
+    with span("prefilter"):
+        if not prefilter.admit(m.text):
+            return
 
-    kind = classify_message(m.text or "")
+    with span("classify"):
+        scan = TextScan(m.text)
+        kind = scan.kind
     if kind == "ignore":
         return
 
@@ -474,83 +919,159 @@ async def on_text(m: Message, repo: db.Repo):
     if not network_id:
         if SILENT_UNBOUND:
             return
-        await m.answer("Сделайте привязку: сеть: <название>, <город>[, <адрес>]")
+        await reply(m, "Сделайте привязку: сеть: <название>, <город>[, <адрес>]")
         return
 
-    net = await repo.get_network(network_id)
-
     if kind == "stock_snapshot":
-        await handle_stock_snapshot(m, repo, network_id)
+        await handle_stock_snapshot(m, repo, network_id, scan)
         return
     if kind == "stock_inc":
-        await handle_stock_inc(m, repo, network_id)
+        await handle_stock_inc(m, repo, network_id, scan)
         return
     if kind == "sale":
-        await handle_sale(m, repo, network_id, net)
+        await handle_sale(m, repo, network_id, event_update.update_id, scan)
         return
 
 # =============================================================================
 # Бизнес-логика
 # =============================================================================
 
-async def resolve_product_from_stock_first(repo: db.Repo, network_id: int | str, raw_model: str) -> Tuple[Optional[str], str]:
+class CandidateIndex:
+    """Кэш кандидатов для сопоставления моделей: каталог (товары+алиасы) и сток по сетям.
+
+    Имена хранятся как есть: запрос (_norm) сравнивается с ними без processor, как и раньше.
+    Актуальность — по catalog_version из repo.cache_versions() (общая для реплик, в meta):
+    пока версия не изменилась, сопоставление не перечитывает кандидатов.
+    """
+
+    def __init__(self):
+        self._repo = None
+        self._catalog: Optional[Tuple[int, List[int], List[str]]] = None
+        self._stock: Dict[str, Tuple[int, List[int], List[str]]] = {}
+
+    def _check_repo(self, repo: db.Repo):
+        if self._repo is not repo:
+            self._repo = repo
+            self._catalog = None
+            self._stock.clear()
+
+    @staticmethod
+    def _build(version: int, rows: List[Tuple[int, str]]):
+        return (version, [pid for pid, _ in rows], [name for _, name in rows])
+
+    async def stock(self, repo: db.Repo, network_id: str):
+        """(ids, имена) товаров в стоке сети."""
+        self._check_repo(repo)
+        v = (await repo.cache_versions())[0]  # до запроса: коммит между ними даст лишний промах, не устаревший кэш
+        hit = self._stock.get(network_id)
+        if hit is None or hit[0] != v:
+            hit = self._stock[network_id] = self._build(v, await repo.get_network_stock_candidates(network_id))
+        return hit[1], hit[2]
+
+    async def catalog(self, repo: db.Repo):
+        """(ids, имена) всего каталога вместе с алиасами."""
+        self._check_repo(repo)
+        v = (await repo.cache_versions())[0]
+        hit = self._catalog
+        if hit is None or hit[0] != v:
+            hit = self._catalog = self._build(v, await repo.get_product_candidates_with_aliases())
+        return hit[1], hit[2]
+
+candidates = CandidateIndex()
+
+STOCK_MATCH_CUTOFF = 82    # сначала ищем среди того, что есть в стоке сети
+CATALOG_MATCH_CUTOFF = 90  # затем по всему каталогу с алиасами
+FUZZY_OFFLOAD_CELLS = 20000  # крупнее — cdist в потоке на FUZZY_WORKERS ядер, меньше — extractOne по строкам
+
+async def resolve_products_batch(repo: db.Repo, network_id: int | str, raw_models: List[str]) -> List[Tuple[Optional[int], str]]:
+    """Сопоставляет все модели сообщения: сначала против стока сети, затем против каталога
+    для тех, кто не прошёл порог. Порядок ответа = порядок входа.
+
+    Обычное сообщение (строки × кандидаты <= FUZZY_OFFLOAD_CELLS) — extractOne по строкам:
+    на матрице 1×N пул потоков cdist дороже самой работы. Крупный снимок — одна матрица
+    cdist в потоке. В обоих случаях score_cutoff отсекает кандидатов ниже порога без полного WRatio."""
     from rapidfuzz import process, fuzz
-    q = _norm(raw_model)
-
-    stock_candidates = await repo.get_network_stock_candidates(network_id)
-    if stock_candidates:
-        names = [name for _, name in stock_candidates]
-        match = process.extractOne(q, names, scorer=fuzz.WRatio)
-        if match:
-            _, score, idx = match
-            if score >= 82:
-                return stock_candidates[idx][0], names[idx]
-
-    all_candidates = await repo.get_product_candidates_with_aliases()
-    if all_candidates:
-        names = [name for _, name in all_candidates]
-        match = process.extractOne(q, names, scorer=fuzz.WRatio)
-        if match:
-            _, score, idx = match
-            if score >= 90:
-                return all_candidates[idx][0], names[idx]
-
-    return None, raw_model
-
-async def handle_sale(m: Message, repo: db.Repo, network_id: int | str, net: Any):
-    wrote_any = False
-    items = parse_sales_message(m.text or "")
-    for it in items:
-        pid, canonical = await resolve_product_from_stock_first(repo, network_id, it["model_raw"])
-        if not pid:
+    import numpy as np
+
+    with FUZZY_SECONDS.time(), span("resolve_products_batch"):
+        return await _resolve_products_batch(repo, network_id, raw_models, process, fuzz, np)
+
+async def _resolve_products_batch(repo, network_id, raw_models, process, fuzz, np):
+    out: List[Tuple[Optional[int], str]] = [(None, raw) for raw in raw_models]
+    qs = [_norm(raw) for raw in raw_models]
+    pending = list(range(len(qs)))
+    stages = (
+        ("stock", lambda: candidates.stock(repo, network_id), STOCK_MATCH_CUTOFF),
+        ("catalog", lambda: candidates.catalog(repo), CATALOG_MATCH_CUTOFF),
+    )
+    for source, load, cutoff in stages:
+        if not pending:
+            break
+        ids, names = await load()
+        if not ids:
             continue
-        mem = it["mem_gb"] or 0
-        qty = it["qty"]
-        await repo.insert_sale(
-            occurred_at=now_local(),
-            day=today_local(),
-            person_id=(await repo.get_person_by_tg(m.from_user.id)).id,
-            network_id=network_id,
-            product_id=pid,
-            memory_gb=mem,
-            qty=qty,
-            source_update_id=m.update_id,
-        )
-        wrote_any = True
-        new_qty = await repo.add_stock(network_id, pid, mem, -qty)
-        if new_qty < 0:
-            if STRICT_STOCK_PROMPT and await repo.prompt_needed_today(network_id, kind="negative"):
-                await safe_send(m.chat.id, "Остаток ушёл в минус, обновите сток.")
-    if wrote_any:
-        await repo.touch_last_sale((await repo.get_person_by_tg(m.from_user.id)).id)
-
-async def handle_stock_inc(m: Message, repo: db.Repo, network_id: int | str):
-    for line in (l for l in (m.text or "").splitlines() if l.strip()):
-        if classify_message(line) != "stock_inc":
+        batch = [qs[i] for i in pending]
+        if len(batch) * len(names) > FUZZY_OFFLOAD_CELLS:
+            scores = await asyncio.to_thread(process.cdist, batch, names, scorer=fuzz.WRatio, dtype=np.float64,
+                                             workers=FUZZY_WORKERS, score_cutoff=cutoff)
+            best = scores.argmax(axis=1)  # первый максимум — как у extractOne; ниже порога там 0
+            hits = [int(j) if scores[row, j] >= cutoff else None for row, j in enumerate(best)]
+        else:
+            hits = []
+            for q in batch:
+                match = process.extractOne(q, names, scorer=fuzz.WRatio, score_cutoff=cutoff)
+                hits.append(match[2] if match else None)
+        left = []
+        for i, j in zip(pending, hits):
+            if j is not None:
+                out[i] = (ids[j], names[j])
+            else:
+                left.append(i)
+        if len(left) < len(pending):
+            FUZZY_MATCHES.inc(len(pending) - len(left), source=source)
+        pending = left
+    if pending:
+        FUZZY_MATCHES.inc(len(pending), source="miss")
+    return out
+
+async def resolve_product_from_stock_first(repo: db.Repo, network_id: int | str, raw_model: str) -> Tuple[Optional[str], str]:
+    return (await resolve_products_batch(repo, network_id, [raw_model]))[0]
+
+@timed(HANDLER_SECONDS, handler="handle_sale")
+async def handle_sale(m: Message, repo: db.Repo, network_id: int | str, update_id: int,
+                      scan: Optional[TextScan] = None):
+    # update_id обязателен: он пишется в sales.source_update_id — только для трассировки
+    # (из какого апдейта продажа); дубли отсекает антидубль апдейтов, не эта колонка
+    rows: List[Tuple[int, int, int]] = []
+    items = (scan or TextScan(m.text)).sale_items()
+    resolved = await resolve_products_batch(repo, network_id, [it["model_raw"] for it in items])
+    for it, (pid, canonical) in zip(items, resolved):
+        if not pid:
             continue
-        qty = _extract_qty(line)
-        mem = _extract_mem(line)
-        pid, _ = await resolve_product_from_stock_first(repo, network_id, _clean_model_fragment(line))
+        rows.append((pid, it["mem_gb"] or 0, it["qty"]))
+    if not rows:
+        return
+    # все строки сообщения — продажи, списание со стока и last_sale — одной транзакцией
+    person = await repo.get_person_by_tg(m.from_user.id)
+    new_levels = await repo.insert_sales_batch(
+        occurred_at=now_local(),
+        day=today_local(),
+        person_id=person.id,
+        network_id=network_id,
+        items=rows,
+        source_update_id=update_id,
+    )
+    if any(q < 0 for q in new_levels):
+        if STRICT_STOCK_PROMPT and await repo.prompt_needed_today(network_id, kind="negative"):
+            await safe_send(m.chat.id, "Остаток ушёл в минус, обновите сток.")
+
+@timed(HANDLER_SECONDS, handler="handle_stock_inc")
+async def handle_stock_inc(m: Message, repo: db.Repo, network_id: int | str, scan: Optional[TextScan] = None):
+    lines = [l for l in (scan or TextScan(m.text)).lines if l.text and l.kind == "stock_inc"]
+    resolved = await resolve_products_batch(repo, network_id, [l.model for l in lines])
+    for line, (pid, _) in zip(lines, resolved):
+        qty = line.qty
+        mem = line.mem
         if not pid or not qty:
             continue
         await repo.insert_shipment(
@@ -561,24 +1082,23 @@ async def handle_stock_inc(m: Message, repo: db.Repo, network_id: int | str):
             memory_gb=mem or 0,
             qty=qty,
         )
-        await repo.add_stock(network_id, pid, mem or 0, +qty)
+        await repo.add_stock(network_id, pid, mem or 0, +qty, kind="shipment", day=today_local())
 
-async def handle_stock_snapshot(m: Message, repo: db.Repo, network_id: int | str):
+@timed(HANDLER_SECONDS, handler="handle_stock_snapshot")
+async def handle_stock_snapshot(m: Message, repo: db.Repo, network_id: int | str, scan: Optional[TextScan] = None):
     rows: List[Tuple[str, int, int]] = []
-    for line in (m.text or "").splitlines()[1:]:
-        l = line.strip()
-        if not l:
-            continue
-        qty = _extract_qty(l)
-        mem = _extract_mem(l)
-        pid, _ = await resolve_product_from_stock_first(repo, network_id, _clean_model_fragment(l))
+    lines = [l for l in (scan or TextScan(m.text)).lines[1:] if l.text]
+    resolved = await resolve_products_batch(repo, network_id, [l.model for l in lines])
+    for l, (pid, _) in zip(lines, resolved):
+        qty = l.qty
+        mem = l.mem
         if pid and qty is not None:
             rows.append((pid, mem or 0, qty))
     async with repo.tx():
-        await repo.replace_stock_snapshot(network_id, rows)
+        diff = await repo.replace_stock_snapshot(network_id, rows, day=today_local())
         await repo.set_network_initialized(network_id, True)
         await repo.clear_prompt_flags(network_id)
-    await safe_send(m.chat.id, "Обновил сток, спасибо.")
+    await safe_send(m.chat.id, f"Обновил сток, спасибо ({stock_diff_summary(diff)}).")
 
 # =============================================================================
 # Ежедневные задачи
@@ -609,26 +1129,28 @@ async def daily_summary_and_projection(repo: db.Repo):
             proj = round(pace * days_in_month)
             lines.append(f"• {n}: MTD {qty_mtd} → ~{proj} к {days_in_month}.{mth}")
 
-    await safe_send(GROUP_CHAT_ID, "\n".join(lines))
+    await safe_send(GROUP_CHAT_ID, "\n".join(lines), PRIO_DIGEST)
 
 async def remind_no_sales_4d(repo: db.Repo):
     if not GROUP_CHAT_ID:
         return
-    groups = await repo.get_stale_people_by_network(days=4)
+    groups = await repo.get_stale_people_by_network(days=STALE_DAYS, per_network=STALE_DAYS_BY_NETWORK)
     if not groups:
         return
-    lines = ["Нет продаж 4 дня:"]
+    lines = [f"Нет продаж {STALE_DAYS} дн.:"]
     for net, users in groups.items():
         if not users:
             continue
-        lines.append(f"• {net}: " + ", ".join(users))
-    await safe_send(GROUP_CHAT_ID, "\n".join(lines))
+        days = STALE_DAYS_BY_NETWORK.get(net, STALE_DAYS)
+        lines.append(f"• {net}{f' ({days} дн.)' if days != STALE_DAYS else ''}: " + ", ".join(users))
+    await safe_send(GROUP_CHAT_ID, "\n".join(lines), PRIO_DIGEST)
 
 # =============================================================================
 # Keep-alive и веб-сервер
 # =============================================================================
 
 async def health(_):
+    coldstart.served()
     return web.json_response({"ok": True, "ts": datetime.utcnow().isoformat()})
 
 async def cron_daily_report(request: web.Request):
@@ -639,6 +1161,129 @@ async def cron_daily_report(request: web.Request):
     await daily_summary_and_projection(repo)
     return web.Response(text="ok")
 
+async def export_csv(request: web.Request):
+    # /export/sales|shipments?key=...&from=ГГГГ-ММ-ДД&to=ГГГГ-ММ-ДД[&network=...][&gzip=1]
+    if not EXPORT_KEY or EXPORT_KEY in ("cron_default_0", "wh_default_0"):
+        return web.Response(status=404, text="export disabled")
+    if not key_matches(request.query.get("key", ""), EXPORT_KEY):
+        return web.Response(status=401, text="unauthorized")
+    kind = request.match_info["kind"]
+    if kind not in db.EXPORT_QUERIES:
+        return web.Response(status=404, text="unknown export")
+    try:
+        end = datetime.strptime(request.query["to"], "%Y-%m-%d").date() if "to" in request.query else today_local()
+        start = datetime.strptime(request.query["from"], "%Y-%m-%d").date() if "from" in request.query else end
+    except ValueError:
+        return web.Response(status=400, text="from/to: YYYY-MM-DD")
+    network = request.query.get("network") or None
+    gz = request.query.get("gzip") == "1"
+
+    name = f"{kind}_{start:%Y%m%d}-{end:%Y%m%d}{'_' + network if network else ''}.csv" + (".gz" if gz else "")
+    resp = web.StreamResponse(headers={
+        "Content-Type": "application/gzip" if gz else "text/csv; charset=utf-8",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}",
+    })
+    await resp.prepare(request)
+    # gzip-поток (wbits=31): сжимаем пачками, в памяти только текущая пачка
+    zipper = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")  # BOM: Excel иначе откроет кириллицу кракозябрами
+    async with contextlib.aclosing(request.app["repo"].iter_export(kind, start, end, network)) as batches:
+        async for rows in batches:
+            writer.writerows(rows)
+            chunk = buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+            await resp.write(zipper.compress(chunk) if zipper else chunk)
+    if zipper:
+        await resp.write(zipper.flush())
+    await resp.write_eof()
+    return resp
+
+async def metrics_endpoint(request: web.Request):
+    if METRICS_KEY and not key_matches(request.query.get("key", ""), METRICS_KEY):
+        return web.Response(status=401, text="unauthorized")
+    return web.Response(body=metrics.REGISTRY.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def register_metrics(app: web.Application):
+    # счётчики, которые уже ведут сами компоненты, — снимаются в момент выдачи /metrics
+    reg = metrics.REGISTRY
+    reg.collect("outbox_queue_depth", "gauge", "Сообщений в очереди на отправку",
+                lambda: [({}, outbox.pending())])
+    reg.collect("outbox_messages_total", "counter", "Исходящие по итогу: queued/sent/retried/dropped/flood(429)",
+                lambda: [({"result": k}, v) for k, v in outbox.stats.items()])
+    reg.collect("updates_queue_depth", "gauge", "Апдейтов в очередях сетей",
+                lambda: [({}, app["pipeline"].depth())])
+    reg.collect("updates_total", "counter", "Апдейты в очередях (вебхук и long polling) по итогу",
+                lambda: [({"result": k}, v) for k, v in app["pipeline"].stats.items()])
+    reg.collect("updates_polled_total", "counter", "Long polling: пачки, апдейты и сбои опроса",
+                lambda: [({"result": k}, v) for k, v in app["poller"].stats.items()])
+    reg.collect("prefilter_messages_total", "counter", "Сообщения после префильтра",
+                lambda: [({"result": k}, v) for k, v in prefilter.stats.items()])
+    reg.collect("report_cache_total", "counter", "Кэш отчётов /sales и /stocks",
+                lambda: [({"result": "hit"}, report_cache.hits), ({"result": "miss"}, report_cache.misses)])
+    reg.collect("traced_updates_total", "counter", "Трассированные апдейты: все и дольше TRACE_SLOW_MS",
+                lambda: [({"result": k}, v) for k, v in app["tracing"].stats.items()])
+    reg.collect("scheduler_leader", "gauge", "1 — эта реплика держит аренду и выполняет плановые задачи",
+                lambda: [({"instance": INSTANCE_ID}, int(leader.is_leader))])
+    reg.collect("identity_cache_total", "counter", "Кэши личностей и привязок Repo",
+                lambda: [({"cache": name, "result": res}, getattr(getattr(app["repo"], attr), field))
+                         for name, attr in (("person", "_people"), ("tg_network", "_tg_net"),
+                                            ("username_network", "_un_net"), ("network", "_networks"))
+                         for res, field in (("hit", "hits"), ("miss", "misses"))])
+
+class LeaderLease:
+    """Лидер среди реплик — держатель аренды в БД; продлевается каждые ttl/3.
+
+    Лидерство считается только до локального срока аренды: если продлить не удалось
+    (БД недоступна, процесс стоял), задачи прекращаются раньше, чем аренду возьмёт другой.
+    """
+
+    def __init__(self, holder: str, ttl: float, name: str = "scheduler"):
+        self.holder = holder
+        self.ttl = ttl
+        self.name = name
+        self._until = 0.0
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._until
+
+    async def renew(self, repo: db.Repo):
+        was = self.is_leader
+        t0 = time.monotonic()
+        try:
+            held = await repo.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            log.warning("lease renew failed: %s", e)
+            held = False
+        self._until = t0 + self.ttl if held else 0.0
+        if held != was:
+            log.info("lease %s: %s is %s", self.name, self.holder, "leader" if held else "follower")
+
+    async def release(self, repo: db.Repo):
+        if self.is_leader:
+            self._until = 0.0
+            await repo.release_lease(self.name, self.holder)
+
+leader = LeaderLease(INSTANCE_ID, LEASE_TTL_SEC)
+
+def scheduled(name: str, fn, leader_only: bool = True):
+    # APScheduler ждёт корутину, только если сама функция — корутинная;
+    # лямбда, возвращающая корутину, ушла бы в поток и не выполнилась
+    async def run():
+        if leader_only and not leader.is_leader:
+            return
+        with JOB_SECONDS.time(job=name):
+            try:
+                await fn()
+            except Exception:
+                JOB_FAILURES.inc(job=name)
+                log.exception("job %s failed", name)
+    return run
+
 async def keepalive_ping():
     if not RENDER_EXTERNAL_URL or not KEEPALIVE_ENABLED:
         return
@@ -656,61 +1301,162 @@ async def keepalive_ping():
     except Exception as e:
         log.debug("keepalive error: %s", e)
 
-async def on_startup(app: web.Application):
-    app["repo"] = db.Repo()
-    dp.message.middleware(RepoMiddleware(app["repo"]))
+async def open_repo():
+    if STORAGE == "postgres":
+        from db_pg import PgRepo  # asyncpg нужен только в этом режиме
+        return await PgRepo.connect(PG_DSN)
+    return db.Repo(today=today_local())
 
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-    except Exception:
-        pass
+async def setup_webhook():
+    if UPDATES_MODE == "polling":
+        # при поставленном вебхуке getUpdates отвечает 409
+        try:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            log.info("Long polling: вебхук снят")
+        except Exception as e:
+            log.warning("delete_webhook failed: %s", e)
+        return
 
     if RENDER_EXTERNAL_URL:
         url = f"{RENDER_EXTERNAL_URL}/webhook"
         await bot.set_webhook(
             url=url,
             secret_token=sanitize_secret(WEBHOOK_SECRET),
-            drop_pending_updates=True,
-            allowed_updates=["message", "edited_message"]
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            allowed_updates=ALLOWED_UPDATES
         )
         log.info("Webhook set to %s", url)
     else:
         log.warning("RENDER_EXTERNAL_URL пуст — вебхук не поставлен")
 
-    # Планировщик
-    if DATABASE_URL and HAS_SQLA:
-        scheduler = AsyncIOScheduler(
-            timezone=str(TZ),
-            jobstores={"default": SQLAlchemyJobStore(url=DATABASE_URL)}
-        )
+def _import_fuzzy():
+    from rapidfuzz import process, fuzz
+    import numpy
+
+async def warm_up(repo):
+    # кэши привязок и кандидатов, rapidfuzz/numpy — до первых сообщений, а не на них
+    networks = await repo.warm_caches()
+    await candidates.catalog(repo)
+    for net in networks:
+        await candidates.stock(repo, net)
+    await asyncio.to_thread(_import_fuzzy)
+
+def background(app: web.Application, name: str, coro):
+    # стартовые задачи, которые не должны задерживать открытие порта
+    async def run():
+        t0 = time.perf_counter()
+        try:
+            await coro
+        except Exception:
+            log.exception("startup: %s failed", name)
+        else:
+            log.info("startup: %s done in %.0fms", name, (time.perf_counter() - t0) * 1000)
+    app["background"].append(asyncio.create_task(run(), name=name))
+
+async def on_startup(app: web.Application):
+    app["background"] = []
+    app["repo"] = await open_repo()
+    coldstart.mark("repo")
+    dp.message.middleware(RepoMiddleware(app["repo"]))
+    dp.message.middleware(MetricsMiddleware())
+    if TRACE_SLOW_MS > 0:
+        app["tracing"] = TracingMiddleware(TRACE_SLOW_MS)
+        dp.message.middleware(app["tracing"])
+    if PROFILE_WINDOW_SEC > 0:
+        app["profiler"] = SamplingProfiler(PROFILE_INTERVAL_MS / 1000.0, PROFILE_WINDOW_SEC)
+        app["profiler"].start()
+
+    # вебхук общий на всех; ставит его лидер, чтобы реплики не сбрасывали его друг другу.
+    # Вызовы Telegram API — фоном: порт открывается, не дожидаясь их
+    await leader.renew(app["repo"])
+    coldstart.mark("lease")
+    if leader.is_leader:
+        background(app, "webhook", setup_webhook())
     else:
-        scheduler = AsyncIOScheduler(timezone=str(TZ))
+        log.info("%s не лидер — вебхук не трогаем", INSTANCE_ID)
+    background(app, "warm_up", warm_up(app["repo"]))
+
+    # Планировщик: у каждой реплики свой, задачи ниже выполняет только лидер.
+    # Хранилище задач — в памяти: общее в БД дало бы запуск на всех репликах,
+    # а замыкания с repo в него и не сериализуются.
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler  # ~30ms импорта — только при старте сервера
+    scheduler = AsyncIOScheduler(timezone=str(TZ))
+    scheduler.add_job(scheduled("lease", lambda: leader.renew(app["repo"]), leader_only=False), "interval",
+                      seconds=max(1.0, LEASE_TTL_SEC / 3), id="lease")
 
     # Свод в 20:00
-    scheduler.add_job(lambda: daily_summary_and_projection(app["repo"]), "cron",
+    scheduler.add_job(scheduled("daily_report", lambda: daily_summary_and_projection(app["repo"])), "cron",
                       hour=20, minute=0, misfire_grace_time=3600, id="daily_report")
     # Напоминания в 10:00
-    scheduler.add_job(lambda: remind_no_sales_4d(app["repo"]), "cron",
+    scheduler.add_job(scheduled("no_sales_4d", lambda: remind_no_sales_4d(app["repo"])), "cron",
                       hour=10, minute=0, misfire_grace_time=3600, id="no_sales_4d")
+    # Чекпоинт стока за вчера — запросы «сток на дату» не листают весь журнал
+    scheduler.add_job(scheduled("stock_checkpoint",
+                                lambda: app["repo"].checkpoint_stock(today_local() - timedelta(days=1))),
+                      "cron", hour=0, minute=10, misfire_grace_time=3600, id="stock_checkpoint")
+    # Антидубль: окно в памяти сбрасываем на диск фоном (каждая реплика — своё), старьё чистим раз в сутки
+    scheduler.add_job(scheduled("dedup_flush", lambda: app["repo"].flush_dedup(), leader_only=False), "interval",
+                      seconds=DEDUP_FLUSH_SEC, id="dedup_flush")
+    scheduler.add_job(scheduled("dedup_prune", lambda: app["repo"].prune_processed_updates()), "cron",
+                      hour=4, minute=0, misfire_grace_time=3600, id="dedup_prune")
     # Keep-alive каждые 4 минуты
     if KEEPALIVE_ENABLED:
-        scheduler.add_job(keepalive_ping, "interval", minutes=KEEPALIVE_INTERVAL_MIN,
+        scheduler.add_job(scheduled("keepalive", keepalive_ping), "interval", minutes=KEEPALIVE_INTERVAL_MIN,
                           id="keepalive", next_run_time=now_local() + timedelta(seconds=10))
     scheduler.start()
     app["scheduler"] = scheduler
     log.info("Scheduler started")
+    coldstart.mark("scheduler")
+
+    # getUpdates допускает одного потребителя на бота — опрашивает лидер
+    if UPDATES_MODE == "polling":
+        # пачки идут в те же очереди по сетям, что и вебхук
+        app["poller"] = UpdatePoller(app["pipeline"], bot, app["repo"], active=lambda: leader.is_leader,
+                                     limit=POLL_LIMIT, timeout=POLL_TIMEOUT_SEC, allowed_updates=ALLOWED_UPDATES)
+        app["poller"].start()
+        log.info("Long polling started")
+
+    coldstart.report()
+    coldstart.release()  # дальше на том же сокете отвечает aiohttp
 
 async def on_cleanup(app: web.Application):
+    for task in app.get("background", []):
+        task.cancel()
+    await asyncio.gather(*app.get("background", []), return_exceptions=True)
     scheduler = app.get("scheduler")
     if scheduler:
         scheduler.shutdown(wait=False)
+    if app.get("poller"):
+        await app["poller"].close()
+    pipeline = app.get("pipeline")
+    if pipeline:
+        await pipeline.close()
+    await outbox.close()
+    if app.get("profiler"):
+        app["profiler"].stop()
+    repo = app.get("repo")
+    if repo:
+        await repo.flush_dedup()
+        with contextlib.suppress(Exception):
+            await leader.release(repo)  # другая реплика подхватит задачи сразу, не дожидаясь TTL
+        closing = repo.close()
+        if asyncio.iscoroutine(closing):  # PgRepo закрывает пул асинхронно
+            await closing
 
 def build_app() -> web.Application:
     app = web.Application()
     # health (GET). HEAD прикрутится автоматически.
     app.router.add_get("/", health)
     app.router.add_post("/cron/daily_report", cron_daily_report)
-    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=sanitize_secret(WEBHOOK_SECRET)).register(app, path="/webhook")
+    app.router.add_get("/export/{kind}", export_csv)
+    app.router.add_get("/metrics", metrics_endpoint)
+    register_metrics(app)
+    # вебхук отвечает сразу, обработка — в очередях по сетям (updates.py)
+    pipeline = UpdatePipeline(dp, bot, lambda u: update_route_key(app["repo"], u),
+                              secret=sanitize_secret(WEBHOOK_SECRET), max_queue=UPDATE_QUEUE_MAX,
+                              max_lanes=UPDATE_LANES, seen=lambda u: update_seen(app["repo"], u))
+    app["pipeline"] = pipeline
+    app.router.add_post("/webhook", pipeline.handle)
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
     return app
@@ -719,7 +1465,13 @@ def build_app() -> web.Application:
 # Entry
 # =============================================================================
 
+coldstart.mark("module")
+
 if __name__ == "__main__":
     if not BOT_TOKEN:
         raise SystemExit("Set BOT_TOKEN environment variable")
-    web.run_app(build_app(), port=PORT)
+    sock = coldstart.held_socket()
+    if sock is not None:
+        web.run_app(build_app(), sock=sock)
+    else:
+        web.run_app(build_app(), port=PORT)
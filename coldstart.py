@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Быстрый холодный старт: порт слушается и отвечает на health раньше, чем загружен бот.
+
+Импорт aiogram (pydantic-модели всех типов Bot API) занимает секунды, и всё это время
+платформа видит закрытый порт. hold_port() вызывается в самом начале bot.py: биндит
+PORT и в отдельном потоке отвечает 200 на GET/HEAD / и 503 на остальное (вебхук
+Telegram повторит). Тот же сокет потом получает aiohttp (run_app(sock=...)), а
+release() гасит временный сервер — соединения в промежутке ждут в backlog, а не
+получают отказ.
+
+mark()/report() — разбивка старта по этапам в лог "startup". Модуль только на stdlib:
+его импорт не должен стоить времени.
+"""
+
+import logging
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+T0 = time.perf_counter()  # отсчёт — от загрузки bot.py
+log = logging.getLogger("startup")
+
+_marks: List[Tuple[str, float]] = []
+_first_ok: Optional[float] = None
+_reported = False
+_sock: Optional[socket.socket] = None
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def mark(stage: str):
+    """Этап закончился сейчас; в отчёте — его длительность от предыдущей отметки."""
+    _marks.append((stage, time.perf_counter() - T0))
+
+
+def served():
+    """Ответили 200 (временный сервер или health бота) — запомнить первый раз."""
+    global _first_ok
+    if _first_ok is None:
+        _first_ok = time.perf_counter() - T0
+        if _reported:
+            log.info("first 200 at %.0fms", _first_ok * 1000)
+
+
+def report():
+    global _reported
+    parts, prev = [], 0.0
+    for stage, t in _marks:
+        parts.append(f"{stage} {(t - prev) * 1000:.0f}ms")
+        prev = t
+    first = f", first 200 at {_first_ok * 1000:.0f}ms" if _first_ok is not None else ""
+    log.info("%s; ready at %.0fms%s", ", ".join(parts), prev * 1000, first)
+    _reported = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, body: bool):
+        if self.path == "/":
+            self.send_response(200)
+            payload = b'{"ok": true, "starting": true}'
+        else:
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            payload = b'{"ok": false, "starting": true}'
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if body:
+            self.wfile.write(payload)
+        if self.path == "/":
+            served()
+
+    def do_GET(self):
+        self._reply(True)
+
+    def do_HEAD(self):
+        self._reply(False)
+
+    def do_POST(self):
+        self._reply(True)
+
+    def log_message(self, *args):
+        pass
+
+
+def hold_port(port: int, host: str = "0.0.0.0"):
+    global _sock, _server
+    _sock = socket.create_server((host, port), backlog=128)
+    _server = ThreadingHTTPServer((host, port), _Handler, bind_and_activate=False)
+    _server.socket.close()
+    _server.socket = _sock.dup()  # свой дескриптор: server_close() не закроет сокет для aiohttp
+    threading.Thread(target=_server.serve_forever, args=(0.05,), name="coldstart", daemon=True).start()
+
+
+def held_socket() -> Optional[socket.socket]:
+    return _sock
+
+
+def release():
+    """Погасить временный сервер (после того как aiohttp готов принять на том же сокете)."""
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
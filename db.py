@@ -1,16 +1,124 @@
 # db.py — SQLite Repo для нового bot.py
-import os, sqlite3, contextlib
-from dataclasses import dataclass
+#
+# Все запросы выполняются вне event loop: записи идут в единственный поток-писатель
+# (своё соединение, очередь заданий, одна транзакция на задание), чтения — в небольшой
+# пул read-only соединений (WAL позволяет читать параллельно с записью).
+# Опционально писатель склеивает задания, пришедшие в окне DB_GROUP_COMMIT_MS, в один
+# коммит (group commit): каждое задание — в своём SAVEPOINT, fsync один на пачку.
+import os, json, sqlite3, contextlib, contextvars, functools, threading, queue, asyncio, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import metrics
+from tracing import span
 
 DB_PATH = os.getenv("DB_PATH", "sales.db")
+DB_READERS = int(os.getenv("DB_READERS", "3"))  # размер пула читающих соединений
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "0"))  # 0 — коммит на каждое задание
+DB_GROUP_COMMIT_MAX = 64
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "2000"))  # строк на один fetchmany при выгрузке
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "50000"))  # сколько последних update_id помним
+# несколько реплик на одной базе: новый update_id ещё и «застолбить» в processed_updates
+DEDUP_SHARED = os.getenv("DEDUP_SHARED", "0") == "1"
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "4096"))  # людей/привязок в кэше
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "300"))   # сек; страховка от правок мимо Repo
+CACHE_VERSION_SEC = float(os.getenv("CACHE_VERSION_SEC", "2"))  # как часто перечитывать версии кэшей из meta
+VERSION_KEYS = ("catalog_version", "data_version", "bindings_version")  # порядок — как в Repo.cache_versions()
+
+# Миграции поверх базовой схемы: (версия, [SQL]). Номер применённой хранится в PRAGMA user_version.
+# :today — сегодняшняя дата в часовом поясе бота (Repo(today=...)), а не сервера.
+# Индексы подобраны под реальные запросы Repo; `python -m bench.plans` проверяет планы.
+MIGRATIONS: List[Tuple[int, List[str]]] = [
+    (1, [
+        # пересборка свода и выгрузки по сети: GROUP BY network, day без временного B-дерева
+        "CREATE INDEX IF NOT EXISTS idx_sales_net_day ON sales(network, day, qty)",
+        "DROP INDEX IF EXISTS idx_sales_net",
+    ]),
+    (2, [
+        # служебные ключи (high-water mark антидубля и т.п.)
+        """CREATE TABLE IF NOT EXISTS meta(
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        )""",
+    ]),
+    (3, [
+        # поиск продавцов без продаж: диапазон по last_sale вместо перебора всех привязок
+        "CREATE INDEX IF NOT EXISTS idx_people_last_sale ON people(last_sale)",
+    ]),
+    (4, [
+        # журнал движений стока: остаток на дату = чекпоинт + движения после него
+        """CREATE TABLE IF NOT EXISTS stock_moves(
+            id         INTEGER PRIMARY KEY,
+            network    TEXT NOT NULL,
+            day        TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            memory_gb  INTEGER NOT NULL DEFAULT 0,
+            delta      INTEGER NOT NULL,
+            kind       TEXT NOT NULL  -- opening | sale | shipment | snapshot | adjust
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_stock_moves_net_day ON stock_moves(network, day)",
+        # чекпоинт — остаток сети на конец дня day (строки только с ненулевым qty)
+        """CREATE TABLE IF NOT EXISTS stock_checkpoints(
+            network TEXT NOT NULL,
+            day     TEXT NOT NULL,
+            PRIMARY KEY(network, day)
+        )""",
+        """CREATE TABLE IF NOT EXISTS stock_checkpoint_rows(
+            network    TEXT NOT NULL,
+            day        TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            memory_gb  INTEGER NOT NULL,
+            qty        INTEGER NOT NULL,
+            PRIMARY KEY(network, day, product_id, memory_gb)
+        )""",
+        # история начинается с текущих остатков
+        """INSERT INTO stock_moves(network, day, product_id, memory_gb, delta, kind)
+           SELECT network, :today, product_id, memory_gb, qty, 'opening'
+           FROM stock WHERE qty<>0""",
+    ]),
+    (5, [
+        # выгрузка поставок за период (всех сетей и одной) — диапазон по индексу, уже в порядке day
+        "CREATE INDEX IF NOT EXISTS idx_shipments_day ON shipments(day)",
+        "CREATE INDEX IF NOT EXISTS idx_shipments_net_day ON shipments(network, day)",
+    ]),
+    (6, [
+        # аренды для выбора лидера среди реплик (плановые задачи выполняет только держатель)
+        """CREATE TABLE IF NOT EXISTS leases(
+            name       TEXT PRIMARY KEY,
+            holder     TEXT NOT NULL,
+            expires_at REAL NOT NULL  -- unix time
+        )""",
+    ]),
+]
+# база на этой версии уже со всей схемой — на старте DDL пропускается. Поэтому и правки
+# базовой схемы в _init_schema вносятся вместе с новой миграцией.
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-def _conn():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# выгрузка CSV: (заголовок, запрос); {net} — необязательный фильтр по сети
+EXPORT_QUERIES = {
+    "sales": ("id,occurred_at,day,network,tgid,product,memory_gb,qty,source_update_id", """
+        SELECT s.id, s.occurred_at, s.day, s.network, s.tgid, p.name, s.memory_gb, s.qty, s.source_update_id
+        FROM sales s LEFT JOIN products p ON p.id=s.product_id
+        WHERE s.day>=? AND s.day<=? {net}
+    """),
+    "shipments": ("id,occurred_at,day,network,product,memory_gb,qty", """
+        SELECT s.id, s.occurred_at, s.day, s.network, p.name, s.memory_gb, s.qty
+        FROM shipments s LEFT JOIN products p ON p.id=s.product_id
+        WHERE s.day>=? AND s.day<=? {net}
+    """),
+}
+
+def _conn(readonly: bool = False):
+    # isolation_level=None: транзакциями управляет поток-писатель (BEGIN/COMMIT явно)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA foreign_keys=ON")
+    if readonly:
+        conn.execute("PRAGMA query_only=ON")
     return conn
 
 def _today_str() -> str:
@@ -21,14 +129,430 @@ class Person:
     id: str           # используем строку tgid
     username: str|None
 
-class Repo:
+@dataclass
+class StockDiff:
+    """Что изменил снимок стока: SKU — (product_id, memory_gb)."""
+    added: List[Tuple[int, int, int]] = field(default_factory=list)         # (pid, mem, qty)
+    changed: List[Tuple[int, int, int, int]] = field(default_factory=list)  # (pid, mem, было, стало)
+    removed: List[Tuple[int, int, int]] = field(default_factory=list)       # (pid, mem, было)
+    unchanged: int = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    @classmethod
+    def between(cls, old: Dict[Tuple[int, int], int], rows: List[Tuple[int, int, int]]) -> "StockDiff":
+        """Разница текущего стока old {(pid, mem): qty} и снимка rows [(pid, mem, qty)].
+
+        Повтор одного SKU в снимке — складываем.
+        """
+        new: Dict[Tuple[int, int], int] = {}
+        for pid, mem, qty in rows:
+            key = (int(pid), int(mem or 0))
+            new[key] = new.get(key, 0) + int(qty)
+        diff = cls()
+        for (pid, mem), qty in new.items():
+            was = old.get((pid, mem))
+            if was is None:
+                diff.added.append((pid, mem, qty))
+            elif was != qty:
+                diff.changed.append((pid, mem, was, qty))
+            else:
+                diff.unchanged += 1
+        diff.removed = [(pid, mem, qty) for (pid, mem), qty in old.items() if (pid, mem) not in new]
+        return diff
+
+# =============================================================================
+# Асинхронный слой исполнения
+# =============================================================================
+
+_COMMIT = object()
+_ROLLBACK = object()
+
+class _TxAborted(Exception):
+    pass
+
+class _TxSession:
+    """Открытая транзакция repo.tx(): задания из её очереди писатель выполняет без коммита."""
     def __init__(self):
-        self.conn = _conn()
-        self._init_schema()
+        self.q: "queue.Queue" = queue.Queue()
+        self.open = True
+
+# текущая транзакция задачи (для вложенных вызовов внутри `async with repo.tx()`)
+_TX: contextvars.ContextVar[Optional[_TxSession]] = contextvars.ContextVar("repo_tx", default=None)
+
+def _resolve(fut: asyncio.Future, result: Any, exc: Optional[BaseException]):
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+def _post(loop: asyncio.AbstractEventLoop, fut: asyncio.Future, result: Any, exc: Optional[BaseException]):
+    try:
+        loop.call_soon_threadsafe(_resolve, fut, result, exc)
+    except RuntimeError:
+        pass  # loop уже закрыт — результат никому не нужен
+
+class _Writer(threading.Thread):
+    """Единственный поток-писатель: владеет write-соединением, разбирает очередь заданий."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__(name="repo-writer", daemon=True)
+        self.conn = conn
+        self.q: "queue.Queue" = queue.Queue()
+        self._hooks: List[Any] = []  # вызываются после успешного COMMIT
+
+    def after_commit(self, hook):
+        # только из потока-писателя (внутри задания)
+        self._hooks.append(hook)
+
+    def submit(self, fn, args, kw) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        job = (fn, args, kw, loop, fut)
+        sess = _TX.get()
+        if sess is not None and sess.open:
+            sess.q.put(job)
+        else:
+            self.q.put(job)
+        return fut
+
+    def stop(self):
+        self.q.put(None)
+        self.join()
+
+    def run(self):
+        stop = False
+        while not stop:
+            job = self.q.get()
+            if job is None:
+                break
+            jobs = [job]
+            if DB_GROUP_COMMIT_MS > 0:
+                stop = self._collect(jobs)
+            self._run_batch(jobs)
+        self.conn.close()
+
+    def _collect(self, jobs) -> bool:
+        # добираем задания, пришедшие в окне group commit; True — пришёл сигнал остановки
+        deadline = time.monotonic() + DB_GROUP_COMMIT_MS / 1000.0
+        while len(jobs) < DB_GROUP_COMMIT_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self.q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                return True
+            jobs.append(job)
+        return False
+
+    def _run_batch(self, jobs):
+        # одна транзакция на пачку; ошибка задания откатывает только его SAVEPOINT
+        c = self.conn
+        results = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for fn, args, kw, loop, fut in jobs:
+                c.execute("SAVEPOINT job")
+                mark = len(self._hooks)
+                try:
+                    if isinstance(fn, _TxSession):
+                        res = self._run_session(fn)
+                    else:
+                        res = fn(c, *args, **kw)
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    del self._hooks[mark:]
+                    results.append((loop, fut, None, e))
+                else:
+                    c.execute("RELEASE job")
+                    results.append((loop, fut, res, None))
+            c.execute("COMMIT")
+        except BaseException as e:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            results = [(loop, fut, None, e) for _, _, _, loop, fut in jobs]
+        else:
+            for hook in self._hooks:
+                hook()
+        self._hooks.clear()
+        # результаты отдаём только после COMMIT — запись уже на диске
+        for loop, fut, res, exc in results:
+            _post(loop, fut, res, exc)
+
+    def _run_session(self, sess: _TxSession):
+        # задания транзакции резолвятся сразу: владелец ждёт их, чтобы продолжить тело tx()
+        try:
+            while True:
+                job = sess.q.get()
+                if job is _COMMIT:
+                    return
+                if job is _ROLLBACK:
+                    raise _TxAborted()
+                fn, args, kw, loop, fut = job
+                try:
+                    res = fn(self.conn, *args, **kw)
+                except Exception as e:
+                    _post(loop, fut, None, e)
+                else:
+                    _post(loop, fut, res, None)
+        finally:
+            sess.open = False
+            # всё, что успело попасть в очередь после закрытия, уходит обычным порядком
+            while True:
+                try:
+                    job = sess.q.get_nowait()
+                except queue.Empty:
+                    break
+                if job not in (_COMMIT, _ROLLBACK):
+                    self.q.put(job)
+
+class UpdateDedup:
+    """Окно последних update_id в памяти: проверка дубля — O(1) и без диска.
+
+    update_id от Telegram растут монотонно, поэтому хватает кольца флагов на `window`
+    id ниже максимума (high-water mark). Исключение: после недели без апдейтов Telegram
+    начинает с случайного id, и он может оказаться сильно ниже hwm. Старые апдейты так
+    далеко назад не приходят, поэтому id ниже окна — это новая последовательность: hwm
+    переставляется на него, кольцо очищается. Новые id копятся в `pending` и периодически
+    сбрасываются в БД (Repo.flush_dedup).
+    """
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = max(1, window)
+        self.ring = bytearray(self.window)  # ring[id % window] — видели ли id
+        self.hwm: Optional[int] = None
+        self.pending: List[int] = []
+
+    def _clear(self, first: int, count: int):
+        # обнулить `count` слотов, начиная с id `first`
+        if count >= self.window:
+            self.ring[:] = bytes(self.window)
+            return
+        start = first % self.window
+        end = start + count
+        if end <= self.window:
+            self.ring[start:end] = bytes(count)
+        else:
+            self.ring[start:] = bytes(self.window - start)
+            self.ring[:end - self.window] = bytes(end - self.window)
+
+    def check_and_mark(self, update_id: int) -> bool:
+        """True — id уже встречался, False — новый, теперь помечен. id ниже окна — сброс
+        последовательности: hwm переставляется на него, ответ False."""
+        update_id = int(update_id)
+        if self.hwm is None or update_id > self.hwm:
+            first = update_id if self.hwm is None else self.hwm + 1
+            self._clear(first, update_id - first + 1)
+            self.hwm = update_id
+        elif update_id <= self.hwm - self.window:
+            self.ring[:] = bytes(self.window)
+            self.hwm = update_id
+        elif self.ring[update_id % self.window]:
+            return True
+        self.ring[update_id % self.window] = 1
+        self.pending.append(update_id)
+        return False
+
+    def load(self, hwm: Optional[int], recent: List[int]):
+        if hwm is not None:
+            # id выше hwm в processed_updates — остаток прежней последовательности (до сброса)
+            recent = [uid for uid in recent if uid <= hwm]
+        for uid in sorted(recent):
+            self.check_and_mark(uid)
+        if hwm is not None and (self.hwm is None or hwm > self.hwm):
+            self.check_and_mark(hwm)
+        self.pending.clear()
+
+    def take_pending(self) -> List[int]:
+        ids, self.pending = self.pending, []
+        return ids
+
+    def unmark(self, update_id: int):
+        """Снять отметку: апдейт не учтён (не удалось записать), повторная доставка должна пройти."""
+        update_id = int(update_id)
+        if self.hwm is not None and self.hwm - self.window < update_id <= self.hwm:
+            self.ring[update_id % self.window] = 0
+        self.pending = [i for i in self.pending if i != update_id]
+
+_MISS = object()
+
+class TTLCache:
+    """LRU с TTL. Инвалидация приходит из потока-писателя (после COMMIT), поэтому под локом.
+
+    gen растёт на каждую инвалидацию: значение, прочитанное до неё, в кэш уже не кладём.
+    """
+
+    def __init__(self, maxsize: int = IDENTITY_CACHE_SIZE, ttl: float = IDENTITY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.gen = 0
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return _MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, gen: Optional[int] = None):
+        with self._lock:
+            if gen is not None and gen != self.gen:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=_MISS):
+        with self._lock:
+            self.gen += 1
+            if key is _MISS:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+def _savepoint(c, *statements):
+    for sql in statements:
+        c.execute(sql)
+
+def _timed(fn):
+    # время самого метода в потоке БД, без ожидания в очереди писателя/пула
+    name = fn.__name__
+    @functools.wraps(fn)
+    def inner(self, c, *args, **kw):
+        t0 = time.perf_counter()
+        try:
+            return fn(self, c, *args, **kw)
+        finally:
+            metrics.REPO_SECONDS.observe(time.perf_counter() - t0, method=name)
+    return inner
+
+def _writes(fn):
+    """Метод выполняется в потоке-писателе: fn(self, conn, *args) внутри транзакции."""
+    fn = _timed(fn)
+    stage = "repo." + fn.__name__
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kw):
+        with span(stage):
+            return await self._writer.submit(functools.partial(fn, self), args, kw)
+    return wrapper
+
+def _reads(fn):
+    """Метод выполняется на read-only соединении из пула (внутри tx() — через писателя)."""
+    fn = _timed(fn)
+    stage = "repo." + fn.__name__
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kw):
+        with span(stage):
+            if _TX.get() is not None and _TX.get().open:
+                return await self._writer.submit(functools.partial(fn, self), args, kw)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._readers, functools.partial(self._run_read, fn, args, kw))
+    return wrapper
+
+class Repo:
+    def __init__(self, today: Optional[date] = None):
+        # today — для миграций (дата opening-движений); бот передаёт today_local()
+        conn = _conn()
+        self._init_schema(conn, today or date.today())
+        self.dedup = UpdateDedup()
+        self._load_dedup(conn)
+        self._writer = _Writer(conn)
+        self._writer.start()
+        # версии кэшей лежат в meta и растут в той же транзакции, что и правка, — поэтому их
+        # видят все реплики. catalog_version — набор кандидатов fuzzy-сопоставления (каталог/алиасы
+        # или состав стока), data_version — продажи, поставки или сток (тексты отчётов),
+        # bindings_version — люди, привязки и сети (кэши личностей ниже)
+        self._versions: Tuple[int, int, int] = (0, 0, 0)
+        self._versions_at = float("-inf")
+        self._bindings_seen: Optional[int] = None
+        # кэши личностей для on_text: tgid -> Person, tgid -> сеть, username -> сеть, сеть -> строка networks
+        self._people = TTLCache()
+        self._tg_net = TTLCache()
+        self._un_net = TTLCache()
+        self._networks = TTLCache()
+        self._local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._readers = ThreadPoolExecutor(max_workers=max(1, DB_READERS), thread_name_prefix="repo-read")
+
+    def _run_read(self, fn, args, kw):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = self._local.conn = _conn(readonly=True)
+            self._read_conns.append(c)
+        return fn(self, c, *args, **kw)
+
+    def _bump(self, c, key: str):
+        c.execute("""
+            INSERT INTO meta(key, value) VALUES(?, '1')
+            ON CONFLICT(key) DO UPDATE SET value=CAST(meta.value AS INTEGER)+1
+        """, (key,))
+        self._writer.after_commit(self._versions_stale)
+
+    def _versions_stale(self):
+        self._versions_at = float("-inf")  # свой коммит виден сразу, не через CACHE_VERSION_SEC
+
+    async def cache_versions(self) -> Tuple[int, int, int]:
+        """(catalog_version, data_version, bindings_version) из meta. Из БД — не чаще раза в CACHE_VERSION_SEC:
+        правки других реплик видны с такой задержкой, свои — сразу после коммита."""
+        now = time.monotonic()
+        if now - self._versions_at >= CACHE_VERSION_SEC:
+            # всегда читающее соединение: версия — только закоммиченная, даже внутри tx()
+            loop = asyncio.get_running_loop()
+            self._versions = await loop.run_in_executor(self._readers, self._run_read, Repo._read_versions, (), {})
+            self._versions_at = now
+        return self._versions
+
+    def _read_versions(self, c) -> Tuple[int, int, int]:
+        v = dict(c.execute(f"SELECT key, value FROM meta WHERE key IN {VERSION_KEYS}").fetchall())
+        return tuple(int(v.get(k, 0)) for k in VERSION_KEYS)
+
+    async def _sync_identity(self):
+        # привязку могли поменять на другой реплике — тогда кэши личностей сбрасываются целиком
+        v = (await self.cache_versions())[2]
+        if v != self._bindings_seen:
+            self._bindings_seen = v
+            for cache in (self._people, self._tg_net, self._un_net, self._networks):
+                cache.invalidate()
+
+    async def _cached(self, cache: TTLCache, key, load):
+        # внутри tx() — мимо кэша: там видны ещё не закоммиченные правки
+        if _TX.get() is not None and _TX.get().open:
+            return await load()
+        await self._sync_identity()
+        v = cache.get(key)
+        if v is _MISS:
+            gen = cache.gen
+            v = await load()
+            cache.put(key, v, gen)
+        return v
+
+    def close(self):
+        self._writer.stop()
+        self._readers.shutdown(wait=True)
+        for c in self._read_conns:
+            c.close()
+        self._read_conns.clear()
 
     # ---------- schema ----------
-    def _init_schema(self):
-        c = self.conn.cursor()
+    def _init_schema(self, conn: sqlite3.Connection, today: date):
+        c = conn.cursor()
+        if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        c.execute("BEGIN")
 
         # люди
         c.execute("""
@@ -96,7 +620,20 @@ class Repo:
             source_update_id INTEGER
         )""")
         c.execute("CREATE INDEX IF NOT EXISTS idx_sales_day ON sales(day)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_sales_net ON sales(network)")
+
+        # дневной свод продаж по сети: ведётся в той же транзакции, что и insert_sale;
+        # отчёты читают только его (месяц — ~31 строка на сеть)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily(
+            network TEXT,
+            day TEXT,
+            qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(network, day)
+        )""")
+        # база, где продажи были раньше свода, — заполняем один раз
+        r = c.execute("SELECT EXISTS(SELECT 1 FROM sales) AND NOT EXISTS(SELECT 1 FROM sales_daily) AS need").fetchone()
+        if r[0]:
+            self._fill_sales_daily(c)
 
         # поставки/приход
         c.execute("""
@@ -135,83 +672,197 @@ class Repo:
             update_id INTEGER PRIMARY KEY
         )""")
 
-        self.conn.commit()
+        self._migrate(c, today)
+        c.execute("COMMIT")
+
+    def _load_dedup(self, c):
+        r = c.execute("SELECT value FROM meta WHERE key='dedup_hwm'").fetchone()
+        hwm = int(r[0]) if r else c.execute("SELECT MAX(update_id) FROM processed_updates").fetchone()[0]
+        recent = []
+        if hwm is not None:
+            recent = [row[0] for row in c.execute(
+                "SELECT update_id FROM processed_updates WHERE update_id > ?", (int(hwm) - self.dedup.window,))]
+        self.dedup.load(hwm, recent)
+
+    @staticmethod
+    def _migrate(c, today: date):
+        current = c.execute("PRAGMA user_version").fetchone()[0]
+        params = {"today": today.strftime("%Y-%m-%d")}
+        for version, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for sql in statements:
+                c.execute(sql, params)
+            c.execute(f"PRAGMA user_version={int(version)}")
 
     # ---------- утилиты ----------
     @contextlib.asynccontextmanager
     async def tx(self):
+        # все вызовы Repo внутри блока идут одной транзакцией писателя
+        sess = _TX.get()
+        if sess is not None:
+            if not sess.open:
+                yield
+                return
+            # вложенный блок — SAVEPOINT: ошибка внутри откатывает только его записи
+            await self._writer.submit(_savepoint, ("SAVEPOINT nested",), {})
+            try:
+                yield
+            except BaseException:
+                await self._writer.submit(_savepoint, ("ROLLBACK TO nested", "RELEASE nested"), {})
+                raise
+            await self._writer.submit(_savepoint, ("RELEASE nested",), {})
+            return
+        sess = _TxSession()
+        done = self._writer.submit(sess, (), {})
+        token = _TX.set(sess)
         try:
-            self.conn.execute("BEGIN")
             yield
-            self.conn.execute("COMMIT")
-        except Exception:
-            self.conn.execute("ROLLBACK")
+        except BaseException:
+            _TX.reset(token)
+            sess.q.put(_ROLLBACK)
+            with contextlib.suppress(_TxAborted):
+                await done
             raise
+        _TX.reset(token)
+        sess.q.put(_COMMIT)
+        await done
 
     # ---------- люди / привязки ----------
     async def get_person_by_tg(self, tgid: int) -> Person:
         tgid = str(tgid)
-        cur = self.conn.execute("SELECT tgid, username FROM people WHERE tgid=?", (tgid,))
-        row = cur.fetchone()
-        if not row:
-            self.conn.execute("INSERT INTO people(tgid) VALUES(?)", (tgid,))
-            self.conn.commit()
-            return Person(id=tgid, username=None)
+        return await self._cached(self._people, tgid,
+                                  lambda: self._person_or_create(tgid))
+
+    async def _person_or_create(self, tgid: str) -> Person:
+        return await self._find_person(tgid) or await self._create_person(tgid)
+
+    @_reads
+    def _find_person(self, c, tgid: str) -> Optional[Person]:
+        row = c.execute("SELECT tgid, username FROM people WHERE tgid=?", (tgid,)).fetchone()
+        return Person(id=row["tgid"], username=row["username"]) if row else None
+
+    @_writes
+    def _create_person(self, c, tgid: str) -> Person:
+        c.execute("INSERT OR IGNORE INTO people(tgid) VALUES(?)", (tgid,))
+        row = c.execute("SELECT tgid, username FROM people WHERE tgid=?", (tgid,)).fetchone()
         return Person(id=row["tgid"], username=row["username"])
 
-    async def bind_by_tgid(self, tgid: int, network: str):
+    @_writes
+    def bind_by_tgid(self, c, tgid: int, network: str):
         tgid = str(tgid)
-        self.conn.execute("INSERT OR IGNORE INTO people(tgid) VALUES(?)", (tgid,))
-        self.conn.execute("INSERT INTO networks(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (network,))
-        self.conn.execute("""
+        c.execute("INSERT OR IGNORE INTO people(tgid) VALUES(?)", (tgid,))
+        c.execute("INSERT INTO networks(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (network,))
+        c.execute("""
             INSERT INTO person_network(tgid, network) VALUES(?,?)
             ON CONFLICT(tgid) DO UPDATE SET network=excluded.network
         """, (tgid, network))
-        self.conn.commit()
+        self._bump(c, "bindings_version")
+        self._writer.after_commit(lambda: (self._tg_net.invalidate(tgid), self._networks.invalidate(network)))
 
-    async def bind_by_username(self, username: str, network: str):
+    @_writes
+    def bind_by_username(self, c, username: str, network: str):
         u = (username or "").lstrip("@")
-        self.conn.execute("INSERT INTO networks(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (network,))
-        self.conn.execute("""
+        c.execute("INSERT INTO networks(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (network,))
+        c.execute("""
             INSERT INTO username_network(username, network) VALUES(?,?)
             ON CONFLICT(username) DO UPDATE SET network=excluded.network
         """, (u, network))
-        self.conn.commit()
+        self._bump(c, "bindings_version")
+        self._writer.after_commit(lambda: (self._un_net.invalidate(u), self._networks.invalidate(network)))
+
+    @_writes
+    def import_bindings(self, c, rows: List[Tuple[str, str]]) -> int:
+        """Пакет привязок из файла: [(tgid или @username, сеть)] одной транзакцией."""
+        by_tg = [(str(ident), net) for ident, net in rows if str(ident).isdigit()]
+        by_un = [(str(ident).lstrip("@"), net) for ident, net in rows if not str(ident).isdigit()]
+        c.executemany("INSERT INTO networks(name) VALUES(?) ON CONFLICT(name) DO NOTHING",
+                      [(net,) for net in {net for _, net in rows}])
+        c.executemany("INSERT OR IGNORE INTO people(tgid) VALUES(?)", [(tg,) for tg, _ in by_tg])
+        c.executemany("""
+            INSERT INTO person_network(tgid, network) VALUES(?,?)
+            ON CONFLICT(tgid) DO UPDATE SET network=excluded.network
+        """, by_tg)
+        c.executemany("""
+            INSERT INTO username_network(username, network) VALUES(?,?)
+            ON CONFLICT(username) DO UPDATE SET network=excluded.network
+        """, by_un)
+        # поштучно инвалидировать тысячи ключей незачем — сбросим кэши целиком
+        self._bump(c, "bindings_version")
+        self._writer.after_commit(lambda: (self._tg_net.invalidate(), self._un_net.invalidate(),
+                                           self._networks.invalidate()))
+        return len(rows)
 
     async def get_network_by_username(self, username: str) -> Optional[str]:
         u = (username or "").lstrip("@")
-        cur = self.conn.execute("SELECT network FROM username_network WHERE username=?", (u,))
-        r = cur.fetchone()
+        return await self._cached(self._un_net, u, lambda: self._network_by_username(u))
+
+    @_reads
+    def _network_by_username(self, c, u: str) -> Optional[str]:
+        r = c.execute("SELECT network FROM username_network WHERE username=?", (u,)).fetchone()
         return r["network"] if r else None
 
     async def get_primary_network_for_person(self, person_id: str) -> Optional[str]:
-        cur = self.conn.execute("SELECT network FROM person_network WHERE tgid=?", (str(person_id),))
-        r = cur.fetchone()
+        tgid = str(person_id)
+        return await self._cached(self._tg_net, tgid, lambda: self._network_for_person(tgid))
+
+    @_reads
+    def _network_for_person(self, c, tgid: str) -> Optional[str]:
+        r = c.execute("SELECT network FROM person_network WHERE tgid=?", (tgid,)).fetchone()
         return r["network"] if r else None
 
-    async def ensure_network(self, name: str, city: Optional[str]=None, address: Optional[str]=None):
-        self.conn.execute("""
+    @_writes
+    def ensure_network(self, c, name: str, city: Optional[str]=None, address: Optional[str]=None):
+        c.execute("""
             INSERT INTO networks(name, city, address) VALUES(?,?,?)
             ON CONFLICT(name) DO UPDATE SET
                 city=COALESCE(excluded.city, city),
                 address=COALESCE(excluded.address, address)
         """, (name, city, address))
-        self.conn.commit()
+        self._bump(c, "bindings_version")
+        self._writer.after_commit(lambda: self._networks.invalidate(name))
 
     async def get_network(self, name: str) -> Dict[str, Any]:
-        cur = self.conn.execute("SELECT * FROM networks WHERE name=?", (name,))
-        r = cur.fetchone()
+        return dict(await self._cached(self._networks, name, lambda: self._load_network(name)))
+
+    @_reads
+    def _load_network(self, c, name: str) -> Dict[str, Any]:
+        r = c.execute("SELECT * FROM networks WHERE name=?", (name,)).fetchone()
         return dict(r) if r else {"name": name, "city": None, "address": None, "initialized": 0}
 
+    async def warm_caches(self) -> List[str]:
+        """Заполнить кэши людей, привязок и сетей одним проходом (прогрев после старта); -> сети."""
+        await self._sync_identity()  # иначе первый же _cached сбросит прогретое
+        gens = (self._people.gen, self._tg_net.gen, self._networks.gen)
+        people, networks = await self._identity_rows(IDENTITY_CACHE_SIZE)
+        for tgid, username, network in people:
+            self._people.put(tgid, Person(id=tgid, username=username), gens[0])
+            self._tg_net.put(tgid, network, gens[1])
+        for row in networks:
+            self._networks.put(row["name"], row, gens[2])
+        return [row["name"] for row in networks]
+
+    @_reads
+    def _identity_rows(self, c, limit: int):
+        people = [(r["tgid"], r["username"], r["network"]) for r in c.execute("""
+            SELECT p.tgid, p.username, pn.network
+            FROM people p LEFT JOIN person_network pn ON pn.tgid=p.tgid
+            LIMIT ?
+        """, (limit,))]
+        networks = [dict(r) for r in c.execute("SELECT * FROM networks LIMIT ?", (limit,))]
+        return people, networks
+
     # ---------- продукты/алиасы ----------
-    async def get_product_candidates_with_aliases(self) -> List[Tuple[int, str]]:
+    @_reads
+    def get_product_candidates_with_aliases(self, c) -> List[Tuple[int, str]]:
         rows = []
-        rows += [(r["id"], r["name"]) for r in self.conn.execute("SELECT id,name FROM products").fetchall()]
-        rows += [(r["product_id"], r["alias"]) for r in self.conn.execute("SELECT product_id,alias FROM aliases").fetchall()]
+        rows += [(r["id"], r["name"]) for r in c.execute("SELECT id,name FROM products").fetchall()]
+        rows += [(r["product_id"], r["alias"]) for r in c.execute("SELECT product_id,alias FROM aliases").fetchall()]
         return rows
 
-    async def get_network_stock_candidates(self, network: str) -> List[Tuple[int, str]]:
-        cur = self.conn.execute("""
+    @_reads
+    def get_network_stock_candidates(self, c, network: str) -> List[Tuple[int, str]]:
+        cur = c.execute("""
             SELECT s.product_id, p.name
             FROM stock s JOIN products p ON p.id=s.product_id
             WHERE s.network=?
@@ -220,176 +871,435 @@ class Repo:
         return [(r["product_id"], r["name"]) for r in cur.fetchall()]
 
     # (вдруг пригодится) завести продукт и алиас
-    async def ensure_product(self, canonical_name: str, alias: Optional[str]=None) -> int:
-        cur = self.conn.execute("INSERT INTO products(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (canonical_name,))
+    @_writes
+    def ensure_product(self, c, canonical_name: str, alias: Optional[str]=None) -> int:
+        pid = self._ensure_product(c, canonical_name, alias)
+        self._bump(c, "catalog_version")
+        return pid
+
+    @_writes
+    def import_catalog(self, c, rows: List[Tuple[str, List[str]]]) -> int:
+        """Пакет каталога из файла: [(каноническое имя, [алиасы])] одной транзакцией."""
+        for name, aliases in rows:
+            pid = self._ensure_product(c, name)
+            for alias in aliases:
+                self._ensure_alias(c, alias, pid)
+        self._bump(c, "catalog_version")
+        return len(rows)
+
+    def _ensure_product(self, c, canonical_name: str, alias: Optional[str]=None) -> int:
+        cur = c.execute("INSERT INTO products(name) VALUES(?) ON CONFLICT(name) DO NOTHING", (canonical_name,))
         if cur.rowcount == 0:
-            cur = self.conn.execute("SELECT id FROM products WHERE name=?", (canonical_name,))
+            cur = c.execute("SELECT id FROM products WHERE name=?", (canonical_name,))
         else:
-            cur = self.conn.execute("SELECT last_insert_rowid() AS id")
+            cur = c.execute("SELECT last_insert_rowid() AS id")
         pid = int(cur.fetchone()["id"])
         if alias:
-            self.conn.execute("INSERT INTO aliases(alias, product_id) VALUES(?,?) ON CONFLICT(alias) DO UPDATE SET product_id=excluded.product_id", (alias, pid))
-        self.conn.commit()
+            self._ensure_alias(c, alias, pid)
         return pid
 
+    @staticmethod
+    def _ensure_alias(c, alias: str, pid: int):
+        c.execute("INSERT INTO aliases(alias, product_id) VALUES(?,?) ON CONFLICT(alias) DO UPDATE SET product_id=excluded.product_id", (alias, pid))
+
     # ---------- сток ----------
-    async def add_stock(self, network: str, product_id: int, memory_gb: int, delta: int) -> int:
+    @_writes
+    def add_stock(self, c, network: str, product_id: int, memory_gb: int, delta: int, *,
+                  day: date, kind: str = "adjust") -> int:
+        # day — дата в часовом поясе бота (today_local()), не сервера
+        qty, created = self._apply_stock_delta(c, network, product_id, memory_gb, delta, kind,
+                                               day.strftime("%Y-%m-%d"))
+        self._bump(c, "data_version")
+        if created:
+            self._bump(c, "catalog_version")
+        return qty
+
+    @staticmethod
+    def _log_moves(c, network: str, day: str, kind: str, moves: List[Tuple[int, int, int]]):
+        # moves: [(product_id, mem, delta)]
+        c.executemany("""
+            INSERT INTO stock_moves(network, day, product_id, memory_gb, delta, kind) VALUES(?,?,?,?,?,?)
+        """, [(network, day, pid, mem or 0, int(delta), kind) for pid, mem, delta in moves if delta])
+
+    def _apply_stock_delta(self, c, network: str, product_id: int, memory_gb: int, delta: int,
+                           kind: str, day: str) -> Tuple[int, bool]:
+        # (новый остаток, создана ли строка стока); версии кэшей поднимает вызывающий — раз на транзакцию
+        self._log_moves(c, network, day, kind, [(product_id, memory_gb, delta)])
         # upsert
-        cur = self.conn.execute("""
+        row = c.execute("""
             SELECT qty FROM stock WHERE network=? AND product_id=? AND memory_gb=?
-        """, (network, product_id, memory_gb or 0))
-        row = cur.fetchone()
+        """, (network, product_id, memory_gb or 0)).fetchone()
         if row:
             new_qty = int(row["qty"]) + int(delta)
-            self.conn.execute("""
+            c.execute("""
                 UPDATE stock SET qty=?, updated_at=datetime('now','localtime')
                 WHERE network=? AND product_id=? AND memory_gb=?
             """, (new_qty, network, product_id, memory_gb or 0))
         else:
             new_qty = int(delta)
-            self.conn.execute("""
+            c.execute("""
                 INSERT INTO stock(network,product_id,memory_gb,qty,updated_at)
                 VALUES(?,?,?,?,datetime('now','localtime'))
             """, (network, product_id, memory_gb or 0, new_qty))
-        self.conn.commit()
-        return new_qty
+            return new_qty, True
+        return new_qty, False
 
-    async def replace_stock_snapshot(self, network: str, rows: List[Tuple[int,int,int]]):
+    @_writes
+    def replace_stock_snapshot(self, c, network: str, rows: List[Tuple[int,int,int]], *,
+                               day: date) -> StockDiff:
         # rows: [(product_id, mem, qty)]
-        self.conn.execute("DELETE FROM stock WHERE network=?", (network,))
-        for pid, mem, qty in rows:
-            self.conn.execute("""
+        old = {(r["product_id"], r["memory_gb"]): r["qty"] for r in c.execute(
+            "SELECT product_id, memory_gb, qty FROM stock WHERE network=?", (network,))}
+        # пишем только разницу: у неизменившихся SKU остаётся и qty, и updated_at
+        diff = StockDiff.between(old, rows)
+        if diff.removed:
+            c.executemany("DELETE FROM stock WHERE network=? AND product_id=? AND memory_gb=?",
+                          [(network, pid, mem) for pid, mem, _ in diff.removed])
+        if diff.changed:
+            c.executemany("""
+                UPDATE stock SET qty=?, updated_at=datetime('now','localtime')
+                WHERE network=? AND product_id=? AND memory_gb=?
+            """, [(qty, network, pid, mem) for pid, mem, _, qty in diff.changed])
+        if diff.added:
+            c.executemany("""
                 INSERT INTO stock(network,product_id,memory_gb,qty,updated_at)
                 VALUES(?,?,?,?,datetime('now','localtime'))
-            """, (network, pid, mem or 0, int(qty)))
-        self.conn.commit()
+            """, [(network, pid, mem, qty) for pid, mem, qty in diff.added])
+        # в журнал снимок ложится разницей с прежним остатком
+        self._log_moves(c, network, day.strftime("%Y-%m-%d"), "snapshot",
+                        [(pid, mem, qty) for pid, mem, qty in diff.added]
+                        + [(pid, mem, qty - was) for pid, mem, was, qty in diff.changed]
+                        + [(pid, mem, -was) for pid, mem, was in diff.removed])
+        if diff:
+            self._bump(c, "data_version")
+        if diff.added or diff.removed:
+            # кандидатов для сопоставления меняет только состав SKU, не количества
+            self._bump(c, "catalog_version")
+        return diff
 
-    async def set_network_initialized(self, network: str, flag: bool):
-        self.conn.execute("UPDATE networks SET initialized=? WHERE name=?", (1 if flag else 0, network))
-        self.conn.commit()
+    @_writes
+    def set_network_initialized(self, c, network: str, flag: bool):
+        c.execute("UPDATE networks SET initialized=? WHERE name=?", (1 if flag else 0, network))
+        self._bump(c, "bindings_version")
+        self._writer.after_commit(lambda: self._networks.invalidate(network))
 
-    async def clear_prompt_flags(self, network: str):
-        self.conn.execute("DELETE FROM prompts WHERE network=?", (network,))
-        self.conn.commit()
+    @_writes
+    def clear_prompt_flags(self, c, network: str):
+        c.execute("DELETE FROM prompts WHERE network=?", (network,))
 
-    async def get_stock_table(self, network: Optional[str]) -> List[Tuple[str, Optional[int], int]]:
+    @_reads
+    def get_stock_table(self, c, network: Optional[str],
+                        as_of: Optional[date] = None) -> List[Tuple[str, Optional[int], int]]:
+        """Сток сети сейчас или, с as_of, на конец этого дня (по журналу движений)."""
         if not network:
             return []
-        cur = self.conn.execute("""
-            SELECT p.name AS name, s.memory_gb AS mem, s.qty AS qty
-            FROM stock s JOIN products p ON p.id=s.product_id
-            WHERE s.network=?
-            ORDER BY p.name, s.memory_gb
-        """, (network,))
-        return [(r["name"], r["mem"], r["qty"]) for r in cur.fetchall()]
+        if as_of is None:
+            cur = c.execute("""
+                SELECT p.name AS name, s.memory_gb AS mem, s.qty AS qty
+                FROM stock s JOIN products p ON p.id=s.product_id
+                WHERE s.network=?
+            """, (network,))
+            rows = [(r["name"], r["mem"], r["qty"]) for r in cur.fetchall()]
+        else:
+            levels = self._stock_as_of(c, network, as_of.strftime("%Y-%m-%d"))
+            pids = sorted({pid for pid, _ in levels})
+            names: Dict[int, str] = {}
+            for i in range(0, len(pids), 500):
+                chunk = pids[i:i + 500]
+                names.update((r["id"], r["name"]) for r in c.execute(
+                    f"SELECT id, name FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+            rows = [(names.get(pid), mem, qty) for (pid, mem), qty in levels.items() if qty]
+        # сортируем здесь: ORDER BY по имени из другой таблицы — это временное B-дерево
+        rows.sort(key=lambda r: (r[0] or "", r[1]))
+        return rows
+
+    @staticmethod
+    def _stock_as_of(c, network: str, day: str) -> Dict[Tuple[int, int], int]:
+        # последний чекпоинт не позже day + движения после него: скан ограничен днями от чекпоинта
+        r = c.execute("SELECT MAX(day) AS day FROM stock_checkpoints WHERE network=? AND day<=?",
+                      (network, day)).fetchone()
+        base = r["day"] if r else None
+        levels: Dict[Tuple[int, int], int] = {}
+        if base:
+            for r in c.execute("""
+                SELECT product_id, memory_gb, qty FROM stock_checkpoint_rows WHERE network=? AND day=?
+            """, (network, base)):
+                levels[(r["product_id"], r["memory_gb"])] = r["qty"]
+        for r in c.execute("""
+            SELECT product_id, memory_gb, delta FROM stock_moves WHERE network=? AND day>? AND day<=?
+        """, (network, base or "", day)):
+            key = (r["product_id"], r["memory_gb"])
+            levels[key] = levels.get(key, 0) + r["delta"]
+        return levels
+
+    @_writes
+    def checkpoint_stock(self, c, day: date) -> int:
+        """Чекпоинт остатков на конец day для сетей, у которых с прошлого чекпоинта были движения."""
+        d = day.strftime("%Y-%m-%d")
+        done = 0
+        for net in [r["name"] for r in c.execute("SELECT name FROM networks")]:
+            if c.execute("SELECT 1 FROM stock_checkpoints WHERE network=? AND day=?", (net, d)).fetchone():
+                continue
+            r = c.execute("SELECT MAX(day) AS day FROM stock_checkpoints WHERE network=? AND day<?",
+                          (net, d)).fetchone()
+            if not c.execute("SELECT 1 FROM stock_moves WHERE network=? AND day>? AND day<=? LIMIT 1",
+                             (net, r["day"] or "", d)).fetchone():
+                continue  # ничего не двигалось — хватит прежнего чекпоинта
+            levels = self._stock_as_of(c, net, d)
+            c.execute("INSERT INTO stock_checkpoints(network, day) VALUES(?,?)", (net, d))
+            c.executemany("""
+                INSERT INTO stock_checkpoint_rows(network, day, product_id, memory_gb, qty) VALUES(?,?,?,?,?)
+            """, [(net, d, pid, mem, qty) for (pid, mem), qty in levels.items() if qty])
+            done += 1
+        return done
 
     # ---------- продажи/поставки ----------
-    async def insert_sale(self, occurred_at: datetime, day: date, person_id: str,
-                          network_id: str, product_id: int, memory_gb: int, qty: int,
-                          source_update_id: int):
-        self.conn.execute("""
+    @_writes
+    def insert_sale(self, c, occurred_at: datetime, day: date, person_id: str,
+                    network_id: str, product_id: int, memory_gb: int, qty: int,
+                    source_update_id: int):
+        c.execute("""
             INSERT INTO sales(occurred_at,day,tgid,network,product_id,memory_gb,qty,source_update_id)
             VALUES(?,?,?,?,?,?,?,?)
         """, (occurred_at.isoformat(), day.strftime("%Y-%m-%d"), str(person_id),
               network_id, product_id, memory_gb or 0, int(qty), int(source_update_id)))
+        self._add_sales_daily(c, network_id, day.strftime("%Y-%m-%d"), int(qty))
+        self._bump(c, "data_version")
         # обновим last_sale у человека
-        self.conn.execute("UPDATE people SET last_sale=? WHERE tgid=?", (day.strftime("%Y-%m-%d"), str(person_id)))
-        self.conn.commit()
+        c.execute("UPDATE people SET last_sale=? WHERE tgid=?", (day.strftime("%Y-%m-%d"), str(person_id)))
+
+    @_writes
+    def insert_sales_batch(self, c, occurred_at: datetime, day: date, person_id: str,
+                           network_id: str, items: List[Tuple[int,int,int]],
+                           source_update_id: int) -> List[int]:
+        # items: [(product_id, mem, qty)] — все строки одного сообщения одной транзакцией.
+        # Возвращает новые остатки в порядке items.
+        d = day.strftime("%Y-%m-%d")
+        c.executemany("""
+            INSERT INTO sales(occurred_at,day,tgid,network,product_id,memory_gb,qty,source_update_id)
+            VALUES(?,?,?,?,?,?,?,?)
+        """, [(occurred_at.isoformat(), d, str(person_id), network_id, pid, mem or 0, int(qty),
+               int(source_update_id)) for pid, mem, qty in items])
+        applied = [self._apply_stock_delta(c, network_id, pid, mem, -int(qty), "sale", d) for pid, mem, qty in items]
+        if items:
+            self._add_sales_daily(c, network_id, d, sum(int(qty) for _, _, qty in items))
+            self._bump(c, "data_version")  # одна на сообщение, а не на строку: каждая сбрасывает кэши
+            if any(created for _, created in applied):
+                self._bump(c, "catalog_version")
+            c.execute("UPDATE people SET last_sale=? WHERE tgid=?", (d, str(person_id)))
+        return [qty for qty, _ in applied]
+
+    def _add_sales_daily(self, c, network: str, day: str, qty: int):
+        c.execute("""
+            INSERT INTO sales_daily(network, day, qty) VALUES(?,?,?)
+            ON CONFLICT(network, day) DO UPDATE SET qty=qty+excluded.qty
+        """, (network, day, qty))
+
+    @staticmethod
+    def _fill_sales_daily(c) -> int:
+        c.execute("DELETE FROM sales_daily")
+        return c.execute("""
+            INSERT INTO sales_daily(network, day, qty)
+            SELECT network, day, SUM(qty) FROM sales GROUP BY network, day
+        """).rowcount
 
-    async def insert_shipment(self, occurred_at: datetime, day: date,
-                              network_id: str, product_id: int, memory_gb: int, qty: int):
-        self.conn.execute("""
+    @_writes
+    def rebuild_sales_daily(self, c) -> int:
+        """Пересобрать свод из сырых sales; возвращает число строк свода."""
+        self._bump(c, "data_version")
+        return self._fill_sales_daily(c)
+
+    @_writes
+    def insert_shipment(self, c, occurred_at: datetime, day: date,
+                        network_id: str, product_id: int, memory_gb: int, qty: int):
+        c.execute("""
             INSERT INTO shipments(occurred_at,day,network,product_id,memory_gb,qty)
             VALUES(?,?,?,?,?,?)
         """, (occurred_at.isoformat(), day.strftime("%Y-%m-%d"),
               network_id, product_id, memory_gb or 0, int(qty)))
-        self.conn.commit()
+        self._bump(c, "data_version")
 
-    async def touch_last_sale(self, person_id: str):
-        self.conn.execute("UPDATE people SET last_sale=? WHERE tgid=?", (_today_str(), str(person_id)))
-        self.conn.commit()
+    @_writes
+    def touch_last_sale(self, c, person_id: str):
+        c.execute("UPDATE people SET last_sale=? WHERE tgid=?", (_today_str(), str(person_id)))
+
+    # ---------- выгрузка ----------
+    async def iter_export(self, kind: str, start: date, end: date, network: Optional[str] = None,
+                          batch: int = EXPORT_BATCH) -> AsyncIterator[List[Tuple]]:
+        """Строки sales/shipments за [start, end] пачками по batch; первая пачка — [заголовок].
+
+        Отдельное read-only соединение: длинная выгрузка не занимает пул читателей отчётов,
+        а память не растёт — в каждый момент в руках одна пачка fetchmany.
+        """
+        header, sql = EXPORT_QUERIES[kind]
+        args: List[Any] = [start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")]
+        if network:
+            args.append(network)
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(None, functools.partial(_conn, readonly=True))
+        try:
+            cur = await loop.run_in_executor(
+                None, conn.execute, sql.format(net="AND s.network=?" if network else ""), args)
+            yield [tuple(header.split(","))]
+            while True:
+                rows = await loop.run_in_executor(None, cur.fetchmany, batch)
+                if not rows:
+                    break
+                yield [tuple(r) for r in rows]
+        finally:
+            await loop.run_in_executor(None, conn.close)
 
     # ---------- отчёты ----------
-    async def get_sales_by_network_day(self, d: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
-        sql = "SELECT network, SUM(qty) s FROM sales WHERE day=?"
-        args = [d.strftime("%Y-%m-%d")]
+    def _sales_totals(self, c, start: date, end: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        # сумма за [start, end) из свода: по одной сети — диапазон PK, по всем — подзапрос на каждую
+        # сеть (сетей десятки, поиск по PK), без GROUP BY по диапазону дат и временных B-деревьев
+        args = [start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")]
         if only_network:
-            sql += " AND network=?"
-            args.append(only_network)
-        sql += " GROUP BY network ORDER BY s DESC"
-        cur = self.conn.execute(sql, args)
-        return [(r["network"], int(r["s"])) for r in cur.fetchall()]
+            cur = c.execute("""
+                SELECT network, SUM(qty) s FROM sales_daily
+                WHERE network=? AND day>=? AND day<?
+                GROUP BY network
+            """, [only_network] + args)
+        else:
+            cur = c.execute("""
+                SELECT n.name AS network,
+                       (SELECT SUM(d.qty) FROM sales_daily d
+                        WHERE d.network=n.name AND d.day>=? AND d.day<?) AS s
+                FROM networks n
+            """, args)
+        rows = [(r["network"], int(r["s"])) for r in cur.fetchall() if r["s"] is not None]
+        rows.sort(key=lambda r: -r[1])
+        return rows
 
-    async def get_sales_by_network_week(self, today: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+    @_reads
+    def get_sales_by_network_day(self, c, d: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        return self._sales_totals(c, d, d + timedelta(days=1), only_network)
+
+    @_reads
+    def get_sales_by_network_week(self, c, today: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
         # ISO: понедельник — воскресенье
         start = today - timedelta(days=today.weekday())
         end = start + timedelta(days=7)
-        sql = "SELECT network, SUM(qty) s FROM sales WHERE day>=? AND day<?"
-        args = [start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")]
-        if only_network:
-            sql += " AND network=?"
-            args.append(only_network)
-        sql += " GROUP BY network ORDER BY s DESC"
-        cur = self.conn.execute(sql, args)
-        return [(r["network"], int(r["s"])) for r in cur.fetchall()]
+        return self._sales_totals(c, start, end, only_network)
 
-    async def get_sales_by_network_month(self, y: int, m: int, only_network: Optional[str]) -> List[Tuple[str,int]]:
+    @_reads
+    def get_sales_by_network_month(self, c, y: int, m: int, only_network: Optional[str]) -> List[Tuple[str,int]]:
         start = date(y, m, 1)
         end = date(y+1,1,1) if m==12 else date(y, m+1, 1)
-        sql = "SELECT network, SUM(qty) s FROM sales WHERE day>=? AND day<?"
-        args = [start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")]
-        if only_network:
-            sql += " AND network=?"
-            args.append(only_network)
-        sql += " GROUP BY network ORDER BY s DESC"
-        cur = self.conn.execute(sql, args)
-        return [(r["network"], int(r["s"])) for r in cur.fetchall()]
-
-    async def set_plan(self, network: str, y: int, m: int, plan: int):
-        self.conn.execute("""
+        return self._sales_totals(c, start, end, only_network)
+
+    @_writes
+    def set_plan(self, c, network: str, y: int, m: int, plan: int):
+        c.execute("""
             INSERT INTO plans(network,year,month,plan) VALUES(?,?,?,?)
             ON CONFLICT(network,year,month) DO UPDATE SET plan=excluded.plan
         """, (network, y, m, int(plan)))
-        self.conn.commit()
-
-    async def get_stale_people_by_network(self, days: int=4) -> Dict[str, List[str]]:
-        cutoff = date.today() - timedelta(days=days)
-        cur = self.conn.execute("""
-            SELECT pn.network, p.username, p.tgid, p.last_sale
-            FROM person_network pn
-            JOIN people p ON p.tgid=pn.tgid
-        """)
+
+    @_reads
+    def get_stale_people_by_network(self, c, days: int=4,
+                                    per_network: Optional[Dict[str, int]] = None) -> Dict[str, List[str]]:
+        """Продавцы без продаж дольше порога: days по умолчанию, per_network — свой порог сети."""
+        today = date.today()
+        cutoffs = {net: (today - timedelta(days=d)).strftime("%Y-%m-%d") for net, d in (per_network or {}).items()}
+        default = (today - timedelta(days=days)).strftime("%Y-%m-%d")
+        # по индексу берём всех, кто старше самой поздней из отсечек, точный порог — по сети
+        widest = max([default, *cutoffs.values()])
+        cur = c.execute("""
+            SELECT pn.network, p.username, p.tgid
+            FROM people p
+            JOIN person_network pn ON pn.tgid=p.tgid
+            LEFT JOIN json_each(?) t ON t.key=pn.network
+            WHERE (p.last_sale IS NULL OR p.last_sale < ?)
+              AND pn.network IS NOT NULL
+              AND (p.last_sale IS NULL OR p.last_sale < COALESCE(t.value, ?))
+        """, (json.dumps(cutoffs), widest, default))
         res: Dict[str, List[str]] = {}
         for r in cur.fetchall():
-            d = r["last_sale"]
-            stale = (not d) or (d < cutoff.strftime("%Y-%m-%d"))
-            if stale:
-                shown = f"@{r['username']}" if r["username"] else r["tgid"]
-                res.setdefault(r["network"], []).append(shown)
+            shown = f"@{r['username']}" if r["username"] else r["tgid"]
+            res.setdefault(r["network"], []).append(shown)
         return res
 
     # ---------- напоминания ----------
-    async def prompt_needed_today(self, network: str, kind: str="negative") -> bool:
-        today = _today_str()
-        cur = self.conn.execute("SELECT last_date FROM prompts WHERE network=? AND kind=?", (network, kind))
-        r = cur.fetchone()
-        if r and r["last_date"] == today:
-            return False
-        self.conn.execute("""
+    @_writes
+    def prompt_needed_today(self, c, network: str, kind: str="negative") -> bool:
+        # один upsert без чтения: из двух реплик строку изменит только первая
+        return c.execute("""
             INSERT INTO prompts(network,kind,last_date) VALUES(?,?,?)
             ON CONFLICT(network,kind) DO UPDATE SET last_date=excluded.last_date
-        """, (network, kind, today))
-        self.conn.commit()
-        return True
+            WHERE prompts.last_date IS NOT excluded.last_date
+        """, (network, kind, _today_str())).rowcount == 1
+
+    # ---------- аренды (лидер среди реплик) ----------
+    @_writes
+    def acquire_lease(self, c, name: str, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду name на ttl секунд; False — её держит другой и она не истекла."""
+        now = time.time()
+        return c.execute("""
+            INSERT INTO leases(name, holder, expires_at) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+            WHERE leases.holder=excluded.holder OR leases.expires_at<?
+        """, (name, holder, now + ttl, now)).rowcount == 1
+
+    @_writes
+    def release_lease(self, c, name: str, holder: str):
+        c.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+    # ---------- long polling ----------
+    @_reads
+    def get_poll_offset(self, c) -> Optional[int]:
+        """offset для getUpdates: следующий после последнего учтённого update_id."""
+        r = c.execute("SELECT value FROM meta WHERE key='poll_offset'").fetchone()
+        return int(r[0]) if r else None
+
+    @_writes
+    def set_poll_offset(self, c, offset: int):
+        c.execute("""
+            INSERT INTO meta(key, value) VALUES('poll_offset', ?)
+            ON CONFLICT(key) DO UPDATE SET value=excluded.value
+        """, (str(offset),))
 
     # ---------- антидубль ----------
     async def mark_and_check_update(self, update_id: int) -> bool:
+        # память; на диск окно уходит фоново через flush_dedup
+        if self.dedup.check_and_mark(update_id):
+            return True
+        # с репликами тот же апдейт мог уйти другой: решает PK processed_updates
+        if not DEDUP_SHARED:
+            return False
         try:
-            self.conn.execute("INSERT INTO processed_updates(update_id) VALUES(?)", (int(update_id),))
-            self.conn.commit()
-            # простой трим старья
-            self.conn.execute("DELETE FROM processed_updates WHERE update_id < (SELECT MAX(update_id)-50000 FROM processed_updates)")
-            self.conn.commit()
-            return False  # еще не было
-        except sqlite3.IntegrityError:
-            return True   # уже видели
+            return not await self._claim_update(update_id)
+        except BaseException:
+            self.dedup.unmark(update_id)  # БД занята/недоступна — не считаем апдейт виденным
+            raise
+
+    @_writes
+    def _claim_update(self, c, update_id: int) -> bool:
+        return c.execute("INSERT OR IGNORE INTO processed_updates(update_id) VALUES(?)", (update_id,)).rowcount == 1
+
+    async def flush_dedup(self):
+        ids = self.dedup.take_pending()
+        if ids:
+            try:
+                await self._save_dedup(ids, self.dedup.hwm)
+            except Exception:
+                self.dedup.pending[:0] = ids  # не потеряем — попробуем в следующий раз
+                raise
+
+    @_writes
+    def _save_dedup(self, c, ids: List[int], hwm: int):
+        c.executemany("INSERT OR IGNORE INTO processed_updates(update_id) VALUES(?)", [(i,) for i in ids])
+        c.execute("""
+            INSERT INTO meta(key, value) VALUES('dedup_hwm', ?)
+            ON CONFLICT(key) DO UPDATE SET value=excluded.value
+        """, (str(hwm),))
+
+    @_writes
+    def prune_processed_updates(self, c) -> int:
+        """Удалить id старше окна антидубля и хвост прежней последовательности после сброса
+        update_id (плановая задача, не на каждый апдейт)."""
+        r = c.execute("SELECT value FROM meta WHERE key='dedup_hwm'").fetchone()
+        if not r:
+            return 0
+        hwm = int(r[0])
+        return c.execute("DELETE FROM processed_updates WHERE update_id <= ? OR update_id > ?",
+                         (hwm - self.dedup.window, hwm + self.dedup.window)).rowcount
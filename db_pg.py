@@ -0,0 +1,894 @@
+# db_pg.py — PostgreSQL Repo (asyncpg) с тем же набором методов, что у db.Repo
+#
+# Выбирается конфигом (STORAGE=postgres, см. bot.py). Вместо потока-писателя — пул
+# соединений: каждый метод берёт соединение и идёт своей транзакцией, внутри tx() — на
+# соединении блока. Хуки after-commit (версии каталога/данных, сброс кэшей) копятся в
+# транзакции и срабатывают после коммита, как у писателя SQLite.
+# Отчёты агрегируются на сервере, сток — пакетный INSERT ... ON CONFLICT по unnest().
+# Сверка с db.Repo на одном сценарии: PG_TEST_URL=postgresql://... python -m bench.parity
+import os, contextlib, contextvars, functools, json, re, time, zlib
+from datetime import date, datetime, timedelta
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import asyncpg
+
+import metrics
+from db import (CACHE_VERSION_SEC, DEDUP_SHARED, EXPORT_BATCH, EXPORT_QUERIES, IDENTITY_CACHE_SIZE, Person, StockDiff, TTLCache,
+                VERSION_KEYS, UpdateDedup, _MISS)
+from tracing import span
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))  # выгрузка держит соединение на всё время
+
+# Схема целиком (аналог базовой схемы db.py + MIGRATIONS). Дни — DATE, время событий —
+# исходная строка isoformat, как в SQLite, чтобы выгрузка совпадала байт в байт.
+SCHEMA: List[str] = [
+    """CREATE TABLE IF NOT EXISTS people(
+        tgid      TEXT PRIMARY KEY,
+        username  TEXT,
+        last_sale DATE
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_people_last_sale ON people(last_sale)",
+    """CREATE TABLE IF NOT EXISTS networks(
+        name        TEXT PRIMARY KEY,
+        city        TEXT,
+        address     TEXT,
+        initialized INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS person_network(
+        tgid    TEXT PRIMARY KEY REFERENCES people(tgid) ON DELETE CASCADE,
+        network TEXT REFERENCES networks(name) ON DELETE SET NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS username_network(
+        username TEXT PRIMARY KEY,
+        network  TEXT REFERENCES networks(name) ON DELETE SET NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS products(
+        id   INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS aliases(
+        alias      TEXT PRIMARY KEY,
+        product_id INTEGER REFERENCES products(id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS stock(
+        network    TEXT REFERENCES networks(name) ON DELETE CASCADE,
+        product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+        memory_gb  INTEGER NOT NULL DEFAULT 0,
+        qty        INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ,
+        PRIMARY KEY(network, product_id, memory_gb)
+    )""",
+    """CREATE TABLE IF NOT EXISTS sales(
+        id               BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        occurred_at      TEXT,
+        day              DATE,
+        tgid             TEXT REFERENCES people(tgid),
+        network          TEXT REFERENCES networks(name),
+        product_id       INTEGER REFERENCES products(id),
+        memory_gb        INTEGER,
+        qty              INTEGER,
+        source_update_id BIGINT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_sales_day ON sales(day)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_net_day ON sales(network, day)",
+    """CREATE TABLE IF NOT EXISTS sales_daily(
+        network TEXT,
+        day     DATE,
+        qty     INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(network, day)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_sales_daily_day ON sales_daily(day)",
+    """CREATE TABLE IF NOT EXISTS shipments(
+        id          BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        occurred_at TEXT,
+        day         DATE,
+        network     TEXT REFERENCES networks(name),
+        product_id  INTEGER REFERENCES products(id),
+        memory_gb   INTEGER,
+        qty         INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_shipments_day ON shipments(day)",
+    "CREATE INDEX IF NOT EXISTS idx_shipments_net_day ON shipments(network, day)",
+    """CREATE TABLE IF NOT EXISTS plans(
+        network TEXT,
+        year    INTEGER,
+        month   INTEGER,
+        plan    INTEGER,
+        PRIMARY KEY(network, year, month)
+    )""",
+    """CREATE TABLE IF NOT EXISTS prompts(
+        network   TEXT,
+        kind      TEXT,
+        last_date DATE,
+        PRIMARY KEY(network, kind)
+    )""",
+    "CREATE TABLE IF NOT EXISTS processed_updates(update_id BIGINT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)",
+    """CREATE TABLE IF NOT EXISTS stock_moves(
+        id         BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        network    TEXT NOT NULL,
+        day        DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        memory_gb  INTEGER NOT NULL DEFAULT 0,
+        delta      INTEGER NOT NULL,
+        kind       TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_stock_moves_net_day ON stock_moves(network, day)",
+    """CREATE TABLE IF NOT EXISTS stock_checkpoints(
+        network TEXT NOT NULL,
+        day     DATE NOT NULL,
+        PRIMARY KEY(network, day)
+    )""",
+    """CREATE TABLE IF NOT EXISTS stock_checkpoint_rows(
+        network    TEXT NOT NULL,
+        day        DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        memory_gb  INTEGER NOT NULL,
+        qty        INTEGER NOT NULL,
+        PRIMARY KEY(network, day, product_id, memory_gb)
+    )""",
+    """CREATE TABLE IF NOT EXISTS leases(
+        name       TEXT PRIMARY KEY,
+        holder     TEXT NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL
+    )""",
+]
+
+# день в выгрузке — строкой YYYY-MM-DD, как в SQLite
+PG_EXPORT_QUERIES = {
+    "sales": """
+        SELECT s.id, s.occurred_at, s.day::text, s.network, s.tgid, p.name, s.memory_gb, s.qty, s.source_update_id
+        FROM sales s LEFT JOIN products p ON p.id=s.product_id
+        WHERE s.day>=$1 AND s.day<=$2 {net}
+    """,
+    "shipments": """
+        SELECT s.id, s.occurred_at, s.day::text, s.network, p.name, s.memory_gb, s.qty
+        FROM shipments s LEFT JOIN products p ON p.id=s.product_id
+        WHERE s.day>=$1 AND s.day<=$2 {net}
+    """,
+}
+
+# остаток сети на конец дня $2: последний чекпоинт не позже $2 + движения после него
+STOCK_AS_OF = """
+    WITH base AS (SELECT MAX(day) AS day FROM stock_checkpoints WHERE network=$1 AND day<=$2)
+    SELECT x.product_id, x.memory_gb, SUM(x.qty)::int AS qty FROM (
+        SELECT r.product_id, r.memory_gb, r.qty FROM stock_checkpoint_rows r, base
+        WHERE r.network=$1 AND r.day=base.day
+        UNION ALL
+        SELECT m.product_id, m.memory_gb, m.delta FROM stock_moves m, base
+        WHERE m.network=$1 AND m.day>COALESCE(base.day, '-infinity'::date) AND m.day<=$2
+    ) x GROUP BY x.product_id, x.memory_gb
+"""
+
+def asyncpg_dsn(url: str) -> str:
+    """URL в стиле SQLAlchemy (postgresql+psycopg2://...) -> DSN для asyncpg."""
+    return re.sub(r"^postgres(?:ql)?\+\w+://", "postgresql://", url)
+
+def _rowcount(status: str) -> int:
+    # asyncpg отдаёт статус команды: "INSERT 0 5", "DELETE 3"
+    tail = status.rsplit(" ", 1)[-1]
+    return int(tail) if tail.isdigit() else 0
+
+class _PgTx:
+    __slots__ = ("conn", "hooks")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.hooks: List[Callable[[], Any]] = []
+
+_PG_TX: contextvars.ContextVar[Optional[_PgTx]] = contextvars.ContextVar("pg_tx", default=None)
+
+# версия схемы — контрольная сумма DDL: любая правка SCHEMA прогонит его заново
+SCHEMA_VERSION = format(zlib.crc32("\n".join(SCHEMA).encode()), "08x")
+
+async def _schema_version(c) -> Optional[str]:
+    if await c.fetchval("SELECT to_regclass('meta')") is None:
+        return None
+    return await c.fetchval("SELECT value FROM meta WHERE key='schema_version'")
+
+def _op(fn):
+    """Метод Repo: время (вместе с ожиданием соединения из пула) — в метрики и трассу."""
+    name = fn.__name__
+    stage = "repo." + name
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kw):
+        t0 = time.perf_counter()
+        try:
+            with span(stage):
+                return await fn(self, *args, **kw)
+        finally:
+            metrics.REPO_SECONDS.observe(time.perf_counter() - t0, method=name)
+    return wrapper
+
+class PgRepo:
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self.dedup = UpdateDedup()
+        # версии кэшей bot.py — в meta, общие для реплик (см. db.Repo)
+        self._versions: Tuple[int, int, int] = (0, 0, 0)
+        self._versions_at = float("-inf")
+        self._bindings_seen: Optional[int] = None
+        self._people = TTLCache()
+        self._tg_net = TTLCache()
+        self._un_net = TTLCache()
+        self._networks = TTLCache()
+
+    @classmethod
+    async def connect(cls, dsn: str, min_size: int = PG_POOL_MIN, max_size: int = PG_POOL_MAX,
+                      **pool_kw) -> "PgRepo":
+        pool = await asyncpg.create_pool(asyncpg_dsn(dsn), min_size=min_size, max_size=max_size, **pool_kw)
+        repo = cls(pool)
+        async with pool.acquire() as c:
+            # схема не менялась с прошлого старта — ни DDL, ни блокировки
+            if await _schema_version(c) != SCHEMA_VERSION:
+                async with c.transaction():
+                    # реплики стартуют одновременно — DDL по очереди
+                    await c.execute("SELECT pg_advisory_xact_lock(hashtext('oppo_bot.schema'))")
+                    for sql in SCHEMA:
+                        await c.execute(sql)
+                    await c.execute("""
+                        INSERT INTO meta(key, value) VALUES('schema_version', $1)
+                        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+                    """, SCHEMA_VERSION)
+            await repo._load_dedup(c)
+        return repo
+
+    async def close(self):
+        await self._pool.close()
+
+    async def _bump(self, c, after, key: str):
+        await c.execute("""
+            INSERT INTO meta(key, value) VALUES($1, '1')
+            ON CONFLICT(key) DO UPDATE SET value=(meta.value::bigint + 1)::text
+        """, key)
+        after.append(self._versions_stale)
+
+    def _versions_stale(self):
+        self._versions_at = float("-inf")
+
+    async def cache_versions(self) -> Tuple[int, int, int]:
+        """(catalog_version, data_version, bindings_version) из meta, не чаще раза в CACHE_VERSION_SEC."""
+        now = time.monotonic()
+        if now - self._versions_at >= CACHE_VERSION_SEC:
+            async with self._pool.acquire() as c:  # мимо tx(): только закоммиченная версия
+                rows = await c.fetch("SELECT key, value FROM meta WHERE key = ANY($1::text[])", list(VERSION_KEYS))
+            v = {r["key"]: int(r["value"]) for r in rows}
+            self._versions = tuple(v.get(k, 0) for k in VERSION_KEYS)
+            self._versions_at = now
+        return self._versions
+
+    async def _sync_identity(self):
+        v = (await self.cache_versions())[2]
+        if v != self._bindings_seen:
+            self._bindings_seen = v
+            for cache in (self._people, self._tg_net, self._un_net, self._networks):
+                cache.invalidate()
+
+    @contextlib.asynccontextmanager
+    async def _write(self):
+        # (соединение, список after-commit хуков): внутри tx() — общие, иначе своя транзакция
+        state = _PG_TX.get()
+        if state is not None:
+            yield state.conn, state.hooks
+            return
+        hooks: List[Callable[[], Any]] = []
+        async with self._pool.acquire() as c:
+            async with c.transaction():
+                yield c, hooks
+        for hook in hooks:
+            hook()
+
+    @contextlib.asynccontextmanager
+    async def _read(self):
+        state = _PG_TX.get()
+        if state is not None:
+            yield state.conn
+            return
+        async with self._pool.acquire() as c:
+            yield c
+
+    async def _cached(self, cache: TTLCache, key, load):
+        if _PG_TX.get() is not None:
+            return await load()
+        await self._sync_identity()
+        v = cache.get(key)
+        if v is _MISS:
+            gen = cache.gen
+            v = await load()
+            cache.put(key, v, gen)
+        return v
+
+    async def _load_dedup(self, c):
+        hwm = await c.fetchval("SELECT value FROM meta WHERE key='dedup_hwm'")
+        if hwm is None:
+            hwm = await c.fetchval("SELECT MAX(update_id) FROM processed_updates")
+        recent = []
+        if hwm is not None:
+            recent = [r[0] for r in await c.fetch(
+                "SELECT update_id FROM processed_updates WHERE update_id > $1", int(hwm) - self.dedup.window)]
+        self.dedup.load(int(hwm) if hwm is not None else None, recent)
+
+    # ---------- утилиты ----------
+    @contextlib.asynccontextmanager
+    async def tx(self):
+        # все вызовы Repo внутри блока идут одной транзакцией на одном соединении
+        state = _PG_TX.get()
+        if state is not None:
+            # вложенный блок — SAVEPOINT (asyncpg делает его сам для вложенной transaction())
+            async with state.conn.transaction():
+                yield
+            return
+        async with self._pool.acquire() as c:
+            state = _PgTx(c)
+            token = _PG_TX.set(state)
+            try:
+                async with c.transaction():
+                    yield
+            finally:
+                _PG_TX.reset(token)
+        for hook in state.hooks:
+            hook()
+
+    # ---------- люди / привязки ----------
+    async def get_person_by_tg(self, tgid: int) -> Person:
+        tgid = str(tgid)
+        return await self._cached(self._people, tgid, lambda: self._person_or_create(tgid))
+
+    @_op
+    async def _person_or_create(self, tgid: str) -> Person:
+        async with self._write() as (c, _):
+            await c.execute("INSERT INTO people(tgid) VALUES($1) ON CONFLICT DO NOTHING", tgid)
+            r = await c.fetchrow("SELECT tgid, username FROM people WHERE tgid=$1", tgid)
+        return Person(id=r["tgid"], username=r["username"])
+
+    @_op
+    async def bind_by_tgid(self, tgid: int, network: str):
+        tgid = str(tgid)
+        async with self._write() as (c, after):
+            await c.execute("INSERT INTO people(tgid) VALUES($1) ON CONFLICT DO NOTHING", tgid)
+            await c.execute("INSERT INTO networks(name) VALUES($1) ON CONFLICT DO NOTHING", network)
+            await c.execute("""
+                INSERT INTO person_network(tgid, network) VALUES($1,$2)
+                ON CONFLICT(tgid) DO UPDATE SET network=excluded.network
+            """, tgid, network)
+            await self._bump(c, after, "bindings_version")
+            after.append(lambda: (self._tg_net.invalidate(tgid), self._networks.invalidate(network)))
+
+    @_op
+    async def bind_by_username(self, username: str, network: str):
+        u = (username or "").lstrip("@")
+        async with self._write() as (c, after):
+            await c.execute("INSERT INTO networks(name) VALUES($1) ON CONFLICT DO NOTHING", network)
+            await c.execute("""
+                INSERT INTO username_network(username, network) VALUES($1,$2)
+                ON CONFLICT(username) DO UPDATE SET network=excluded.network
+            """, u, network)
+            await self._bump(c, after, "bindings_version")
+            after.append(lambda: (self._un_net.invalidate(u), self._networks.invalidate(network)))
+
+    @_op
+    async def import_bindings(self, rows: List[Tuple[str, str]]) -> int:
+        """Пакет привязок из файла: [(tgid или @username, сеть)] одной транзакцией."""
+        by_tg = [(str(ident), net) for ident, net in rows if str(ident).isdigit()]
+        by_un = [(str(ident).lstrip("@"), net) for ident, net in rows if not str(ident).isdigit()]
+        async with self._write() as (c, after):
+            await c.execute("INSERT INTO networks(name) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING",
+                            sorted({net for _, net in rows}))
+            await c.execute("INSERT INTO people(tgid) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING",
+                            [tg for tg, _ in by_tg])
+            await c.executemany("""
+                INSERT INTO person_network(tgid, network) VALUES($1,$2)
+                ON CONFLICT(tgid) DO UPDATE SET network=excluded.network
+            """, by_tg)
+            await c.executemany("""
+                INSERT INTO username_network(username, network) VALUES($1,$2)
+                ON CONFLICT(username) DO UPDATE SET network=excluded.network
+            """, by_un)
+            await self._bump(c, after, "bindings_version")
+            after.append(lambda: (self._tg_net.invalidate(), self._un_net.invalidate(), self._networks.invalidate()))
+        return len(rows)
+
+    async def get_network_by_username(self, username: str) -> Optional[str]:
+        u = (username or "").lstrip("@")
+        return await self._cached(self._un_net, u, lambda: self._network_by_username(u))
+
+    @_op
+    async def _network_by_username(self, u: str) -> Optional[str]:
+        async with self._read() as c:
+            return await c.fetchval("SELECT network FROM username_network WHERE username=$1", u)
+
+    async def get_primary_network_for_person(self, person_id: str) -> Optional[str]:
+        tgid = str(person_id)
+        return await self._cached(self._tg_net, tgid, lambda: self._network_for_person(tgid))
+
+    @_op
+    async def _network_for_person(self, tgid: str) -> Optional[str]:
+        async with self._read() as c:
+            return await c.fetchval("SELECT network FROM person_network WHERE tgid=$1", tgid)
+
+    @_op
+    async def ensure_network(self, name: str, city: Optional[str]=None, address: Optional[str]=None):
+        async with self._write() as (c, after):
+            await c.execute("""
+                INSERT INTO networks(name, city, address) VALUES($1,$2,$3)
+                ON CONFLICT(name) DO UPDATE SET
+                    city=COALESCE(excluded.city, networks.city),
+                    address=COALESCE(excluded.address, networks.address)
+            """, name, city, address)
+            await self._bump(c, after, "bindings_version")
+            after.append(lambda: self._networks.invalidate(name))
+
+    async def get_network(self, name: str) -> Dict[str, Any]:
+        return dict(await self._cached(self._networks, name, lambda: self._load_network(name)))
+
+    @_op
+    async def _load_network(self, name: str) -> Dict[str, Any]:
+        async with self._read() as c:
+            r = await c.fetchrow("SELECT name, city, address, initialized FROM networks WHERE name=$1", name)
+        return dict(r) if r else {"name": name, "city": None, "address": None, "initialized": 0}
+
+    async def warm_caches(self) -> List[str]:
+        """Заполнить кэши людей, привязок и сетей одним проходом (прогрев после старта); -> сети."""
+        await self._sync_identity()
+        gens = (self._people.gen, self._tg_net.gen, self._networks.gen)
+        people, networks = await self._identity_rows(IDENTITY_CACHE_SIZE)
+        for r in people:
+            self._people.put(r["tgid"], Person(id=r["tgid"], username=r["username"]), gens[0])
+            self._tg_net.put(r["tgid"], r["network"], gens[1])
+        for r in networks:
+            self._networks.put(r["name"], dict(r), gens[2])
+        return [r["name"] for r in networks]
+
+    @_op
+    async def _identity_rows(self, limit: int):
+        async with self._read() as c:
+            people = await c.fetch("""
+                SELECT p.tgid, p.username, pn.network
+                FROM people p LEFT JOIN person_network pn ON pn.tgid=p.tgid
+                LIMIT $1
+            """, limit)
+            networks = await c.fetch("SELECT name, city, address, initialized FROM networks LIMIT $1", limit)
+        return people, networks
+
+    # ---------- продукты/алиасы ----------
+    @_op
+    async def get_product_candidates_with_aliases(self) -> List[Tuple[int, str]]:
+        async with self._read() as c:
+            rows = [(r["id"], r["name"]) for r in await c.fetch("SELECT id, name FROM products ORDER BY id")]
+            rows += [(r["product_id"], r["alias"]) for r in await c.fetch(
+                "SELECT product_id, alias FROM aliases ORDER BY product_id, alias")]
+        return rows
+
+    @_op
+    async def get_network_stock_candidates(self, network: str) -> List[Tuple[int, str]]:
+        async with self._read() as c:
+            rows = await c.fetch("""
+                SELECT DISTINCT s.product_id, p.name
+                FROM stock s JOIN products p ON p.id=s.product_id
+                WHERE s.network=$1
+                ORDER BY s.product_id
+            """, network)
+        return [(r["product_id"], r["name"]) for r in rows]
+
+    @_op
+    async def ensure_product(self, canonical_name: str, alias: Optional[str]=None) -> int:
+        async with self._write() as (c, after):
+            pid = await self._ensure_product(c, canonical_name)
+            if alias:
+                await self._ensure_aliases(c, [alias], [pid])
+            await self._bump(c, after, "catalog_version")
+        return pid
+
+    @_op
+    async def import_catalog(self, rows: List[Tuple[str, List[str]]]) -> int:
+        """Пакет каталога из файла: [(каноническое имя, [алиасы])] одной транзакцией."""
+        names = list(dict.fromkeys(name for name, _ in rows))
+        async with self._write() as (c, after):
+            # только новые имена: ON CONFLICT по существующим тратил бы значения identity
+            await c.execute("""
+                INSERT INTO products(name)
+                SELECT n FROM unnest($1::text[]) WITH ORDINALITY AS t(n, i)
+                WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.name=t.n)
+                ORDER BY t.i
+                ON CONFLICT(name) DO NOTHING
+            """, names)
+            ids = {r["name"]: r["id"] for r in await c.fetch(
+                "SELECT id, name FROM products WHERE name = ANY($1::text[])", names)}
+            # один алиас дважды — побеждает последний, как при поштучной вставке
+            aliases = {alias: ids[name] for name, al in rows for alias in al}
+            await self._ensure_aliases(c, list(aliases), list(aliases.values()))
+            await self._bump(c, after, "catalog_version")
+        return len(rows)
+
+    @staticmethod
+    async def _ensure_product(c, canonical_name: str) -> int:
+        pid = await c.fetchval("SELECT id FROM products WHERE name=$1", canonical_name)
+        if pid is None:
+            pid = await c.fetchval("INSERT INTO products(name) VALUES($1) ON CONFLICT(name) DO NOTHING RETURNING id",
+                                   canonical_name)
+            if pid is None:  # вставили параллельно
+                pid = await c.fetchval("SELECT id FROM products WHERE name=$1", canonical_name)
+        return int(pid)
+
+    @staticmethod
+    async def _ensure_aliases(c, aliases: List[str], pids: List[int]):
+        if aliases:
+            await c.execute("""
+                INSERT INTO aliases(alias, product_id) SELECT * FROM unnest($1::text[], $2::int[])
+                ON CONFLICT(alias) DO UPDATE SET product_id=excluded.product_id
+            """, aliases, pids)
+
+    # ---------- сток ----------
+    @_op
+    async def add_stock(self, network: str, product_id: int, memory_gb: int, delta: int, *,
+                        day: date, kind: str = "adjust") -> int:
+        async with self._write() as (c, after):
+            levels = await self._apply_stock_deltas(c, after, network, kind, day, [(product_id, memory_gb, delta)])
+        return levels[(int(product_id), int(memory_gb or 0))]
+
+    @staticmethod
+    async def _log_moves(c, network: str, day: date, kind: str, moves: List[Tuple[int, int, int]]):
+        moves = [(int(pid), int(mem or 0), int(delta)) for pid, mem, delta in moves if delta]
+        if moves:
+            await c.execute("""
+                INSERT INTO stock_moves(network, day, product_id, memory_gb, delta, kind)
+                SELECT $1, $2, * , $6 FROM unnest($3::int[], $4::int[], $5::int[])
+            """, network, day, [m[0] for m in moves], [m[1] for m in moves],
+                [m[2] for m in moves], kind)
+
+    async def _apply_stock_deltas(self, c, after, network: str, kind: str, day: date,
+                                  moves: List[Tuple[int, int, int]]) -> Dict[Tuple[int, int], int]:
+        """Все дельты одним upsert; возвращает итоговые остатки {(pid, mem): qty}."""
+        # один SKU дважды в пачке — складываем: ON CONFLICT не обновит строку второй раз
+        agg: Dict[Tuple[int, int], int] = {}
+        for pid, mem, delta in moves:
+            key = (int(pid), int(mem or 0))
+            agg[key] = agg.get(key, 0) + int(delta)
+        await self._log_moves(c, network, day, kind, moves)
+        rows = await c.fetch("""
+            INSERT INTO stock(network, product_id, memory_gb, qty, updated_at)
+            SELECT $1, t.pid, t.mem, t.delta, now() FROM unnest($2::int[], $3::int[], $4::int[]) AS t(pid, mem, delta)
+            ON CONFLICT(network, product_id, memory_gb)
+            DO UPDATE SET qty=stock.qty+excluded.qty, updated_at=excluded.updated_at
+            RETURNING product_id, memory_gb, qty, (xmax = 0) AS inserted
+        """, network, [k[0] for k in agg], [k[1] for k in agg], list(agg.values()))
+        await self._bump(c, after, "data_version")
+        if any(r["inserted"] for r in rows):
+            await self._bump(c, after, "catalog_version")
+        return {(r["product_id"], r["memory_gb"]): r["qty"] for r in rows}
+
+    @_op
+    async def replace_stock_snapshot(self, network: str, rows: List[Tuple[int,int,int]], *,
+                                     day: date) -> StockDiff:
+        async with self._write() as (c, after):
+            old = {(r["product_id"], r["memory_gb"]): r["qty"] for r in await c.fetch(
+                "SELECT product_id, memory_gb, qty FROM stock WHERE network=$1 FOR UPDATE", network)}
+            diff = StockDiff.between(old, rows)
+            if diff.removed:
+                await c.execute("""
+                    DELETE FROM stock WHERE network=$1
+                    AND (product_id, memory_gb) IN (SELECT * FROM unnest($2::int[], $3::int[]))
+                """, network, [pid for pid, _, _ in diff.removed], [mem for _, mem, _ in diff.removed])
+            upsert = diff.added + [(pid, mem, qty) for pid, mem, _, qty in diff.changed]
+            if upsert:
+                await c.execute("""
+                    INSERT INTO stock(network, product_id, memory_gb, qty, updated_at)
+                    SELECT $1, *, now() FROM unnest($2::int[], $3::int[], $4::int[])
+                    ON CONFLICT(network, product_id, memory_gb)
+                    DO UPDATE SET qty=excluded.qty, updated_at=excluded.updated_at
+                """, network, [u[0] for u in upsert], [u[1] for u in upsert], [u[2] for u in upsert])
+            await self._log_moves(c, network, day, "snapshot",
+                                  [(pid, mem, qty) for pid, mem, qty in diff.added]
+                                  + [(pid, mem, qty - was) for pid, mem, was, qty in diff.changed]
+                                  + [(pid, mem, -was) for pid, mem, was in diff.removed])
+            if diff:
+                await self._bump(c, after, "data_version")
+            if diff.added or diff.removed:
+                await self._bump(c, after, "catalog_version")
+        return diff
+
+    @_op
+    async def set_network_initialized(self, network: str, flag: bool):
+        async with self._write() as (c, after):
+            await c.execute("UPDATE networks SET initialized=$1 WHERE name=$2", 1 if flag else 0, network)
+            await self._bump(c, after, "bindings_version")
+            after.append(lambda: self._networks.invalidate(network))
+
+    @_op
+    async def clear_prompt_flags(self, network: str):
+        async with self._write() as (c, _):
+            await c.execute("DELETE FROM prompts WHERE network=$1", network)
+
+    @_op
+    async def get_stock_table(self, network: Optional[str],
+                              as_of: Optional[date] = None) -> List[Tuple[str, Optional[int], int]]:
+        """Сток сети сейчас или, с as_of, на конец этого дня (по журналу движений)."""
+        if not network:
+            return []
+        async with self._read() as c:
+            if as_of is None:
+                recs = await c.fetch("""
+                    SELECT p.name, s.memory_gb AS mem, s.qty
+                    FROM stock s JOIN products p ON p.id=s.product_id
+                    WHERE s.network=$1
+                """, network)
+            else:
+                recs = await c.fetch(f"""
+                    SELECT p.name, a.memory_gb AS mem, a.qty
+                    FROM ({STOCK_AS_OF}) a LEFT JOIN products p ON p.id=a.product_id
+                    WHERE a.qty<>0
+                """, network, as_of)
+        rows = [(r["name"], r["mem"], r["qty"]) for r in recs]
+        rows.sort(key=lambda r: (r[0] or "", r[1]))
+        return rows
+
+    @_op
+    async def checkpoint_stock(self, day: date) -> int:
+        """Чекпоинт остатков на конец day для сетей, у которых с прошлого чекпоинта были движения."""
+        async with self._write() as (c, _):
+            nets = [r["name"] for r in await c.fetch("""
+                SELECT n.name FROM networks n
+                WHERE NOT EXISTS (SELECT 1 FROM stock_checkpoints k WHERE k.network=n.name AND k.day=$1)
+                  AND EXISTS (
+                      SELECT 1 FROM stock_moves m
+                      WHERE m.network=n.name AND m.day<=$1
+                        AND m.day>COALESCE((SELECT MAX(k.day) FROM stock_checkpoints k
+                                            WHERE k.network=n.name AND k.day<$1), '-infinity'::date))
+            """, day)]
+            for net in nets:
+                # сначала строки: STOCK_AS_OF не должен увидеть ещё пустой чекпоинт этого же дня
+                await c.execute(f"""
+                    INSERT INTO stock_checkpoint_rows(network, day, product_id, memory_gb, qty)
+                    SELECT $1, $2, a.product_id, a.memory_gb, a.qty FROM ({STOCK_AS_OF}) a WHERE a.qty<>0
+                """, net, day)
+                await c.execute("INSERT INTO stock_checkpoints(network, day) VALUES($1,$2)", net, day)
+        return len(nets)
+
+    # ---------- продажи/поставки ----------
+    @_op
+    async def insert_sale(self, occurred_at: datetime, day: date, person_id: str,
+                          network_id: str, product_id: int, memory_gb: int, qty: int,
+                          source_update_id: int):
+        async with self._write() as (c, after):
+            await c.execute("""
+                INSERT INTO sales(occurred_at,day,tgid,network,product_id,memory_gb,qty,source_update_id)
+                VALUES($1,$2,$3,$4,$5,$6,$7,$8)
+            """, occurred_at.isoformat(), day, str(person_id), network_id, product_id, memory_gb or 0,
+                int(qty), source_update_id)
+            await self._add_sales_daily(c, network_id, day, int(qty))
+            await c.execute("UPDATE people SET last_sale=$1 WHERE tgid=$2", day, str(person_id))
+            await self._bump(c, after, "data_version")
+
+    @_op
+    async def insert_sales_batch(self, occurred_at: datetime, day: date, person_id: str,
+                                 network_id: str, items: List[Tuple[int,int,int]],
+                                 source_update_id: int) -> List[int]:
+        # items: [(product_id, mem, qty)] — все строки сообщения одной транзакцией.
+        # Возвращает новые остатки в порядке items.
+        if not items:
+            return []
+        async with self._write() as (c, after):
+            await c.execute("""
+                INSERT INTO sales(occurred_at,day,tgid,network,product_id,memory_gb,qty,source_update_id)
+                SELECT $1, $2, $3, $4, t.pid, t.mem, t.qty, $8 FROM unnest($5::int[], $6::int[], $7::int[]) AS t(pid, mem, qty)
+            """, occurred_at.isoformat(), day, str(person_id), network_id, [int(pid) for pid, _, _ in items],
+                [int(mem or 0) for _, mem, _ in items], [int(qty) for _, _, qty in items], source_update_id)
+            levels = await self._apply_stock_deltas(c, after, network_id, "sale", day,
+                                                    [(pid, mem, -int(qty)) for pid, mem, qty in items])
+            await self._add_sales_daily(c, network_id, day, sum(int(qty) for _, _, qty in items))
+            await c.execute("UPDATE people SET last_sale=$1 WHERE tgid=$2", day, str(person_id))
+            # data_version уже поднял _apply_stock_deltas — один раз на сообщение
+        # остаток после каждой строки, как при поштучном списании: идём с конца от итогового
+        out: List[int] = []
+        for pid, mem, qty in reversed(items):
+            key = (int(pid), int(mem or 0))
+            out.append(levels[key])
+            levels[key] += int(qty)
+        return out[::-1]
+
+    @staticmethod
+    async def _add_sales_daily(c, network: str, day: date, qty: int):
+        await c.execute("""
+            INSERT INTO sales_daily(network, day, qty) VALUES($1,$2,$3)
+            ON CONFLICT(network, day) DO UPDATE SET qty=sales_daily.qty+excluded.qty
+        """, network, day, qty)
+
+    @_op
+    async def rebuild_sales_daily(self) -> int:
+        """Пересобрать свод из сырых sales; возвращает число строк свода."""
+        async with self._write() as (c, after):
+            await c.execute("DELETE FROM sales_daily")
+            n = _rowcount(await c.execute("""
+                INSERT INTO sales_daily(network, day, qty)
+                SELECT network, day, SUM(qty) FROM sales GROUP BY network, day
+            """))
+            await self._bump(c, after, "data_version")
+        return n
+
+    @_op
+    async def insert_shipment(self, occurred_at: datetime, day: date,
+                              network_id: str, product_id: int, memory_gb: int, qty: int):
+        async with self._write() as (c, after):
+            await c.execute("""
+                INSERT INTO shipments(occurred_at,day,network,product_id,memory_gb,qty)
+                VALUES($1,$2,$3,$4,$5,$6)
+            """, occurred_at.isoformat(), day, network_id, product_id, memory_gb or 0, int(qty))
+            await self._bump(c, after, "data_version")
+
+    @_op
+    async def touch_last_sale(self, person_id: str):
+        async with self._write() as (c, _):
+            await c.execute("UPDATE people SET last_sale=$1 WHERE tgid=$2", date.today(), str(person_id))
+
+    # ---------- выгрузка ----------
+    async def iter_export(self, kind: str, start: date, end: date, network: Optional[str] = None,
+                          batch: int = EXPORT_BATCH) -> AsyncIterator[List[Tuple]]:
+        """Строки sales/shipments за [start, end] пачками по batch; первая пачка — [заголовок].
+
+        Серверный курсор в read-only транзакции: в памяти одна пачка.
+        """
+        header = EXPORT_QUERIES[kind][0]
+        sql = PG_EXPORT_QUERIES[kind].format(net="AND s.network=$3" if network else "")
+        args: List[Any] = [start, end] + ([network] if network else [])
+        async with self._pool.acquire() as c:
+            async with c.transaction(readonly=True):
+                cur = await c.cursor(sql, *args)
+                yield [tuple(header.split(","))]
+                while True:
+                    rows = await cur.fetch(batch)
+                    if not rows:
+                        break
+                    yield [tuple(r) for r in rows]
+
+    # ---------- отчёты ----------
+    async def _sales_totals(self, start: date, end: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        # сумма за [start, end) из свода, GROUP BY на сервере
+        async with self._read() as c:
+            rows = await c.fetch("""
+                SELECT network, SUM(qty)::int AS s FROM sales_daily
+                WHERE day>=$1 AND day<$2 AND ($3::text IS NULL OR network=$3)
+                GROUP BY network
+                ORDER BY s DESC, network
+            """, start, end, only_network)
+        return [(r["network"], r["s"]) for r in rows]
+
+    @_op
+    async def get_sales_by_network_day(self, d: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        return await self._sales_totals(d, d + timedelta(days=1), only_network)
+
+    @_op
+    async def get_sales_by_network_week(self, today: date, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        start = today - timedelta(days=today.weekday())
+        return await self._sales_totals(start, start + timedelta(days=7), only_network)
+
+    @_op
+    async def get_sales_by_network_month(self, y: int, m: int, only_network: Optional[str]) -> List[Tuple[str,int]]:
+        end = date(y+1, 1, 1) if m == 12 else date(y, m+1, 1)
+        return await self._sales_totals(date(y, m, 1), end, only_network)
+
+    @_op
+    async def set_plan(self, network: str, y: int, m: int, plan: int):
+        async with self._write() as (c, _):
+            await c.execute("""
+                INSERT INTO plans(network,year,month,plan) VALUES($1,$2,$3,$4)
+                ON CONFLICT(network,year,month) DO UPDATE SET plan=excluded.plan
+            """, network, y, m, int(plan))
+
+    @_op
+    async def get_stale_people_by_network(self, days: int=4,
+                                          per_network: Optional[Dict[str, int]] = None) -> Dict[str, List[str]]:
+        """Продавцы без продаж дольше порога: days по умолчанию, per_network — свой порог сети."""
+        today = date.today()
+        cutoffs = {net: (today - timedelta(days=d)).isoformat() for net, d in (per_network or {}).items()}
+        default = today - timedelta(days=days)
+        widest = max([default, *(date.fromisoformat(v) for v in cutoffs.values())])
+        async with self._read() as c:
+            recs = await c.fetch("""
+                SELECT pn.network, p.username, p.tgid
+                FROM people p
+                JOIN person_network pn ON pn.tgid=p.tgid
+                LEFT JOIN jsonb_each_text($1::jsonb) t ON t.key=pn.network
+                WHERE (p.last_sale IS NULL OR p.last_sale < $2)
+                  AND pn.network IS NOT NULL
+                  AND (p.last_sale IS NULL OR p.last_sale < COALESCE(t.value::date, $3))
+            """, json.dumps(cutoffs), widest, default)
+        res: Dict[str, List[str]] = {}
+        for r in recs:
+            res.setdefault(r["network"], []).append(f"@{r['username']}" if r["username"] else r["tgid"])
+        return res
+
+    # ---------- напоминания ----------
+    @_op
+    async def prompt_needed_today(self, network: str, kind: str="negative") -> bool:
+        # один upsert: строка вернётся, только если сегодня ещё не напоминали
+        async with self._write() as (c, _):
+            return await c.fetchval("""
+                INSERT INTO prompts(network,kind,last_date) VALUES($1,$2,$3)
+                ON CONFLICT(network,kind) DO UPDATE SET last_date=excluded.last_date
+                WHERE prompts.last_date IS DISTINCT FROM excluded.last_date
+                RETURNING true
+            """, network, kind, date.today()) is not None
+
+    # ---------- аренды (лидер среди реплик) ----------
+    @_op
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду name на ttl секунд; False — её держит другой и она не истекла."""
+        # время — по часам сервера БД, общим для всех реплик
+        async with self._write() as (c, _):
+            return await c.fetchval("""
+                INSERT INTO leases(name, holder, expires_at) VALUES($1, $2, now() + make_interval(secs => $3))
+                ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+                WHERE leases.holder=excluded.holder OR leases.expires_at<now()
+                RETURNING true
+            """, name, holder, float(ttl)) is not None
+
+    @_op
+    async def release_lease(self, name: str, holder: str):
+        async with self._write() as (c, _):
+            await c.execute("DELETE FROM leases WHERE name=$1 AND holder=$2", name, holder)
+
+    # ---------- long polling ----------
+    @_op
+    async def get_poll_offset(self) -> Optional[int]:
+        async with self._read() as c:
+            v = await c.fetchval("SELECT value FROM meta WHERE key='poll_offset'")
+        return int(v) if v is not None else None
+
+    @_op
+    async def set_poll_offset(self, offset: int):
+        async with self._write() as (c, _):
+            await c.execute("""
+                INSERT INTO meta(key, value) VALUES('poll_offset', $1)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            """, str(offset))
+
+    # ---------- антидубль ----------
+    async def mark_and_check_update(self, update_id: int) -> bool:
+        if self.dedup.check_and_mark(update_id):
+            return True
+        if not DEDUP_SHARED:
+            return False
+        try:
+            return not await self._claim_update(update_id)
+        except BaseException:
+            self.dedup.unmark(update_id)
+            raise
+
+    @_op
+    async def _claim_update(self, update_id: int) -> bool:
+        async with self._write() as (c, _):
+            return await c.fetchval("""
+                INSERT INTO processed_updates(update_id) VALUES($1) ON CONFLICT DO NOTHING RETURNING true
+            """, update_id) is not None
+
+    async def flush_dedup(self):
+        ids = self.dedup.take_pending()
+        if ids:
+            try:
+                await self._save_dedup(ids, self.dedup.hwm)
+            except Exception:
+                self.dedup.pending[:0] = ids
+                raise
+
+    @_op
+    async def _save_dedup(self, ids: List[int], hwm: int):
+        async with self._write() as (c, _):
+            await c.execute("INSERT INTO processed_updates(update_id) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING",
+                            ids)
+            await c.execute("""
+                INSERT INTO meta(key, value) VALUES('dedup_hwm', $1)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            """, str(hwm))
+
+    @_op
+    async def prune_processed_updates(self) -> int:
+        """Удалить id старше окна антидубля и хвост прежней последовательности после сброса
+        update_id (плановая задача, не на каждый апдейт)."""
+        async with self._write() as (c, _):
+            hwm = await c.fetchval("SELECT value FROM meta WHERE key='dedup_hwm'")
+            if hwm is None:
+                return 0
+            hwm = int(hwm)
+            return _rowcount(await c.execute("DELETE FROM processed_updates WHERE update_id <= $1 OR update_id > $2",
+                                             hwm - self.dedup.window, hwm + self.dedup.window))
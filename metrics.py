@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики в текстовом формате Prometheus — без зависимостей.
+
+Counter/Histogram обновляются из любого потока (писатель и читатели БД тоже),
+поэтому под локом. Для счётчиков, которые уже живут в других объектах
+(outbox.stats, кэши), есть collect(): функция отдаёт значения в момент выдачи /metrics.
+"""
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# секунды: от быстрого SQL до медленной отправки
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+        self._collectors: List[Tuple[str, str, str, Callable[[], Iterable[Tuple[Dict[str, object], float]]]]] = []
+
+    def register(self, metric: "_Metric") -> "_Metric":
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, name: str, kind: str, help: str,
+                fn: Callable[[], Iterable[Tuple[Dict[str, object], float]]]):
+        """Значения снимаются fn() при каждой выдаче: [(labels, value)]."""
+        self._collectors.append((name, kind, help, fn))
+
+    def render(self) -> str:
+        out: List[str] = []
+        for m in self._metrics:
+            out.extend(m.render())
+        for name, kind, help, fn in self._collectors:
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            try:
+                samples = list(fn())
+            except Exception:  # источник ещё не готов (до on_startup) — пропускаем
+                samples = []
+            for labels, value in samples:
+                out.append(f"{name}{_fmt_labels(_key(labels))} {_fmt_value(value)}")
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, registry)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelKey, List[float]] = {}  # [счётчики корзин..., +Inf, сумма]
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            v[i] += 1  # корзина, куда попало значение; накопительные суммы — при выдаче
+            v[-1] += value
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        out = self._header()
+        for key, v in values:
+            acc = 0.0
+            for bound, n in zip(self.buckets, v):
+                acc += n
+                out.append(f"{self.name}_bucket{_fmt_labels(key, (('le', _fmt_value(bound)),))} {_fmt_value(acc)}")
+            acc += v[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_fmt_labels(key, (('le', '+Inf'),))} {_fmt_value(acc)}")
+            out.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(v[-1])}")
+            out.append(f"{self.name}_count{_fmt_labels(key)} {_fmt_value(acc)}")
+        return out
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist: Histogram, labels: Dict[str, object]):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+        return False
+
+
+def timed(hist: Histogram, **labels):
+    """Декоратор корутины: длительность каждого вызова — в hist."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kw):
+            with hist.time(**labels):
+                return await fn(*args, **kw)
+        return wrapper
+    return deco
+
+
+# ---------- метрики, общие для модулей ----------
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта по обработчикам")
+REPO_SECONDS = Histogram("repo_method_seconds", "Время выполнения метода Repo в потоке БД")
+FUZZY_SECONDS = Histogram("fuzzy_resolve_seconds", "Сопоставление моделей сообщения (resolve_products_batch)")
+FUZZY_MATCHES = Counter("fuzzy_matches_total", "Итог сопоставления строки: stock (>=82), catalog (>=90), miss")
+JOB_SECONDS = Histogram("scheduler_job_seconds", "Длительность плановых задач",
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+JOB_FAILURES = Counter("scheduler_job_failures_total", "Плановые задачи, упавшие с исключением")
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Очередь исходящих сообщений: лимиты Telegram, приоритеты, retry_after.
+
+Обработчик кладёт сообщение в очередь и сразу возвращается. У каждого чата свой
+воркер и своё ведро токенов (группы ~20/мин, личка ~1/с), поверх — общее ведро
+на бота (~30/с), которое раздаёт слоты по приоритету: ответы на команды раньше
+уведомлений, уведомления раньше плановых сводок.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError,
+)
+
+log = logging.getLogger("outbox")
+
+# приоритеты: меньше — раньше
+PRIO_REPLY = 0    # ответы на команды
+PRIO_NOTICE = 1   # уведомления из обработчиков сообщений
+PRIO_DIGEST = 2   # сводки и напоминания по расписанию
+
+MAX_NET_RETRIES = 3       # сетевые/5xx ошибки
+MAX_FLOOD_RETRIES = 5     # подряд полученные 429
+CHAT_IDLE_SEC = 60.0      # воркер чата без сообщений столько секунд — завершается
+
+
+class TokenBucket:
+    """Ведро с резервированием: take() списывает токен и говорит, сколько ждать."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Chat:
+    __slots__ = ("queue", "bucket", "task")
+
+    def __init__(self, bucket: TokenBucket):
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.bucket = bucket
+        self.task: Optional[asyncio.Task] = None
+
+
+class Outbox:
+    def __init__(self, bot: Bot, global_rate: float = 30.0, group_per_min: float = 20.0,
+                 private_per_sec: float = 1.0):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.group_per_min = group_per_min
+        self.private_per_sec = private_per_sec
+        self._chats: Dict[int, _Chat] = {}
+        self._seq = itertools.count()
+        self._slots: Optional[asyncio.PriorityQueue] = None  # (prio, seq, future) — ждут общий слот
+        self._pump: Optional[asyncio.Task] = None
+        self._paused_until = 0.0  # глобальный 429: все ждут до этого момента
+        self._inflight = 0
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "dropped": 0, "flood": 0}
+
+    def send(self, chat_id: int, text: str, prio: int = PRIO_NOTICE, **kw: Any) -> asyncio.Future:
+        """Поставить сообщение в очередь; future резолвится отправленным Message или None."""
+        if self._pump is None:
+            self._slots = asyncio.PriorityQueue()
+            self._pump = asyncio.create_task(self._run_pump())
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # id групп и каналов отрицательные
+            bucket = (TokenBucket(self.group_per_min / 60.0, 3) if chat_id < 0
+                      else TokenBucket(self.private_per_sec, 3))
+            chat = self._chats[chat_id] = _Chat(bucket)
+        fut = asyncio.get_running_loop().create_future()
+        chat.queue.put_nowait((prio, next(self._seq), text, kw, fut))
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._run_chat(chat_id, chat))
+        self.stats["queued"] += 1
+        return fut
+
+    def pending(self) -> int:
+        return self._inflight + sum(ch.queue.qsize() for ch in self._chats.values())
+
+    async def _run_pump(self):
+        bucket = TokenBucket(self.global_rate, 5)
+        while True:
+            _, _, fut = await self._slots.get()
+            if fut.done():
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            wait = bucket.take()
+            if wait:
+                await asyncio.sleep(wait)
+            fut.set_result(None)
+
+    async def _global_slot(self, prio: int):
+        fut = asyncio.get_running_loop().create_future()
+        self._slots.put_nowait((prio, next(self._seq), fut))
+        await fut
+
+    async def _run_chat(self, chat_id: int, chat: _Chat):
+        try:
+            while True:
+                try:
+                    prio, _, text, kw, fut = await asyncio.wait_for(chat.queue.get(), CHAT_IDLE_SEC)
+                except asyncio.TimeoutError:
+                    if chat.queue.empty():
+                        return
+                    continue
+                self._inflight += 1
+                try:
+                    msg = await self._deliver(chat_id, chat, prio, text, kw)
+                finally:
+                    self._inflight -= 1
+                if not fut.done():
+                    fut.set_result(msg)
+        finally:
+            chat.task = None
+            if chat.queue.empty() and self._chats.get(chat_id) is chat:
+                del self._chats[chat_id]
+
+    async def _deliver(self, chat_id: int, chat: _Chat, prio: int, text: str, kw: Dict[str, Any]):
+        net_errors = flood = 0
+        while True:
+            wait = chat.bucket.take()
+            if wait:
+                await asyncio.sleep(wait)
+            await self._global_slot(prio)
+            try:
+                msg = await self.bot.send_message(chat_id, text, **kw)
+                self.stats["sent"] += 1
+                return msg
+            except TelegramRetryAfter as e:
+                self.stats["flood"] += 1
+                flood += 1
+                if flood > MAX_FLOOD_RETRIES:
+                    break
+                log.warning("429 for chat %s, retry after %ss", chat_id, e.retry_after)
+                # Telegram считает лимит и на бота целиком — притормозим всех
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                net_errors += 1
+                if net_errors > MAX_NET_RETRIES:
+                    log.warning("send to %s failed after %d retries: %s", chat_id, MAX_NET_RETRIES, e)
+                    break
+                await asyncio.sleep(min(2 ** net_errors, 10))
+            except (TelegramBadRequest, TelegramForbiddenError) as e:
+                # повтор не поможет: кривой текст, бота выгнали из чата и т.п.
+                log.warning("send to %s rejected: %s", chat_id, e)
+                break
+            except Exception as e:
+                log.exception("send to %s failed: %s", chat_id, e)
+                break
+            self.stats["retried"] += 1
+        self.stats["dropped"] += 1
+        return None
+
+    async def close(self, timeout: float = 5.0):
+        """Дождаться отправки очереди (не дольше timeout) и остановить воркеры."""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        tasks = [ch.task for ch in self._chats.values() if ch.task] + ([self._pump] if self._pump else [])
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._chats.clear()
+        self._pump = None
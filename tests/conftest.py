@@ -0,0 +1,18 @@
+# tests — pytest из корня репозитория: python -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")  # bot.py создаёт Bot при импорте
+
+import pytest  # noqa: E402
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Пустая SQLite-база на тест; DB_PATH модуля db возвращается после теста."""
+    path = str(tmp_path / "test.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    return path
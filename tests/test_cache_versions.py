@@ -0,0 +1,82 @@
+# версии кэшей в meta: правку одной реплики видит другая
+import asyncio
+from datetime import date, datetime
+
+import db
+
+
+def test_versions_are_shared_between_repos(db_path, monkeypatch):
+    monkeypatch.setattr(db, "CACHE_VERSION_SEC", 0.0)
+
+    async def scenario():
+        a, b = db.Repo(), db.Repo()
+        try:
+            await a.ensure_network("net")
+            before = await b.cache_versions()
+            pid = await a.ensure_product("Reno 11F 5G", "reno11f")
+            after_catalog = await b.cache_versions()
+            await a.add_stock("net", pid, 128, 3, day=date(2024, 5, 15))
+            after_stock = await b.cache_versions()
+            return before, after_catalog, after_stock
+        finally:
+            a.close()
+            b.close()
+
+    before, after_catalog, after_stock = asyncio.run(scenario())
+    assert after_catalog[0] > before[0]
+    assert after_stock[1] > after_catalog[1]
+
+
+def test_own_commit_is_visible_before_refresh_interval(db_path, monkeypatch):
+    monkeypatch.setattr(db, "CACHE_VERSION_SEC", 3600.0)
+
+    async def scenario():
+        repo = db.Repo()
+        try:
+            before = await repo.cache_versions()
+            await repo.ensure_product("A38", None)
+            return before, await repo.cache_versions()
+        finally:
+            repo.close()
+
+    before, after = asyncio.run(scenario())
+    assert after[0] > before[0]
+
+
+def test_sales_batch_bumps_data_version_once(db_path, monkeypatch):
+    monkeypatch.setattr(db, "CACHE_VERSION_SEC", 0.0)
+
+    async def scenario():
+        repo = db.Repo()
+        try:
+            await repo.ensure_network("net")
+            await repo.get_person_by_tg(1)
+            pid = await repo.ensure_product("A38", None)
+            await repo.add_stock("net", pid, 128, 5, day=date(2024, 5, 15))
+            await repo.add_stock("net", pid, 256, 5, day=date(2024, 5, 15))
+            before = await repo.cache_versions()
+            await repo.insert_sales_batch(datetime(2024, 5, 15, 12), date(2024, 5, 15), "1", "net",
+                                          [(pid, 128, 1), (pid, 256, 1), (pid, 128, 2)], 1)
+            return before, await repo.cache_versions()
+        finally:
+            repo.close()
+
+    before, after = asyncio.run(scenario())
+    assert after == (before[0], before[1] + 1, before[2])
+
+
+def test_binding_change_reaches_other_repo_cache(db_path, monkeypatch):
+    monkeypatch.setattr(db, "CACHE_VERSION_SEC", 0.0)
+
+    async def scenario():
+        a, b = db.Repo(), db.Repo()
+        try:
+            await a.bind_by_tgid(42, "net1")
+            cached = await b.get_primary_network_for_person("42")  # кэш b теперь помнит net1
+            await a.bind_by_tgid(42, "net2")
+            return cached, await b.get_primary_network_for_person("42")
+        finally:
+            a.close()
+            b.close()
+
+    assert asyncio.run(scenario()) == ("net1", "net2")
@@ -0,0 +1,68 @@
+# Антидубль апдейтов: окно в памяти и его восстановление из БД
+import asyncio
+import sqlite3
+
+import pytest
+
+import db
+from db import UpdateDedup
+
+
+def test_duplicates_inside_window():
+    d = UpdateDedup(window=100)
+    assert d.check_and_mark(1000) is False
+    assert d.check_and_mark(1000) is True
+    assert d.check_and_mark(995) is False  # пришёл позже соседей — не дубль
+    assert d.check_and_mark(995) is True
+
+
+def test_id_far_below_hwm_is_a_new_sequence():
+    # после недели тишины Telegram начинает со случайного update_id, в том числе ниже прежнего
+    d = UpdateDedup(window=100)
+    assert d.check_and_mark(900_000_000) is False
+    assert d.check_and_mark(123_456) is False
+    assert d.check_and_mark(123_457) is False
+    assert d.hwm == 123_457
+    assert d.check_and_mark(123_456) is True
+    assert d.pending == [900_000_000, 123_456, 123_457]
+
+
+def test_sequence_reset_survives_restart(db_path):
+    async def scenario():
+        repo = db.Repo()
+        try:
+            assert await repo.mark_and_check_update(900_000_000) is False
+            await repo.flush_dedup()
+            assert await repo.mark_and_check_update(123_456) is False
+            await repo.flush_dedup()
+        finally:
+            repo.close()
+        repo = db.Repo()  # hwm из meta.dedup_hwm, 900_000_000 в processed_updates остался
+        try:
+            return (await repo.mark_and_check_update(123_456), await repo.mark_and_check_update(123_457),
+                    await repo.prune_processed_updates())
+        finally:
+            repo.close()
+
+    assert asyncio.run(scenario()) == (True, False, 1)
+
+
+def test_failed_claim_leaves_update_unseen(db_path, monkeypatch):
+    monkeypatch.setattr(db, "DEDUP_SHARED", True)
+
+    async def scenario():
+        repo = db.Repo()
+        try:
+            async def locked(update_id):
+                raise sqlite3.OperationalError("database is locked")
+
+            real = repo._claim_update
+            repo._claim_update = locked
+            with pytest.raises(sqlite3.OperationalError):
+                await repo.mark_and_check_update(500)
+            repo._claim_update = real
+            return await repo.mark_and_check_update(500), await repo.mark_and_check_update(500)
+        finally:
+            repo.close()
+
+    assert asyncio.run(scenario()) == (False, True)
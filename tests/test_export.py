@@ -0,0 +1,24 @@
+# /export: выключен без явного ключа, ключ сравнивается как байты
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+import bot
+
+
+def _call(path, key):
+    req = make_mocked_request("GET", f"{path}?key={key}", match_info={"kind": "sales"})
+    return asyncio.run(bot.export_csv(req))
+
+
+def test_export_disabled_without_explicit_key(monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_KEY", "")
+    assert _call("/export/sales", "").status == 404
+    monkeypatch.setattr(bot, "EXPORT_KEY", "cron_default_0")
+    assert _call("/export/sales", "cron_default_0").status == 404
+
+
+def test_export_rejects_non_ascii_key(monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_KEY", "s3cret")
+    assert _call("/export/sales", "%D0%BA%D0%BB%D1%8E%D1%87").status == 401
+    assert _call("/export/sales", "wrong").status == 401
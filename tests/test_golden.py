@@ -0,0 +1,18 @@
+# Разбор и сопоставление корпуса: совпадение с baseline_resolve и golden.jsonl (см. bench/__main__.py)
+import asyncio
+
+from bench.__main__ import PRODUCTS, build_repo, check_baseline, check_golden
+from bench.corpus import corpus, synthetic_catalog
+
+
+def test_corpus_matches_baseline_and_golden(db_path, capsys):
+    async def scenario():
+        catalog = synthetic_catalog(PRODUCTS)
+        messages = corpus(catalog)
+        repo = await build_repo(catalog)
+        try:
+            return await check_baseline(repo, messages), await check_golden(repo, messages)
+        finally:
+            repo.close()
+
+    assert asyncio.run(scenario()) == (0, 0), capsys.readouterr().out
@@ -0,0 +1,56 @@
+# LeaderLease поверх аренды в SQLite: один лидер, передача при release и по истечении
+import asyncio
+import time
+
+import bot
+import db
+
+
+def _run(scenario):
+    async def wrapped():
+        repo = db.Repo()
+        try:
+            return await scenario(repo)
+        finally:
+            repo.close()
+    return asyncio.run(wrapped())
+
+
+def test_single_leader_and_release(db_path):
+    async def scenario(repo):
+        a, b = bot.LeaderLease("a", 60), bot.LeaderLease("b", 60)
+        await a.renew(repo)
+        await b.renew(repo)
+        first = (a.is_leader, b.is_leader)
+        await a.release(repo)
+        await b.renew(repo)
+        return first, (a.is_leader, b.is_leader)
+
+    assert _run(scenario) == ((True, False), (False, True))
+
+
+def test_expired_lease_moves_to_other_holder(db_path):
+    async def scenario(repo):
+        a, b = bot.LeaderLease("a", 0.2), bot.LeaderLease("b", 0.2)
+        await a.renew(repo)
+        time.sleep(0.3)  # a не продлевал — срок вышел и локально, и в БД
+        expired = a.is_leader
+        await b.renew(repo)
+        await a.renew(repo)
+        return expired, a.is_leader, b.is_leader
+
+    assert _run(scenario) == (False, False, True)
+
+
+def test_failed_renew_drops_leadership():
+    class BrokenRepo:
+        async def acquire_lease(self, name, holder, ttl):
+            raise OSError("db down")
+
+    async def scenario():
+        lease = bot.LeaderLease("a", 60)
+        lease._until = time.monotonic() + 60  # был лидером
+        await lease.renew(BrokenRepo())
+        return lease.is_leader
+
+    assert asyncio.run(scenario()) is False
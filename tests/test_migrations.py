@@ -0,0 +1,23 @@
+# миграции SQLite: opening-движения датируются днём бота, а не сервера
+import sqlite3
+from datetime import date
+
+import db
+
+
+def test_opening_moves_use_given_day(db_path):
+    db.Repo().close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO networks(name) VALUES('net')")
+    conn.execute("INSERT INTO products(name) VALUES('A38')")
+    conn.execute("INSERT INTO stock(network, product_id, memory_gb, qty) VALUES('net', 1, 128, 4)")
+    conn.execute("DELETE FROM stock_moves")
+    conn.execute("PRAGMA user_version=3")  # база до журнала движений
+    conn.commit()
+    conn.close()
+
+    db.Repo(today=date(2030, 1, 2)).close()
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT network, day, product_id, memory_gb, delta, kind FROM stock_moves").fetchall()
+    conn.close()
+    assert rows == [("net", "2030-01-02", 1, 128, 4, "opening")]
@@ -0,0 +1,78 @@
+# Outbox: приоритеты, лимиты по чату, 429 и ошибки, которые не повторяем
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from outbox import PRIO_DIGEST, PRIO_NOTICE, PRIO_REPLY, Outbox
+
+
+class FakeBot:
+    def __init__(self, errors=()):
+        self.sent = []            # (chat_id, text, monotonic)
+        self.errors = list(errors)  # исключения для первых вызовов
+
+    async def send_message(self, chat_id, text, **kw):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+def _method():
+    return SendMessage(chat_id=1, text="x")
+
+
+def test_priority_order_within_chat():
+    async def scenario():
+        bot = FakeBot()
+        box = Outbox(bot)
+        futs = [box.send(1, "digest", prio=PRIO_DIGEST), box.send(1, "notice", prio=PRIO_NOTICE),
+                box.send(1, "reply", prio=PRIO_REPLY), box.send(1, "notice2", prio=PRIO_NOTICE)]
+        await asyncio.gather(*futs)
+        await box.close()
+        return [text for _, text, _ in bot.sent]
+
+    assert asyncio.run(scenario()) == ["reply", "notice", "notice2", "digest"]
+
+
+def test_chat_rate_limit_after_burst():
+    async def scenario():
+        bot = FakeBot()
+        box = Outbox(bot, private_per_sec=20.0)  # ведро: 3 сразу, дальше по 50 мс
+        t0 = time.monotonic()
+        await asyncio.gather(*(box.send(7, f"m{i}") for i in range(6)))
+        await box.close()
+        return [t - t0 for _, _, t in bot.sent]
+
+    times = asyncio.run(scenario())
+    assert len(times) == 6
+    assert times[2] < 0.04
+    assert times[5] >= 0.14  # три сообщения сверх burst — не быстрее 3 × 50 мс
+
+
+def test_retry_after_pauses_and_delivers():
+    async def scenario():
+        bot = FakeBot([TelegramRetryAfter(_method(), "Too Many Requests", retry_after=0)])
+        box = Outbox(bot)
+        msg = await box.send(1, "hello")
+        await box.close()
+        return msg, box.stats
+
+    msg, stats = asyncio.run(scenario())
+    assert msg == "hello"
+    assert stats["flood"] == 1 and stats["retried"] == 1 and stats["sent"] == 1 and stats["dropped"] == 0
+
+
+def test_bad_request_is_dropped_without_retry():
+    async def scenario():
+        bot = FakeBot([TelegramBadRequest(_method(), "chat not found")])
+        box = Outbox(bot)
+        msg = await box.send(1, "hello")
+        await box.close()
+        return msg, box.stats, bot.sent
+
+    msg, stats, sent = asyncio.run(scenario())
+    assert msg is None and sent == []
+    assert stats["dropped"] == 1 and stats["retried"] == 0
@@ -0,0 +1,32 @@
+# db_pg.PgRepo против db.Repo на одном сценарии (см. bench/parity.py).
+# Адрес — PG_TEST_URL (по умолчанию локальный postgres); пропуск, только если до сервера не достучаться.
+import asyncio
+import os
+
+import pytest
+
+from bench import parity
+
+asyncpg = pytest.importorskip("asyncpg")
+
+
+def _reachable_url() -> str:
+    from db_pg import asyncpg_dsn
+
+    url = os.getenv("PG_TEST_URL", parity.DEFAULT_URL)
+
+    async def probe():
+        conn = await asyncpg.connect(asyncpg_dsn(url), timeout=5)
+        await conn.close()
+
+    try:
+        asyncio.run(probe())
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+        pytest.skip(f"Postgres недоступен ({url}): {e}")
+    return url
+
+
+def test_pg_matches_sqlite(db_path, capsys):
+    url = _reachable_url()
+    code = asyncio.run(parity.check(url))
+    assert code == 0, capsys.readouterr().out
@@ -0,0 +1,96 @@
+# UpdatePipeline: порядок апдейтов автора, предел очередей, изоляция упавших
+import asyncio
+
+from aiogram.types import Update
+
+from updates import UpdatePipeline
+
+
+def _update(update_id, user_id, text="x"):
+    return Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"}}})
+
+
+class FakeDispatcher:
+    def __init__(self, fail=()):
+        self.seen = []
+        self.fail = set(fail)
+
+    async def feed_update(self, bot, update):
+        await asyncio.sleep(0)
+        if update.update_id in self.fail:
+            raise RuntimeError("boom")
+        self.seen.append(update.update_id)
+
+
+def test_same_sender_keeps_arrival_order_despite_slow_route():
+    async def scenario():
+        dp = FakeDispatcher()
+
+        async def route(u):
+            # первый апдейт маршрутизируется дольше второго
+            await asyncio.sleep(0.05 if u.update_id == 1 else 0)
+            return "net:1"
+
+        pipe = UpdatePipeline(dp, None, route)
+        await asyncio.gather(pipe.put(_update(1, 10)), pipe.put(_update(2, 10)), pipe.put(_update(3, 10)))
+        await pipe.close()
+        return dp.seen
+
+    assert asyncio.run(scenario()) == [1, 2, 3]
+
+
+def test_route_failure_falls_back_and_keeps_order():
+    async def scenario():
+        dp = FakeDispatcher()
+
+        async def route(u):
+            if u.update_id == 1:
+                await asyncio.sleep(0.02)
+                raise RuntimeError("db down")
+            return "net:1"
+
+        pipe = UpdatePipeline(dp, None, route)
+        await asyncio.gather(pipe.put(_update(1, 10)), pipe.put(_update(2, 10)))
+        await pipe.close()
+        return dp.seen
+
+    assert asyncio.run(scenario()) == [1, 2]
+
+
+def test_lane_count_is_capped():
+    async def scenario():
+        dp = FakeDispatcher()
+
+        async def route(u):
+            return f"user:{u.update_id}"
+
+        pipe = UpdatePipeline(dp, None, route, max_lanes=4)
+        await asyncio.gather(*(pipe.put(_update(i, i)) for i in range(1, 51)))
+        lanes = len(pipe._lanes)
+        await pipe.close()
+        return lanes, sorted(dp.seen)
+
+    lanes, seen = asyncio.run(scenario())
+    assert lanes <= 4
+    assert seen == list(range(1, 51))
+
+
+def test_failed_update_does_not_stop_lane():
+    async def scenario():
+        dp = FakeDispatcher(fail={2})
+
+        async def route(u):
+            return "net:1"
+
+        pipe = UpdatePipeline(dp, None, route)
+        for i in (1, 2, 3):
+            await pipe.put(_update(i, 10))
+        await pipe.close()
+        return dp.seen, pipe.stats
+
+    seen, stats = asyncio.run(scenario())
+    assert seen == [1, 3]
+    assert stats["processed"] == 2 and stats["failed"] == 1 and stats["received"] == 3
@@ -0,0 +1,9 @@
+# Планы всех запросов Repo: без полных сканов и temp B-tree (см. bench/plans.py)
+import asyncio
+
+from bench import plans
+
+
+def test_query_plans(db_path, capsys):
+    code = asyncio.run(plans.check())
+    assert code == 0, capsys.readouterr().out
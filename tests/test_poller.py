@@ -0,0 +1,157 @@
+# UpdatePoller поверх SQLite: пачка через очереди UpdatePipeline, offset раз на пачку, антидубль повторов
+import asyncio
+
+from aiogram.types import Update
+
+import db
+from updates import UpdatePipeline, UpdatePoller
+
+
+def _update(update_id, user_id=1):
+    return Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "/import",
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"}}})
+
+
+class FakeBot:
+    def __init__(self, updates):
+        self.updates = updates
+
+    async def get_updates(self, offset=None, limit=100, timeout=0, **kw):
+        got = [u for u in self.updates if offset is None or u.update_id >= offset][:limit]
+        if not got:
+            await asyncio.sleep(0.05)  # long polling без новых апдейтов
+        return got
+
+
+class FakeDispatcher:
+    def __init__(self, fail=(), block=None):
+        self.seen = []
+        self.fail = set(fail)
+        self.block = block  # (update_id, asyncio.Event): обработчик ждёт события
+
+    async def feed_update(self, bot, update):
+        if self.block and update.update_id == self.block[0]:
+            await self.block[1].wait()
+        if update.update_id in self.fail:
+            raise RuntimeError("boom")
+        self.seen.append(update.update_id)
+
+
+class CountingRepo:
+    """Repo с подсчётом записей offset; fail_offsets — сколько первых записей упадёт."""
+
+    def __init__(self, repo, fail_offsets=0):
+        self.repo = repo
+        self.dedup = repo.dedup
+        self.offset_writes = 0
+        self.fail_offsets = fail_offsets
+
+    async def get_poll_offset(self):
+        return await self.repo.get_poll_offset()
+
+    async def set_poll_offset(self, offset):
+        if self.fail_offsets:
+            self.fail_offsets -= 1
+            raise OSError("db down")
+        self.offset_writes += 1
+        await self.repo.set_poll_offset(offset)
+
+
+def _pipeline(dp, repo, route=None):
+    async def by_user(u):
+        return f"user:{u.message.from_user.id}"
+    return UpdatePipeline(dp, None, route or by_user, seen=lambda u: repo.mark_and_check_update(u.update_id))
+
+
+async def _wait(cond, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not cond() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_batch_saves_offset_once_and_isolates_failures(db_path):
+    async def scenario():
+        repo = db.Repo()
+        try:
+            counting = CountingRepo(repo)
+            dp = FakeDispatcher(fail={11})
+            pipe = _pipeline(dp, repo)
+            poller = UpdatePoller(pipe, FakeBot([_update(i, i % 2) for i in (10, 11, 12, 13)]), counting, timeout=0)
+            poller.start()
+            await _wait(lambda: poller.stats["batches"] >= 1)
+            await poller.close()
+            await pipe.close()
+            return sorted(dp.seen), counting.offset_writes, await repo.get_poll_offset(), pipe.stats["failed"]
+        finally:
+            repo.close()
+
+    seen, writes, offset, failed = asyncio.run(scenario())
+    assert seen == [10, 12, 13]  # упавший 11 не остановил пачку
+    assert writes == 1 and offset == 14 and failed == 1
+
+
+def test_restart_continues_from_saved_offset(db_path):
+    async def scenario():
+        repo = db.Repo()
+        try:
+            bot = FakeBot([_update(i) for i in (10, 11, 12)])
+            dp = FakeDispatcher()
+            pipe = _pipeline(dp, repo)
+            poller = UpdatePoller(pipe, bot, repo, timeout=0)
+            poller.start()
+            await _wait(lambda: poller.stats["batches"] >= 1)
+            await poller.close()
+            # новый процесс: offset из БД, уже обработанное не приходит
+            dp2 = FakeDispatcher()
+            poller = UpdatePoller(_pipeline(dp2, repo), bot, repo, timeout=0)
+            poller.start()
+            await asyncio.sleep(0.2)
+            await poller.close()
+            return dp.seen, dp2.seen, poller.stats["batches"]
+        finally:
+            repo.close()
+
+    assert asyncio.run(scenario()) == ([10, 11, 12], [], 0)
+
+
+def test_other_writes_proceed_while_handler_waits(db_path):
+    async def scenario():
+        repo = db.Repo()
+        try:
+            release = asyncio.Event()
+            dp = FakeDispatcher(block=(21, release))
+            poller = UpdatePoller(_pipeline(dp, repo), FakeBot([_update(20), _update(21)]), repo, timeout=0)
+            poller.start()
+            await _wait(lambda: 20 in dp.seen)
+            # обработчик 21 «качает файл»; продление аренды не должно ждать его
+            held = await asyncio.wait_for(repo.acquire_lease("scheduler", "replica-a", 60), 1.0)
+            saved = await repo.get_poll_offset()
+            release.set()
+            await _wait(lambda: poller.stats["batches"] >= 1)
+            await poller.close()
+            return held, saved, await repo.get_poll_offset()
+        finally:
+            repo.close()
+
+    assert asyncio.run(scenario()) == (True, None, 22)
+
+
+def test_refetched_batch_is_not_handled_twice(db_path):
+    async def scenario():
+        repo = db.Repo()
+        try:
+            counting = CountingRepo(repo, fail_offsets=1)
+            dp = FakeDispatcher()
+            pipe = _pipeline(dp, repo)
+            poller = UpdatePoller(pipe, FakeBot([_update(i) for i in (30, 31, 32)]), counting, timeout=0)
+            poller.start()
+            await _wait(lambda: poller.stats["batches"] >= 1)
+            await poller.close()
+            return dp.seen, pipe.stats["duplicates"], poller.stats["errors"], await repo.get_poll_offset()
+        finally:
+            repo.close()
+
+    # первая запись offset упала — пачка пришла снова, но команды не выполнились второй раз
+    assert asyncio.run(scenario()) == ([30, 31, 32], 3, 1, 33)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Трассировка апдейтов по этапам и сэмплирующий профайлер — оба включаются конфигом.
+
+TracingMiddleware (bot.py) заводит на апдейт Trace через start(); span("имя") внутри
+обработчика (и в обёртках Repo) копит время этапа. Вложенные этапы копятся по пути
+(resolve_products_batch/repo.get_network_stock_candidates). Апдейт дольше порога уходит в лог
+"slow" с разбивкой. Вне трассы span() ничего не делает, кроме чтения ContextVar.
+
+Отправка сообщений идёт через outbox в своих задачах, поэтому в трассу попадает
+только постановка в очередь, а не ожидание лимитов/429.
+
+SamplingProfiler раз в interval снимает стеки всех потоков (sys._current_frames)
+и раз в window пишет в лог самые частые функции: self — на вершине стека,
+cum — где-то в стеке. Ожидание (select event loop, очереди пулов) считается простоем.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger("tracing")
+
+Path = Tuple[str, ...]
+
+
+class Trace:
+    __slots__ = ("name", "t0", "path", "spans")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.t0 = time.perf_counter()
+        self.path: Path = ()
+        self.spans: Dict[Path, List[float]] = {}  # путь -> [секунды, вызовы]; порядок — первого входа
+
+    def breakdown(self, total: float) -> str:
+        lines = []
+        top = 0.0
+        for path, (sec, n) in self.spans.items():
+            if len(path) == 1:
+                top += sec
+            lines.append(f"{'  ' * len(path)}{path[-1]} {sec * 1000:.1f}ms" + (f" x{n}" if n > 1 else ""))
+        lines.append(f"  (прочее) {(total - top) * 1000:.1f}ms")
+        return "\n".join(lines)
+
+
+_CURRENT: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "parent", "acc", "t0")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        tr = self.trace
+        self.parent = tr.path
+        tr.path = self.parent + (self.name,)
+        # место в разбивке — по первому входу, чтобы родитель шёл раньше вложенных
+        self.acc = tr.spans.get(tr.path) or tr.spans.setdefault(tr.path, [0.0, 0])
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.acc[0] += time.perf_counter() - self.t0
+        self.acc[1] += 1
+        self.trace.path = self.parent
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+def span(name: str):
+    """Этап текущего апдейта; без активной трассы — пустой контекст."""
+    tr = _CURRENT.get()
+    return _NULL if tr is None else _Span(tr, name)
+
+
+def start(name: str):
+    """Начать трассу в текущем контексте: (trace, token для finish)."""
+    tr = Trace(name)
+    return tr, _CURRENT.set(tr)
+
+
+def finish(token) -> None:
+    _CURRENT.reset(token)
+
+
+# ---------- сэмплирующий профайлер ----------
+_IDLE_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+
+def _frame_key(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}:{code.co_name}"
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, window: float = 60.0, top: int = 20):
+        self.interval = interval
+        self.window = window
+        self.top = top
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        own: Counter = Counter()
+        cum: Counter = Counter()
+        samples = busy = 0
+        deadline = time.monotonic() + self.window
+        while not self._stop.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                samples += 1
+                if os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                    continue
+                busy += 1
+                own[_frame_key(frame.f_code)] += 1
+                seen = set()
+                while frame is not None:
+                    key = _frame_key(frame.f_code)
+                    if key not in seen:
+                        seen.add(key)
+                        cum[key] += 1
+                    frame = frame.f_back
+            if time.monotonic() >= deadline:
+                self._dump(samples, busy, own, cum)
+                own.clear()
+                cum.clear()
+                samples = busy = 0
+                deadline = time.monotonic() + self.window
+
+    def _dump(self, samples: int, busy: int, own: Counter, cum: Counter):
+        if not busy:
+            log.info("profile %.0fs: %d samples, all idle", self.window, samples)
+            return
+        lines = [f"profile {self.window:.0f}s: {samples} samples, busy {busy}",
+                 "   self    cum  function"]
+        for key, n in own.most_common(self.top):
+            lines.append(f"{n * 100 / busy:6.1f}% {cum[key] * 100 / busy:5.1f}%  {key}")
+        lines.append("   -- cumulative --")
+        for key, n in cum.most_common(self.top):
+            lines.append(f"{own[key] * 100 / busy:6.1f}% {n * 100 / busy:5.1f}%  {key}")
+        log.info("\n".join(lines))
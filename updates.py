@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Приём апдейтов: вебхук с очередями по сетям или long polling пачками.
+
+Вебхук только проверяет секрет, определяет ключ очереди (обычно сеть автора) и
+кладёт апдейт в очередь этого ключа. У каждого ключа один воркер, поэтому внутри
+сети апдейты идут строго по порядку (остатки считаются последовательно), а разные
+сети обрабатываются параллельно. Ключ определяется асинхронно (запрос в БД), но
+апдейты одного автора встают в очередь в порядке прихода: следующий ждёт, пока
+предыдущий поставлен. Очередей не больше max_lanes — ключи раскладываются по ним
+хешем, так что все апдейты ключа всегда в одной очереди. Очередь ограничена: если
+она полна, вебхук ждёт место и не отвечает — Telegram сам притормозит доставку.
+Повторная доставка отсекается до очереди (seen), так что ни команда, ни учёт не
+выполнятся второй раз.
+
+UpdatePoller забирает getUpdates пачками до 100 и отдаёт пачку в те же очереди:
+сети разбираются параллельно, обработчики (ответы, файлы /import) работают без общей
+транзакции. Когда очереди пусты, offset пачки сохраняется одной записью. После падения
+пачка придёт снова — уже учтённые апдейты отсеет seen.
+"""
+
+import asyncio
+import hmac
+import logging
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+log = logging.getLogger("updates")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WORKER_IDLE_SEC = 60.0  # воркер ключа без апдейтов столько секунд — завершается
+POLL_IDLE_SEC = 1.0     # поллер не активен (не лидер) — проверяем снова через столько
+POLL_MAX_BACKOFF = 30.0
+
+
+class _Lane:
+    __slots__ = ("queue", "task")
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.task: Optional[asyncio.Task] = None
+
+
+def _sender(update: Update) -> Optional[int]:
+    user = getattr(update.event, "from_user", None)
+    return user.id if user is not None else None
+
+
+class UpdatePipeline:
+    def __init__(self, dp: Dispatcher, bot: Bot, route: Callable[[Update], Awaitable[str]],
+                 secret: str = "", max_queue: int = 100, max_lanes: int = 64,
+                 seen: Optional[Callable[[Update], Awaitable[bool]]] = None):
+        self.dp = dp
+        self.bot = bot
+        self.route = route
+        self.seen = seen  # True — апдейт уже учтён (повторная доставка), в очередь не ставим
+        self.secret = secret
+        self.max_queue = max_queue
+        self.max_lanes = max_lanes
+        self._lanes: Dict[int, _Lane] = {}
+        self._admitted: Dict[Optional[int], asyncio.Future] = {}  # автор -> постановка его последнего апдейта
+        self._closing = False
+        self.stats = {"received": 0, "duplicates": 0, "processed": 0, "failed": 0, "waited_full": 0}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            return web.Response(status=401, text="unauthorized")
+        if self._closing:
+            return web.Response(status=503, text="shutting down")  # Telegram повторит позже
+        update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        await self.put(update)
+        return web.Response(text="ok")
+
+    async def put(self, update: Update):
+        self.stats["received"] += 1
+        # место в очереди автора занимаем до первого await: маршрут у апдейтов считается
+        # параллельно, но ставятся они в порядке прихода
+        sender = _sender(update)
+        prev = self._admitted.get(sender)
+        done = asyncio.get_running_loop().create_future()
+        self._admitted[sender] = done
+        try:
+            if self.seen is not None and await self.seen(update):
+                self.stats["duplicates"] += 1
+                return
+            try:
+                key = await self.route(update)
+            except Exception as e:
+                log.warning("route failed for update %s: %s", update.update_id, e)
+                key = "default"
+            if prev is not None:
+                await prev
+            await self._enqueue(zlib.crc32(key.encode()) % self.max_lanes, update)
+        finally:
+            done.set_result(None)
+            if self._admitted.get(sender) is done:
+                del self._admitted[sender]
+
+    async def _enqueue(self, idx: int, update: Update):
+        lane = self._lanes.get(idx)
+        if lane is None:
+            lane = self._lanes[idx] = _Lane(self.max_queue)
+        if lane.queue.full():
+            self.stats["waited_full"] += 1
+        if lane.task is None:
+            lane.task = asyncio.create_task(self._run(idx, lane))
+        await lane.queue.put(update)
+
+    def depth(self) -> int:
+        return sum(l.queue.qsize() for l in self._lanes.values())
+
+    async def join(self):
+        """Дождаться, пока все поставленные апдейты обработаны."""
+        await asyncio.gather(*(l.queue.join() for l in list(self._lanes.values())))
+
+    async def _run(self, idx: int, lane: _Lane):
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(lane.queue.get(), WORKER_IDLE_SEC)
+                except asyncio.TimeoutError:
+                    if lane.queue.empty():
+                        return
+                    continue
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                    self.stats["processed"] += 1
+                except Exception:
+                    self.stats["failed"] += 1
+                    log.exception("update %s (lane %d) failed", update.update_id, idx)
+                finally:
+                    lane.queue.task_done()
+        finally:
+            lane.task = None
+            if lane.queue.empty() and self._lanes.get(idx) is lane:
+                del self._lanes[idx]
+
+    async def close(self, timeout: float = 10.0):
+        """Перестать принимать, доработать очереди (не дольше timeout), остановить воркеры."""
+        self._closing = True
+        lanes = list(self._lanes.values())
+        try:
+            await asyncio.wait_for(asyncio.gather(*(l.queue.join() for l in lanes)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("updates: %d left unprocessed on shutdown", self.depth())
+        tasks = [l.task for l in self._lanes.values() if l.task]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._lanes.clear()
+
+
+class UpdatePoller:
+    """Long polling: getUpdates -> пачка в очереди UpdatePipeline -> offset раз на пачку.
+
+    Порядок внутри сети и изоляцию упавших обработчиков даёт pipeline, как при вебхуке.
+    Если пачка не дошла до записи offset (сбой, остановка), она придёт снова, а
+    обработанные апдейты pipeline отсеет по seen.
+    active() — можно ли сейчас опрашивать (getUpdates допускает одного потребителя на бота).
+    """
+
+    def __init__(self, pipeline: UpdatePipeline, bot: Bot, repo, active: Callable[[], bool] = lambda: True,
+                 limit: int = 100, timeout: int = 25, allowed_updates: Optional[List[str]] = None):
+        self.pipeline = pipeline
+        self.bot = bot
+        self.repo = repo
+        self.active = active
+        self.limit = limit
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._busy = False
+        self.stats = {"batches": 0, "updates": 0, "errors": 0}
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        offset: Optional[int] = None
+        backoff = 1.0
+        while not self._closing:
+            if not self.active():
+                offset = None  # пока опрашивал другой, offset в БД ушёл вперёд
+                await asyncio.sleep(POLL_IDLE_SEC)
+                continue
+            try:
+                if offset is None:
+                    offset = await self.repo.get_poll_offset()
+                updates = await self.bot.get_updates(offset=offset, limit=self.limit, timeout=self.timeout,
+                                                     allowed_updates=self.allowed_updates,
+                                                     request_timeout=self.timeout + 10)
+                if updates and not self._closing:
+                    offset = await self._process(updates)
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # сеть, 409 от соседа, который ещё не отпустил getUpdates, сбой коммита пачки
+                self.stats["errors"] += 1
+                offset = None  # после сбоя — с offset из БД
+                log.warning("polling failed: %s; retry in %.0fs", e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+
+    async def _process(self, updates: List[Update]) -> int:
+        offset = updates[-1].update_id + 1
+        self._busy = True
+        try:
+            # put() ставит апдейты автора в порядке вызова, поэтому пачку можно раздать разом
+            await asyncio.gather(*(self.pipeline.put(u) for u in updates))
+            await self.pipeline.join()
+            await self.repo.set_poll_offset(offset)
+        finally:
+            self._busy = False
+        self.stats["batches"] += 1
+        self.stats["updates"] += len(updates)
+        return offset
+
+    async def close(self, timeout: float = 10.0):
+        """Не брать новых пачек, дождаться текущей (не дольше timeout), остановить опрос."""
+        self._closing = True
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self._busy and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None